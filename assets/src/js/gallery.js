@@ -72,14 +72,82 @@ function onThumbnailClick(e) {
   openPhotoSwipe($(e.currentTarget).data('index'));
 }
 
+// Create 'figure' element for image fetched from next page
+function createFigure(image) {
+  const $figure = $('<figure class="col-sm-4 text-center" itemprop="associatedMedia" itemscope itemtype="http://schema.org/ImageObject">'),
+    $link = $('<a itemprop="contentUrl">'),
+    $img = image.ready
+      ? $('<img itemprop="thumbnail" alt="Image description" loading="lazy">').attr('src', image.thumbnail_url)
+      : $('<span class="image-placeholder">Processing&hellip;</span>');
+
+  $link.attr('href', image.url)
+    .attr('data-size', image.width + 'x' + image.height)
+    .attr('data-index', items.length)
+    .on('click', onThumbnailClick)
+    .append($img);
+
+  $figure.append($link)
+    .append($('<figcaption itemprop="caption description">').text(image.description));
+
+  items.push({
+    src: image.url,
+    msrc: image.ready ? image.thumbnail_url : undefined,
+    title: image.description,
+    w: image.width,
+    h: image.height
+  });
+
+  return $figure;
+}
+
+// Load next page of images when user scrolls to the bottom of gallery
+function initIncrementalLoading() {
+  const $gallery = $('.gallery'),
+    $more = $gallery.find('.gallery-more');
+  let nextUrl = $gallery.data('next'),
+    loading = false;
+
+  if (!nextUrl || !('IntersectionObserver' in window)) {
+    return;
+  }
+
+  const observer = new IntersectionObserver(function(entries) {
+    if (loading || !entries[0].isIntersecting) {
+      return;
+    }
+
+    loading = true;
+    $.getJSON(nextUrl).done(function(data) {
+      const $row = $gallery.find('.row').first();
+
+      data.images.forEach(function(image) {
+        $row.append(createFigure(image));
+      });
+
+      nextUrl = data.next;
+      if (!nextUrl) {
+        observer.disconnect();
+        $more.remove();
+      }
+    }).always(function() {
+      loading = false;
+    });
+  }, { rootMargin: '400px' });
+
+  $more.find('a').addClass('invisible');
+  observer.observe($more[0]);
+}
+
 function initGallery() {
   getItems();
 
   // Bind click event to thumbnails
-  $('.gallery').find('a').each(function() {
+  $('.gallery').find('a[data-index]').each(function() {
     $(this).on('click', onThumbnailClick);
   });
 
+  initIncrementalLoading();
+
   // Get params from url if user navigate directly
   // to selected picture
   const hashData = photoswipeParseHash();
@@ -0,0 +1,115 @@
+"""
+Compares time and peak memory of creating derivatives of large JPEG
+file with full decode (previous behaviour) and with decode at reduced
+scale used by `smart_resize` now.
+
+Every variant runs in separate process to measure it's own peak RSS::
+
+    $ python -m benchmarks.decode --width 6000 --height 4000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from chgallery.image.derivatives import PREVIEW_SIZE, THUMBNAIL_SIZE, generate_derivatives
+from chgallery.image.utils import get_resized_size
+
+
+def full_decode(upload_path, filename):
+    """ Derivatives created from image decoded at native resolution """
+    path = os.path.join(upload_path, filename)
+    with Image.open(path) as img:
+        img_format = img.format
+        img.load()
+        img = img.resize(get_resized_size(img.size))
+    img.save(path, img_format)
+    img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    img.save(os.path.join(upload_path, 'thumbs', filename), img_format)
+    img.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    img.save(os.path.join(upload_path, 'previews', filename), img_format)
+
+
+VARIANTS = {
+    'full': full_decode,
+    'draft': generate_derivatives,
+}
+
+
+def create_image(path, width, height):
+    """ Synthetic photo-like image, gradient with some noise """
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 64)
+    Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT))).save(path, 'JPEG', quality=90)
+
+
+def peak_rss():
+    """
+    Peak resident set size in kilobytes. On Linux `ru_maxrss` survives
+    exec and may be inherited from the parent, so VmHWM is used instead.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_variant(variant, source, repeat):
+    """ Run single variant in current process and print results as JSON """
+    timings = []
+    with tempfile.TemporaryDirectory() as upload_path:
+        os.makedirs(os.path.join(upload_path, 'thumbs'))
+        os.makedirs(os.path.join(upload_path, 'previews'))
+        for i in range(repeat):
+            with open(source, 'rb') as src, open(os.path.join(upload_path, 'image.jpg'), 'wb') as dst:
+                dst.write(src.read())
+            start = time.perf_counter()
+            VARIANTS[variant](upload_path, 'image.jpg')
+            timings.append(time.perf_counter() - start)
+
+    print(json.dumps({
+        'time': min(timings),
+        'maxrss': peak_rss(),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--variant', choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.source, args.repeat)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source.jpg')
+        create_image(source, args.width, args.height)
+        print('{}x{} JPEG, best of {} runs'.format(args.width, args.height, args.repeat))
+        print('{:<8}{:>12}{:>16}'.format('variant', 'time [s]', 'peak RSS [MB]'))
+
+        for variant in VARIANTS:
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.decode',
+                '--variant', variant, '--source', source, '--repeat', str(args.repeat),
+            ])
+            result = json.loads(output)
+            print('{:<8}{:>12.3f}{:>16.1f}'.format(variant, result['time'], result['maxrss'] / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Load test of running application with mixed workload of anonymous
+gallery views, thumbnails, logins, dashboards and uploads. Fill the
+gallery with `flask seed-gallery` first, then run against application
+started with repository's `uwsgi.ini` (``--server`` starts it)::
+
+    $ flask seed-gallery --users 50 --images 5000
+    $ python -m benchmarks.load --server --duration 60 --concurrency 16
+
+Every virtual user (thread) logs in as random `seed-user-<number>` when
+it needs to. Latency percentiles and throughput are reported for every
+kind of request. Only the measured request is timed, e.g. the form with
+CSRF token fetched before login or upload is not. Every uploaded file
+is unique, so uploads aren't shortened by deduplication.
+"""
+import argparse
+import http.cookiejar
+import io
+import json
+import random
+import re
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from chgallery.seed import USERNAME_PREFIX, make_image
+
+
+ACTIONS = ('index', 'thumbnail', 'login', 'dashboard', 'upload')
+DEFAULT_MIX = 'index=30,thumbnail=40,login=5,dashboard=20,upload=5'
+
+CSRF_RE = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+
+
+class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """ Redirects are returned as responses, so only single request is timed """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class VirtualUser:
+
+    def __init__(self, base_url, users, password, thumbnails, upload_data, rnd):
+        self.base_url = base_url.rstrip('/')
+        self.users = users
+        self.password = password
+        self.thumbnails = thumbnails
+        self.upload_data = upload_data
+        self.rnd = rnd
+        self.logged_in = False
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), NoRedirectHandler()
+        )
+
+    def request(self, path, data=None, headers=None):
+        """
+        :rtype tuple: status code and body
+        """
+        url = path if path.startswith('http') else self.base_url + path
+        req = urllib.request.Request(url, data=data, headers=headers or {})
+        try:
+            with self.opener.open(req, timeout=30) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+    def timed(self, path, data=None, headers=None, expected=200):
+        """
+        :param int expected: status code of successful response
+        :rtype tuple: latency in seconds and True if request succeeded
+        """
+        start = time.perf_counter()
+        status, body = self.request(path, data, headers)
+        return time.perf_counter() - start, status == expected
+
+    def get_csrf_token(self, path):
+        status, body = self.request(path)
+        match = CSRF_RE.search(body.decode('utf-8', 'replace'))
+        return match.group(1) if match else ''
+
+    def index(self):
+        return self.timed('/')
+
+    def thumbnail(self):
+        return self.timed(self.rnd.choice(self.thumbnails))
+
+    def login(self):
+        self.cookies.clear()
+        token = self.get_csrf_token('/auth/login')
+        data = urllib.parse.urlencode({
+            'csrf_token': token,
+            'username': '{}{}'.format(USERNAME_PREFIX, self.rnd.randint(1, self.users)),
+            'password': self.password,
+        }).encode()
+        # Successful login redirects to dashboard, failed one shows the form again
+        latency, self.logged_in = self.timed('/auth/login', data, expected=302)
+        return latency, self.logged_in
+
+    def dashboard(self):
+        if not self.logged_in:
+            self.login()
+        return self.timed('/auth/')
+
+    def upload(self):
+        if not self.logged_in:
+            self.login()
+        token = self.get_csrf_token('/image/upload')
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        for name, value in (('csrf_token', token), ('description', 'Load test')):
+            body.write('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                boundary, name, value
+            ).encode())
+        body.write((
+            '--{}\r\nContent-Disposition: form-data; name="image"; filename="load-test.jpg"\r\n'
+            'Content-Type: image/jpeg\r\n\r\n'
+        ).format(boundary).encode())
+        body.write(unique_jpeg(self.upload_data))
+        body.write('\r\n--{}--\r\n'.format(boundary).encode())
+        return self.timed('/image/upload', body.getvalue(), {
+            'Content-Type': 'multipart/form-data; boundary={}'.format(boundary),
+        }, expected=302)
+
+
+def unique_jpeg(data):
+    """
+    Insert comment segment with random contents after JPEG's SOI marker,
+    so every upload has different digest and is stored and processed
+    instead of being hard linked as duplicate (`IMAGE_DEDUPLICATE`).
+
+    :param bytes data: JPEG file
+    :rtype bytes:
+    """
+    comment = uuid.uuid4().hex.encode()
+    return data[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + data[2:]
+
+
+def parse_mix(value):
+    """
+    :param str value: e.g. 'index=30,upload=5'
+    :rtype dict: weight of every action
+    """
+    mix = {}
+    for item in value.split(','):
+        name, weight = item.split('=')
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError('Unknown action: {}'.format(name))
+        mix[name] = int(weight)
+    return mix
+
+
+def collect_thumbnails(base_url, pages):
+    """ Thumbnail URLs of images displayed on first gallery pages """
+    opener = urllib.request.build_opener()
+    thumbnails = []
+    url = base_url.rstrip('/') + '/page.json'
+    for i in range(pages):
+        with opener.open(url, timeout=30) as response:
+            page = json.loads(response.read())
+        thumbnails.extend(image['thumbnail_url'] for image in page['images'] if image['ready'])
+        if not page['next']:
+            break
+        url = urllib.parse.urljoin(url, page['next'])
+    return thumbnails
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of sorted values """
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def wait_for_server(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit('Server is not listening on {}:{}'.format(host, port))
+
+
+def run(args, mix, thumbnails, upload_data):
+    results = {name: [] for name in mix}
+    errors = {name: 0 for name in mix}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    actions, weights = zip(*mix.items())
+
+    def worker(number):
+        rnd = random.Random(args.seed + number if args.seed is not None else None)
+        user = VirtualUser(args.url, args.users, args.password, thumbnails, upload_data, rnd)
+        while time.monotonic() < deadline:
+            action = rnd.choices(actions, weights)[0]
+            try:
+                latency, ok = getattr(user, action)()
+            except OSError:
+                latency, ok = None, False
+            with lock:
+                if ok:
+                    results[action].append(latency)
+                else:
+                    errors[action] += 1
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors, time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8008', help='Address from uwsgi.ini by default.')
+    parser.add_argument('--server', action='store_true', help='Start application with uwsgi --ini uwsgi.ini.')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of the test.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of virtual users.')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help='Weights of requests.')
+    parser.add_argument('--users', type=int, default=10, help='Number of seeded users to log in as.')
+    parser.add_argument('--password', default='seed', help='Password of seeded users.')
+    parser.add_argument('--pages', type=int, default=5, help='Gallery pages to collect thumbnails from.')
+    parser.add_argument('--seed', type=int, help='Seed of random generator.')
+    args = parser.parse_args()
+
+    server = None
+    if args.server:
+        if shutil.which('uwsgi') is None:
+            raise SystemExit('uwsgi is not installed')
+        server = subprocess.Popen(
+            ['uwsgi', '--ini', 'uwsgi.ini'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+    try:
+        url = urllib.parse.urlsplit(args.url)
+        wait_for_server(url.hostname, url.port or 80)
+
+        thumbnails = collect_thumbnails(args.url, args.pages)
+        if not thumbnails and args.mix.get('thumbnail'):
+            raise SystemExit('No thumbnails found, fill the gallery with flask seed-gallery')
+
+        upload = io.BytesIO()
+        make_image((1600, 1200), random.Random(args.seed)).save(upload, 'JPEG', quality=90)
+
+        results, errors, elapsed = run(args, args.mix, thumbnails, upload.getvalue())
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print('{} virtual users, {:.1f} s'.format(args.concurrency, elapsed))
+    print('{:<12}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'request', 'count', 'errors', 'req/s', 'p50 [ms]', 'p90 [ms]', 'p99 [ms]', 'max [ms]'
+    ))
+    for name in sorted(results, key=lambda name: -len(results[name])) + ['total']:
+        if name == 'total':
+            latencies = sorted(latency for values in results.values() for latency in values)
+            failed = sum(errors.values())
+        else:
+            latencies = sorted(results[name])
+            failed = errors[name]
+        if not latencies:
+            print('{:<12}{:>10}{:>8}'.format(name, 0, failed))
+            continue
+        print('{:<12}{:>10}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            name, len(latencies), failed, len(latencies) / elapsed,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000, latencies[-1] * 1000,
+        ))
+
+
+if __name__ == '__main__':
+    main()
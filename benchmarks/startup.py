@@ -0,0 +1,128 @@
+"""
+Startup time of worker process: importing the application, `create_app`
+and latency of first requests, which compile templates and load modules
+imported on first use::
+
+    $ python -m benchmarks.startup --repeat 10
+
+Every run is a fresh process, like a (re)spawned uwsgi worker. Variants
+differ in Jinja bytecode cache: disabled, enabled but empty (first
+worker after deployment) and already filled by previous process.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+VARIANTS = ('no-cache', 'cold', 'warm')
+
+# Requests sent by every process, in this order
+REQUESTS = (('first /', '/'), ('first /auth/login', '/auth/login'), ('second /', '/'))
+
+METRICS = ('import', 'create_app') + tuple(name for name, path in REQUESTS)
+
+
+def get_config(data_dir, variant):
+    return {
+        'DATABASE': 'sqlite:///{}'.format(os.path.join(data_dir, 'benchmark.sqlite')),
+        'UPLOAD_PATH': os.path.join(data_dir, 'uploads'),
+        'TEMPLATE_BYTECODE_CACHE': variant != 'no-cache',
+        'TEMPLATE_BYTECODE_CACHE_DIR': os.path.join(data_dir, 'jinja-cache'),
+    }
+
+
+def prepare(data_dir, images):
+    """ Create database with `images` entries, displayed on the index page """
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+
+    from chgallery import create_app
+    from chgallery.db import get_db_session, init_db
+    from chgallery.db.declarative import Image, User
+
+    app = create_app(get_config(data_dir, 'no-cache'))
+    with app.app_context():
+        init_db()
+        db_session = get_db_session()
+        user = User(username='test', password=generate_password_hash('test'), email='test@example.com')
+        db_session.add(user)
+        db_session.flush()
+        db_session.execute(insert(Image), [
+            {'name': 'image-{}.jpg'.format(i), 'width': 2000, 'height': 1333, 'author_id': user.id,
+             'description': 'Image {}'.format(i), 'status': Image.READY}
+            for i in range(images)
+        ])
+        db_session.commit()
+
+
+def run_variant(variant, data_dir):
+    """ Measure startup in current process and print results as JSON """
+    start = time.perf_counter()
+    from chgallery import create_app
+    result = {'import': time.perf_counter() - start}
+
+    start = time.perf_counter()
+    app = create_app(get_config(data_dir, variant))
+    result['create_app'] = time.perf_counter() - start
+    result['modules'] = len(sys.modules)
+
+    from werkzeug.test import create_environ
+
+    def start_response(status, headers, exc_info=None):
+        assert status.startswith('200'), status
+
+    for name, path in REQUESTS:
+        start = time.perf_counter()
+        response = app(create_environ(path), start_response)
+        for chunk in response:
+            pass
+        if hasattr(response, 'close'):
+            response.close()
+        result[name] = time.perf_counter() - start
+
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Number of processes started for every variant.')
+    parser.add_argument('--images', type=int, default=30, help='Number of images in database.')
+    parser.add_argument('--variant', choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.data)
+        return
+
+    results = {variant: [] for variant in VARIANTS}
+    with tempfile.TemporaryDirectory() as data_dir:
+        prepare(data_dir, args.images)
+
+        for i in range(args.repeat):
+            for variant in VARIANTS:
+                # Warm variant runs after cold one, which fills the cache
+                if variant == 'cold':
+                    shutil.rmtree(os.path.join(data_dir, 'jinja-cache'), ignore_errors=True)
+                output = subprocess.check_output([
+                    sys.executable, '-m', 'benchmarks.startup', '--variant', variant, '--data', data_dir,
+                ])
+                results[variant].append(json.loads(output))
+
+    print('Median of {} process(es), times in ms'.format(args.repeat))
+    print(('{:<10}' + '{:>20}' * (len(METRICS) + 1)).format('variant', *METRICS + ('modules',)))
+    for variant in VARIANTS:
+        print(('{:<10}' + '{:>20.1f}' * len(METRICS) + '{:>20}').format(
+            variant,
+            *(statistics.median(result[name] for result in results[variant]) * 1000 for name in METRICS),
+            results[variant][0]['modules'],
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""
+Micro-benchmarks of image and database hot paths, compared with stored
+baseline. Runs offline on synthetic images and database seeded with
+given number of images::
+
+    $ python -m benchmarks.suite --save-baseline     # on reference revision
+    $ python -m benchmarks.suite                     # after changes
+
+Every benchmark runs in separate process to measure it's own peak RSS.
+Benchmarks slower (mean latency) or using more memory than baseline by
+more than `--threshold` are reported as regressions and the command
+exits with status 1. Baseline is specific to the machine it was
+created on, so it's not stored in repository.
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from werkzeug.test import create_environ
+
+from benchmarks.decode import peak_rss
+from chgallery import create_app
+from chgallery.db import get_db_session, init_db
+from chgallery.db.declarative import Image as ImageModel, User
+from chgallery.image import get_unique_filename
+from chgallery.image.storage import get_path
+from chgallery.image.utils import is_allowed_image_file, smart_resize
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+FORMATS = {'jpeg': 'JPEG', 'png': 'PNG', 'gif': 'GIF'}
+SIZES = ((640, 480), (3000, 2000))
+
+# Uploaded names colliding with `image.jpg`, checked by `get_unique_filename`
+COLLIDING_NAMES = 20
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Register benchmark. Decorated function gets directory with prepared
+    data and returns function which time is measured.
+    """
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+def create_image(path, size, img_format):
+    """ Synthetic photo-like image, gradient with some noise """
+    width, height = size
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 64)
+    img = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    if img_format == 'GIF':
+        img = img.convert('P')
+    img.save(path, img_format)
+
+
+def get_image_path(data_dir, size, ext):
+    return os.path.join(data_dir, 'images', '{}x{}.{}'.format(size[0], size[1], ext))
+
+
+def create_benchmark_app(data_dir):
+    return create_app({
+        'DATABASE': 'sqlite:///{}'.format(os.path.join(data_dir, 'benchmark.sqlite')),
+        'UPLOAD_PATH': os.path.join(data_dir, 'uploads'),
+        'TEMPLATE_BYTECODE_CACHE_DIR': os.path.join(data_dir, 'jinja-cache'),
+        # Files are sent by the view, not by `UploadsMiddleware`
+        'UPLOAD_STATIC_APP': False,
+        'WTF_CSRF_ENABLED': False,
+    })
+
+
+def prepare(data_dir, images):
+    """
+    Create synthetic images and database with `images` entries.
+    """
+    os.makedirs(os.path.join(data_dir, 'images'))
+    for size in SIZES:
+        for ext, img_format in FORMATS.items():
+            create_image(get_image_path(data_dir, size, ext), size, img_format)
+
+    app = create_benchmark_app(data_dir)
+    with app.app_context():
+        init_db()
+        db_session = get_db_session()
+        user = User(username='test', password=generate_password_hash('test'), email='test@example.com')
+        db_session.add(user)
+        db_session.flush()
+
+        names = ['image.jpg'] + ['image({}).jpg'.format(i) for i in range(1, COLLIDING_NAMES + 1)]
+        names.extend('picture-{}.jpg'.format(i) for i in range(max(images - len(names), 0)))
+        db_session.execute(insert(ImageModel), [
+            {'name': name, 'width': 2000, 'height': 1333, 'author_id': user.id, 'description': name}
+            for name in names
+        ])
+        db_session.commit()
+
+    create_image(get_path(app.config['UPLOAD_PATH'], 'image.jpg', 'thumbs'), (250, 166), 'JPEG')
+
+
+def _register_image_benchmarks():
+    for size in SIZES:
+        for ext in FORMATS:
+            suffix = '[{}-{}x{}]'.format(ext, size[0], size[1])
+
+            def setup_resize(data_dir, size=size, ext=ext):
+                with open(get_image_path(data_dir, size, ext), 'rb') as fp:
+                    data = fp.read()
+                return lambda: smart_resize(Image.open(io.BytesIO(data)), 250)
+
+            def setup_validation(data_dir, size=size, ext=ext):
+                with open(get_image_path(data_dir, size, ext), 'rb') as fp:
+                    data = fp.read()
+                return lambda: is_allowed_image_file(io.BytesIO(data))
+
+            benchmark('smart_resize' + suffix)(setup_resize)
+            benchmark('is_allowed_image_file' + suffix)(setup_validation)
+
+
+_register_image_benchmarks()
+
+
+@benchmark('get_unique_filename')
+def setup_unique_filename(data_dir):
+    app = create_benchmark_app(data_dir)
+    app.app_context().push()
+
+    def run():
+        assert get_unique_filename('image.jpg') == 'image({}).jpg'.format(COLLIDING_NAMES + 1)
+        get_db_session().close()
+    return run
+
+
+def _setup_request(data_dir, path):
+    app = create_benchmark_app(data_dir)
+    environ = create_environ(path)
+
+    def start_response(status, headers, exc_info=None):
+        assert status.startswith('200'), status
+
+    def run():
+        response = app(environ.copy(), start_response)
+        for chunk in response:
+            pass
+        if hasattr(response, 'close'):
+            response.close()
+    return run
+
+
+@benchmark('display_uploaded_file')
+def setup_display_uploaded_file(data_dir):
+    return _setup_request(data_dir, '/image/uploads/thumbs/image.jpg')
+
+
+@benchmark('index')
+def setup_index(data_dir):
+    return _setup_request(data_dir, '/')
+
+
+def run_benchmark(name, data_dir, min_time, min_runs):
+    """ Run single benchmark in current process and print results as JSON """
+    func = BENCHMARKS[name](data_dir)
+    func()  # warm up
+
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < min_runs or time.perf_counter() - start < min_time:
+        run_start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - run_start)
+
+    timings.sort()
+    print(json.dumps({
+        'runs': len(timings),
+        'mean': sum(timings) / len(timings),
+        'p95': timings[min(int(len(timings) * 0.95), len(timings) - 1)],
+        'maxrss': peak_rss(),
+    }))
+
+
+def compare(result, baseline, threshold):
+    """
+    Returns descriptions of regressions of single benchmark.
+
+    :param dict result: measured values
+    :param dict baseline: values stored in baseline, or None
+    :param float threshold: allowed relative increase, e.g. 0.2
+    :rtype list:
+    """
+    if baseline is None:
+        return []
+    return [
+        '{} +{:.0%}'.format(key, result[key] / baseline[key] - 1)
+        for key in ('mean', 'maxrss')
+        if baseline.get(key) and result[key] > baseline[key] * (1 + threshold)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=10000, help='Number of images in database.')
+    parser.add_argument('--min-time', type=float, default=1.0, help='Minimum time of every benchmark in seconds.')
+    parser.add_argument('--min-runs', type=int, default=5)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='Store results as new baseline.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown, e.g. 0.2 for 20%%.')
+    parser.add_argument('--only', help='Run only benchmarks which names contain this text.')
+    parser.add_argument('--run', choices=BENCHMARKS, help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_benchmark(args.run, args.data, args.min_time, args.min_runs)
+        return
+
+    try:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+    except FileNotFoundError:
+        baseline = {}
+
+    names = [name for name in BENCHMARKS if not args.only or args.only in name]
+    results = {}
+    regressions = 0
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        prepare(data_dir, args.images)
+        print('{} images in database, threshold {:.0%}'.format(args.images, args.threshold))
+        print('{:<36}{:>8}{:>12}{:>12}{:>12}{:>10}  {}'.format(
+            'benchmark', 'runs', 'ops/s', 'mean [ms]', 'p95 [ms]', 'RSS [MB]', 'baseline'
+        ))
+
+        for name in names:
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.suite', '--run', name, '--data', data_dir,
+                '--min-time', str(args.min_time), '--min-runs', str(args.min_runs),
+            ])
+            result = results[name] = json.loads(output)
+
+            if name not in baseline:
+                status = 'new'
+            else:
+                problems = compare(result, baseline[name], args.threshold)
+                regressions += bool(problems)
+                status = 'REGRESSION ' + ', '.join(problems) if problems else '{:+.0%}'.format(
+                    result['mean'] / baseline[name]['mean'] - 1
+                )
+            print('{:<36}{:>8}{:>12.1f}{:>12.3f}{:>12.3f}{:>10.1f}  {}'.format(
+                name, result['runs'], 1 / result['mean'], result['mean'] * 1000, result['p95'] * 1000,
+                result['maxrss'] / 1024, status,
+            ))
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+    elif regressions:
+        print('{} regression(s) found'.format(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
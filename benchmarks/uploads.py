@@ -0,0 +1,80 @@
+"""
+Compares time of sending a thumbnail through the whole Flask application
+and through `UploadsMiddleware`, with and without logged in user::
+
+    $ python -m benchmarks.uploads --requests 2000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from PIL import Image
+from werkzeug.security import generate_password_hash
+from werkzeug.test import create_environ
+
+from chgallery import create_app
+from chgallery.db import get_db_session, init_db
+from chgallery.db.declarative import User
+from chgallery.image.storage import get_path
+
+
+def create_benchmark_app(tmp, static_app):
+    app = create_app({
+        'DATABASE': 'sqlite:///{}'.format(os.path.join(tmp, 'benchmark.sqlite')),
+        'UPLOAD_PATH': os.path.join(tmp, 'uploads'),
+        'TEMPLATE_BYTECODE_CACHE_DIR': os.path.join(tmp, 'jinja-cache'),
+        'UPLOAD_STATIC_APP': static_app,
+        'WTF_CSRF_ENABLED': False,
+    })
+    with app.app_context():
+        init_db()
+        db_session = get_db_session()
+        db_session.add(User(username='test', password=generate_password_hash('test'), email='test@example.com'))
+        db_session.commit()
+    thumbnail_path = get_path(os.path.join(tmp, 'uploads'), 'image.jpg', 'thumbs', sharded=False)
+    Image.new('RGB', (250, 166), 'red').save(thumbnail_path, 'JPEG')
+    return app
+
+
+def start_response(status, headers, exc_info=None):
+    assert status.startswith('200'), status
+
+
+def run(app, requests, login):
+    """ Average time of single request, called directly on WSGI application """
+    headers = {}
+    if login:
+        client = app.test_client()
+        client.post('/auth/login', data={'username': 'test', 'password': 'test'})
+        headers['Cookie'] = 'session={}'.format(client.get_cookie('session').value)
+    environ = create_environ('/image/uploads/thumbs/image.jpg', headers=headers)
+
+    start = time.perf_counter()
+    for i in range(requests):
+        response = app(environ.copy(), start_response)
+        for chunk in response:
+            pass
+        if hasattr(response, 'close'):
+            response.close()
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    print('{:<10}{:<8}{:>16}'.format('handler', 'user', 'per request [us]'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for static_app in (False, True):
+            app = create_benchmark_app(os.path.join(tmp, str(static_app)), static_app)
+            for login in (False, True):
+                result = run(app, args.requests, login)
+                print('{:<10}{:<8}{:>16.1f}'.format(
+                    'static' if static_app else 'flask', 'yes' if login else 'no', result * 1e6,
+                ))
+
+
+if __name__ == '__main__':
+    main()
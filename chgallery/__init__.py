@@ -1,18 +1,80 @@
 import os
-from flask import Flask, render_template
+from flask import Flask, jsonify, render_template, request, url_for
+from sqlalchemy.orm import load_only
 
 from chgallery.db import get_db_session
 from chgallery.db.declarative import Image
-from chgallery.middleware import PrefixMiddleware
+from chgallery.db.pagination import keyset_page
+from chgallery.image.streaming import UploadRequest
+from chgallery.middleware import PrefixMiddleware, SamplingProfilerMiddleware, TimingMiddleware, UploadsMiddleware
+from chgallery.pagecache import cached_page
 
 
 def create_app(test_config=None):
     # Create and configure the app
     app = Flask(__name__, instance_relative_config=True)
+    app.request_class = UploadRequest
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE='sqlite:///{}'.format(os.path.join(app.instance_path, 'chgallery.sqlite')),
+        DATABASE_POOL_SIZE=None,
+        DATABASE_MAX_OVERFLOW=None,
+        DATABASE_POOL_RECYCLE=-1,
+        DATABASE_POOL_PRE_PING=False,
+        DATABASE_REPLICAS=(),
+        DATABASE_REPLICA_LAG=5,
+        DATABASE_SQLITE_PRAGMAS={
+            'busy_timeout': 5000,
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'cache_size': -16000,
+            'mmap_size': 64 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+        },
+        MAX_CONTENT_LENGTH=32 * 1024 * 1024,
         UPLOAD_PATH=os.path.join(app.instance_path, 'uploads'),
+        UPLOAD_ACCEL_REDIRECT=None,
+        UPLOAD_STATIC_APP=True,
+        UPLOAD_SHARDING=True,
+        IMAGE_MAX_SIZE=2000,
+        IMAGE_MAX_PIXELS=50 * 1000 * 1000,
+        IMAGE_UPSCALE=False,
+        IMAGE_RESAMPLE='lanczos',
+        THUMBNAIL_RESAMPLE='bilinear',
+        IMAGE_SIZES={'thumbs': 250, 'previews': 100},
+        IMAGE_EAGER_SIZES=('thumbs', 'previews'),
+        IMAGE_CACHE_MAX_BYTES=512 * 1024 * 1024,
+        IMAGE_MEMORY_CACHE_BYTES=0,
+        IMAGE_MEMORY_CACHE_MAX_ITEM_BYTES=64 * 1024,
+        IMAGE_VARIANTS=(),
+        IMAGE_SAVE_OPTIONS={
+            'JPEG': {'quality': 85, 'optimize': True, 'progressive': True},
+            'PNG': {'optimize': True},
+            'GIF': {'optimize': True},
+            'WEBP': {'quality': 80, 'method': 4},
+            'AVIF': {'quality': 60, 'speed': 6},
+        },
+        IMAGE_STRIP_METADATA=True,
+        IMAGE_DEDUPLICATE=True,
+        DERIVATIVES_WORKER='inline',
+        DERIVATIVES_POOL_SIZE=2,
+        DERIVATIVES_CLAIM_TIMEOUT=600,
+        ROOT_URL_PREFIX='',
+        GALLERY_PAGE_SIZE=30,
+        PAGE_CACHE=None,
+        PAGE_CACHE_DIR=None,
+        PAGE_CACHE_TTL=10,
+        USER_CACHE_TTL=10,
+        SERVER_TIMING=False,
+        METRICS=False,
+        METRICS_DIR=None,
+        PROFILER=False,
+        PROFILER_SAMPLE_RATE=0.0,
+        PROFILER_DIR=None,
+        PROFILER_MAX_BYTES=100 * 1024 * 1024,
+        PROFILER_TOKEN_MAX_AGE=3600,
+        TEMPLATE_BYTECODE_CACHE=True,
+        TEMPLATE_BYTECODE_CACHE_DIR=None,
     )
 
     if test_config is None:
@@ -22,28 +84,58 @@ def create_app(test_config=None):
         # Load the test config if passed in
         app.config.from_mapping(test_config)
 
-    # ensure the instance config exists
-    try:
-        os.makedirs(app.instance_path)
-    except OSError:
-        pass
+    # Instance folder and `UPLOAD_PATH` are not created here, so worker
+    # startup doesn't touch the file system. Every directory is created
+    # by the code writing to it, when it's missing.
 
-    # create directory for uploaded file if doesn't exist
-    try:
-        os.makedirs(os.path.join(app.config['UPLOAD_PATH'], 'thumbs'))
-        os.makedirs(os.path.join(app.config['UPLOAD_PATH'], 'previews'))
-    except OSError:
-        pass
+    # Uploaded files are sent without going through the whole application
+    app.wsgi_app = UploadsMiddleware(app.wsgi_app, app)  # type: ignore
 
     # In case that application is mounted outside of the server root,
     # e.g. /admin we can set this common prefix here for all url rules.
     app.wsgi_app = PrefixMiddleware(app.wsgi_app, prefix=app.config["ROOT_URL_PREFIX"])  # type: ignore
 
+    # Profile chosen requests, when enabled
+    app.wsgi_app = SamplingProfilerMiddleware(app.wsgi_app, app)  # type: ignore
+
+    # Measure time of whole request, including other middleware
+    app.wsgi_app = TimingMiddleware(app.wsgi_app, app)  # type: ignore
+
+    def get_gallery_page():
+        # Fetch only columns required to display image in gallery
+        query = get_db_session().query(Image).options(
+            load_only(Image.id, Image.name, Image.width, Image.height, Image.description, Image.status)
+        )
+        return keyset_page(
+            query,
+            Image.id,
+            after=request.args.get('after', type=int),
+            limit=app.config['GALLERY_PAGE_SIZE'],
+        )
+
     # basic view for non-registered users
     @app.route('/')
+    @cached_page
     def index():
-        images = get_db_session().query(Image).order_by(Image.id).all()
-        return render_template('index.html', images=images)
+        images, next_key = get_gallery_page()
+        return render_template('index.html', images=images, next_key=next_key)
+
+    # next gallery page for front-end script loading images while user scrolls
+    @app.route('/page.json')
+    @cached_page
+    def gallery_page():
+        images, next_key = get_gallery_page()
+        return jsonify(
+            images=[{
+                'url': image.url(),
+                'thumbnail_url': image.thumbnail_url(),
+                'width': image.width,
+                'height': image.height,
+                'description': image.description,
+                'ready': image.is_ready,
+            } for image in images],
+            next=url_for('gallery_page', after=next_key) if next_key is not None else None,
+        )
 
     from chgallery.db import init_app
     init_app(app)
@@ -54,4 +146,22 @@ def create_app(test_config=None):
     from chgallery import image
     app.register_blueprint(image.bp)
 
+    from chgallery.image import derivatives
+    derivatives.init_app(app)
+
+    from chgallery.image import regenerate
+    regenerate.init_app(app)
+
+    from chgallery import metrics
+    metrics.init_app(app)
+
+    from chgallery import profiler
+    profiler.init_app(app)
+
+    from chgallery import seed
+    seed.init_app(app)
+
+    from chgallery import templating
+    templating.init_app(app)
+
     return app
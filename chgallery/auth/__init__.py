@@ -5,14 +5,15 @@ from flask import (
         g,
         redirect,
         render_template,
+        request,
         session,
         url_for
 )
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from chgallery.auth.cache import get_identity_cache, invalidate_user
 from chgallery.auth.decorators import login_required
-from chgallery.auth.forms import LoginForm, RegisterForm
 from chgallery.db import get_db_session
 from chgallery.db.declarative import Image, User
 
@@ -41,6 +42,8 @@ def register():
     if g.user:
         return redirect(url_for('auth.dashboard'))
 
+    # Forms (WTForms with email validator) are loaded on first use only
+    from chgallery.auth.forms import RegisterForm
     form = RegisterForm()
 
     if form.validate_on_submit():
@@ -65,6 +68,7 @@ def login():
     if g.user:
         return redirect(url_for('auth.dashboard'))
 
+    from chgallery.auth.forms import LoginForm
     form = LoginForm()
     error = None
 
@@ -88,17 +92,38 @@ def login():
 
 @bp.route('/logout')
 def logout():
+    user_id = session.get('user_id')
+    if user_id is not None:
+        invalidate_user(user_id)
     session.clear()
     return redirect(url_for('auth.login'))
 
 
 @bp.before_app_request
 def load_logged_in_user():
-    user_id = session.get('user_id')
     g.user = None
 
-    if user_id is not None:
-        try:
-            g.user = get_db_session().query(User).filter(User.id == user_id).one()
-        except NoResultFound:
-            session.clear()
+    view = current_app.view_functions.get(request.endpoint)
+    if request.endpoint == 'static' or getattr(view, 'skip_user_loading', False):
+        return
+
+    user_id = session.get('user_id')
+    if user_id is None:
+        return
+
+    db_session = get_db_session()
+    cache = get_identity_cache()
+    cached_user = cache.get(user_id) if cache is not None else None
+
+    if cached_user is not None:
+        g.user = db_session.merge(cached_user, load=False)
+        return
+
+    try:
+        g.user = db_session.query(User).filter(User.id == user_id).one()
+    except NoResultFound:
+        session.clear()
+        return
+
+    if cache is not None:
+        cache.set(g.user)
@@ -0,0 +1,95 @@
+"""
+Short living cache of logged in users, owned by single worker process.
+
+Users changed or deleted in current process are removed from the cache
+immediately, changes made by other processes are noticed after
+`USER_CACHE_TTL` seconds at most.
+"""
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from chgallery.db.declarative import User
+
+
+class IdentityCache:
+    """
+    Detached copies of `User` instances, kept for `ttl` seconds.
+    Cached instances are never attached to any session, use
+    `Session.merge(user, load=False)` to get an instance bound
+    to current session without querying the database.
+    """
+
+    def __init__(self, ttl, max_items=1000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        :param int user_id: primary key of the user
+        :rtype User: detached instance or None
+        """
+        entry = self._items.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, user):
+        """
+        Store detached copy of `user` loaded from the database.
+
+        :param User user: persistent instance
+        """
+        values = {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+        copy = User(**values)
+        make_transient_to_detached(copy)
+
+        with self._lock:
+            if len(self._items) >= self.max_items:
+                self._items = {}
+            self._items[user.id] = (time.monotonic() + self.ttl, copy)
+
+    def invalidate(self, user_id):
+        """
+        :param int user_id: primary key of the user
+        """
+        with self._lock:
+            self._items.pop(user_id, None)
+
+
+def get_identity_cache():
+    """
+    Returns identity cache of current application,
+    or None if it's disabled.
+    """
+    ttl = current_app.config['USER_CACHE_TTL']
+    if not ttl:
+        return None
+
+    cache = current_app.extensions.get('chgallery.identity_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault('chgallery.identity_cache', IdentityCache(ttl))
+    return cache
+
+
+def invalidate_user(user_id):
+    """
+    Remove user from identity cache of current application.
+
+    :param int user_id: primary key of the user
+    """
+    cache = get_identity_cache()
+    if cache is not None:
+        cache.invalidate(user_id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    if has_app_context():
+        invalidate_user(target.id)
@@ -9,3 +9,13 @@ def login_required(view):
             return redirect(url_for('auth.login'))
         return view(**kwargs)
     return wrapped_view
+
+
+def skip_user_loading(view):
+    """
+    Don't load logged in user before the view is called, `g.user` is
+    always None. Meant for views that don't depend on the user at all,
+    like serving uploaded files, so they don't query the database.
+    """
+    view.skip_user_loading = True
+    return view
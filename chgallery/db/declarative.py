@@ -3,6 +3,7 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String
 )
@@ -32,6 +33,18 @@ class User(Base):
 
 class Image(Base):
     __tablename__ = 'image'
+    __table_args__ = (
+        # User's images on dashboard, newest first
+        Index('ix_image_author_id_creation_date', 'author_id', 'creation_date'),
+        # Images waiting for derivatives, oldest first
+        Index('ix_image_status_id', 'status', 'id'),
+    )
+
+    # Derivative files (normalized image, thumbnail and preview) status
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    READY = 'ready'
+    FAILED = 'failed'
 
     id = Column(Integer, primary_key=True)
     name = Column(String(255), unique=True, nullable=False, index=True)
@@ -40,6 +53,11 @@ class Image(Base):
     width = Column(Integer, nullable=False)
     height = Column(Integer, nullable=False)
     author_id = Column(Integer, ForeignKey('user.id'))
+    status = Column(String(16), nullable=False, default=READY, server_default=READY)
+    # When `flask derivatives-worker` claimed the image (UTC), see `PROCESSING`
+    claimed_at = Column(DateTime)
+    # SHA-256 of uploaded file, images with the same content share files
+    digest = Column(String(64), index=True)
 
     def __str__(self):
         return str(self.name)
@@ -47,20 +65,33 @@ class Image(Base):
     def __repr__(self):
         return "<{0}: {1}>".format(self.__class__.__name__, self.name)
 
+    @property
+    def is_ready(self):
+        """ True if thumbnail and preview files were already created """
+        return self.status == self.READY
+
     def url(self):
         """ Returns URL to full sized image file """
         return url_for('image.uploaded_file', filename=self.name)
 
+    def resized_url(self, size):
+        """
+        Returns URL of image in one of sizes defined with `IMAGE_SIZES`
+        setting. Sizes other than thumbnail and preview are created
+        on first request.
+        """
+        return url_for('image.uploaded_file_resized', size=size, filename=self.name)
+
     def thumbnail_url(self):
         """
         Returns URL of thumbnail image (max size 250px)
         used for main gallery page.
         """
-        return url_for('image.uploaded_file_thumbnail', filename=self.name)
+        return self.resized_url('thumbs')
 
     def preview_url(self):
         """
         Returns URL of the smallest picture (max size 100px)
         used as preview on administration pages.
         """
-        return url_for('image.uploaded_file_preview', filename=self.name)
+        return self.resized_url('previews')
@@ -0,0 +1,81 @@
+"""
+Non-destructive schema upgrades. Existing database is compared with
+models and everything that's missing (tables, columns and indexes)
+is added in place, without touching stored data.
+
+Changes that can't be made this way (e.g. changed column types
+or removed columns) are not detected.
+"""
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from chgallery.db.declarative import Base
+
+
+class MigrationError(Exception):
+    pass
+
+
+def get_missing_schema(engine, metadata=Base.metadata):
+    """
+    Compare database with models.
+
+    :param engine: SQLAlchemy engine
+    :param metadata: metadata of models
+    :rtype tuple: lists of missing tables, columns and indexes
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    tables, columns, indexes = [], [], []
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            tables.append(table)
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        columns.extend(column for column in table.columns if column.name not in existing_columns)
+
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        indexes.extend(index for index in table.indexes if index.name not in existing_indexes)
+
+    return tables, columns, indexes
+
+
+def upgrade_db(engine, metadata=Base.metadata):
+    """
+    Add missing tables, columns and indexes to the database. New columns
+    must be nullable or have server default, so existing rows get a value.
+
+    :param engine: SQLAlchemy engine
+    :param metadata: metadata of models
+    :rtype list: descriptions of applied changes
+    """
+    tables, columns, indexes = get_missing_schema(engine, metadata)
+
+    for column in columns:
+        if not column.nullable and column.server_default is None:
+            raise MigrationError(
+                'Column {}.{} is not nullable and has no server default'.format(column.table.name, column.name)
+            )
+
+    changes = []
+    with engine.begin() as connection:
+        preparer = connection.dialect.identifier_preparer
+
+        for table in tables:
+            table.create(connection)
+            changes.append('Created table {}'.format(table.name))
+
+        for column in columns:
+            connection.exec_driver_sql('ALTER TABLE {} ADD COLUMN {}'.format(
+                preparer.format_table(column.table),
+                CreateColumn(column).compile(dialect=connection.dialect),
+            ))
+            changes.append('Added column {}.{}'.format(column.table.name, column.name))
+
+        for index in indexes:
+            index.create(connection)
+            changes.append('Created index {}'.format(index.name))
+
+    return changes
@@ -0,0 +1,27 @@
+def keyset_page(query, column, after=None, limit=30):
+    """
+    Returns single page of query results using keyset (seek) pagination.
+    Instead of OFFSET, which makes database read and skip all preceding
+    rows, next page is selected with simple condition on indexed,
+    unique `column`, so every page costs the same.
+
+    One additional row is fetched to check if there is a next page.
+
+    :param query: SQLAlchemy query object
+    :param column: unique column used for ordering, e.g. primary key
+    :param after: value of `column` for last item of previous page
+    :param int limit: number of items per page
+    :rtype tuple: list of items and key for the next page (None if this
+                  is the last page)
+    """
+    if after is not None:
+        query = query.filter(column > after)
+
+    items = query.order_by(column).limit(limit + 1).all()
+    next_key = None
+
+    if len(items) > limit:
+        items = items[:limit]
+        next_key = getattr(items[-1], column.key)
+
+    return items, next_key
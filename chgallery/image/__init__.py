@@ -1,6 +1,9 @@
+import io
 import os
+import re
+import stat
+import uuid
 
-from PIL import Image as PILImage
 from flask import (
     Blueprint,
     Response,
@@ -8,80 +11,192 @@ from flask import (
     current_app,
     flash,
     g,
-    send_from_directory,
+    jsonify,
+    send_file,
     redirect,
     render_template,
+    request,
     url_for
 )
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
 from werkzeug.utils import secure_filename
 
-from chgallery.auth.decorators import login_required
+from chgallery.auth.decorators import login_required, skip_user_loading
 from chgallery.db import get_db_session
 from chgallery.db.declarative import Image
 
-from chgallery.image.forms import UploadForm
-from chgallery.image.utils import smart_resize
+from chgallery.image.cache import ByteCache, SizeLimit, touch
+from chgallery.image.derivatives import (
+    CACHE_DIRNAME,
+    VARIANTS,
+    generate_derivatives,
+    get_options,
+    get_size_dirname,
+    link_derivatives,
+    remove_files,
+    render_size,
+    schedule_derivatives
+)
+from chgallery.image.storage import find_file, get_path, save_stream
+from chgallery.image.streaming import UploadStream, streaming_upload
+from chgallery.image.utils import get_resized_size, guess_image_mimetype
+from chgallery.locks import file_lock
+from chgallery.metrics import measure
+from chgallery.pagecache import bump_gallery_version
 
 
 bp = Blueprint('image', __name__, url_prefix='/image')
 
+# How many times upload tries to find free name when it's taken concurrently
+UNIQUE_FILENAME_ATTEMPTS = 5
+
 
 def get_unique_filename(filename):
     """
     Create unique filename using given name to ensure that
     it's not already present in database. This method simply
-    adds a counter to original filename.
+    adds a counter to original filename. All names that may
+    collide are fetched with single query. Names with counter are
+    selected with range condition instead of LIKE, so the index
+    on name column may be used.
+
+    Note that name may be taken by concurrent request before
+    it's saved, so unique constraint error must be handled anyway.
 
     :param str filename:
     :rtype str:
     """
     filename = secure_filename(filename)
-    final_name = filename
+    fname, ext = os.path.splitext(filename)
+    pattern = re.compile(r'^{}\((\d+)\){}$'.format(re.escape(fname), re.escape(ext)))
+
+    taken = set()
+    names = get_db_session().query(Image.name).filter(or_(
+        Image.name == filename,
+        and_(Image.name > '{}('.format(fname), Image.name < '{})'.format(fname)),
+    ))
+
+    for name, in names:
+        if name == filename:
+            taken.add(0)
+            continue
+        match = pattern.match(name)
+        if match is not None:
+            taken.add(int(match.group(1)))
+
+    counter = 0
+    while counter in taken:
+        counter += 1
+
+    if counter == 0:
+        return filename
+    return '{}({}){}'.format(fname, counter, ext)
+
+
+def save_with_unique_filename(image, filename):
+    """
+    Store new image in database under unique name. When the name was
+    taken by another process in the meantime, new one is chosen.
+
+    :param image: new Image instance
+    :param str filename: name of uploaded file
+    """
     db_session = get_db_session()
-    success = False
-    retries = 0
 
-    while not success:
+    for attempt in range(UNIQUE_FILENAME_ATTEMPTS):
+        image.name = get_unique_filename(filename)
+        db_session.add(image)
         try:
-            db_session.query(Image).filter(Image.name == final_name).one()
-            retries += 1
-            fname, ext = os.path.splitext(filename)
-            final_name = '{}({}){}'.format(fname, retries, ext)
-        except NoResultFound:
-            success = True
+            db_session.commit()
+            return
+        except IntegrityError:
+            db_session.rollback()
+            if attempt == UNIQUE_FILENAME_ATTEMPTS - 1:
+                raise
 
-    return final_name
+
+def find_duplicate(digest):
+    """
+    Returns already processed image with the same content.
+
+    :param str digest: SHA-256 of uploaded file
+    :rtype Image: or None
+    """
+    return (
+        get_db_session().query(Image)
+        .filter(Image.digest == digest, Image.status == Image.READY)
+        .order_by(Image.id)
+        .first()
+    )
 
 
 @bp.route('/upload', methods=('GET', 'POST'))
 @login_required
+@streaming_upload
 def upload():
+    # Forms (WTForms) are loaded on first use only
+    from chgallery.image.forms import UploadForm
     form = UploadForm()
 
     if form.validate_on_submit():
         image = Image(
-            name=get_unique_filename(form.image.data.filename),
             description=form.description.data,
             author_id=g.user.id,
+            status=Image.PENDING,
+        )
+
+        # Size of normalized image is known from file header, image
+        # data is decoded only once, when derivatives are created.
+        img = form.image.pil_image
+        image.width, image.height = get_resized_size(
+            img.size, current_app.config['IMAGE_MAX_SIZE'], current_app.config['IMAGE_UPSCALE']
         )
 
-        # Create normalized image and thumbnail
-        img = PILImage.open(form.image.data)
-        img = smart_resize(img)
+        # Original is already stored in temporary file, if it was streamed
+        upload_path = current_app.config['UPLOAD_PATH']
+        stream = form.image.data.stream
+        if isinstance(stream, UploadStream):
+            tmp_path = stream.path
+            image.digest = stream.hexdigest()
+        else:
+            # Upload directory is created with first stored file
+            os.makedirs(upload_path, exist_ok=True)
+            tmp_path = os.path.join(upload_path, '.upload-{}.tmp'.format(uuid.uuid4().hex))
+            form.image.data.seek(0)
+            image.digest = save_stream(stream, tmp_path)
+
+        duplicate = find_duplicate(image.digest) if current_app.config['IMAGE_DEDUPLICATE'] else None
+        if duplicate is not None:
+            image.status = Image.READY
+            image.width, image.height = duplicate.width, duplicate.height
 
         # Create new entry in database
-        image.width, image.height = img.size
-        db_session = get_db_session()
-        db_session.add(image)
-        db_session.commit()
-
-        # Save both images - resized version and thumbnail
-        img.save(os.path.join(current_app.config['UPLOAD_PATH'], image.name), img.format)
-        img.thumbnail((250, 250))
-        img.save(os.path.join(current_app.config['UPLOAD_PATH'], 'thumbs', image.name), img.format)
-        img.thumbnail((100, 100))
-        img.save(os.path.join(current_app.config['UPLOAD_PATH'], 'previews', image.name), img.format)
+        try:
+            save_with_unique_filename(image, form.image.data.filename)
+        except Exception:
+            os.unlink(tmp_path)
+            img.close()
+            raise
+
+        options = get_options(current_app.config)
+        if duplicate is not None and link_derivatives(upload_path, duplicate.name, image.name, options):
+            os.unlink(tmp_path)
+            img.close()
+        else:
+            if duplicate is not None:
+                image.status = Image.PENDING
+                get_db_session().commit()
+
+            # Save original file, thumbnail and preview are created later
+            os.replace(tmp_path, get_path(upload_path, image.name, sharded=options['sharded']))
+            schedule_derivatives(image, img)
+            # Image is used only by inline worker, others open the stored file
+            img.close()
+
+        bump_gallery_version()
 
         flash('Image uploaded successfully', 'success')
         return redirect(url_for('auth.dashboard'))
@@ -89,6 +204,20 @@ def upload():
     return render_template('image/upload.html', form=form)
 
 
+@bp.errorhandler(RequestEntityTooLarge)
+@bp.errorhandler(UnsupportedMediaType)
+def upload_rejected(error):
+    """ Show the reason of rejecting streamed upload in the form """
+    if request.endpoint != 'image.upload':
+        return error
+
+    # Request body is not parsed completely, so it can't be used
+    from chgallery.image.forms import UploadForm
+    form = UploadForm(formdata=None)
+    form.image.errors = [error.description]
+    return render_template('image/upload.html', form=form), error.code
+
+
 @bp.route('/delete/<int:image_id>', methods=('POST',))
 @login_required
 def delete(image_id):
@@ -103,38 +232,245 @@ def delete(image_id):
         abort(403)
 
     # Remove files associated with Image object instance
-    os.unlink(os.path.join(current_app.config['UPLOAD_PATH'], obj.name))
-    os.unlink(os.path.join(current_app.config['UPLOAD_PATH'], 'thumbs', obj.name))
-    os.unlink(os.path.join(current_app.config['UPLOAD_PATH'], 'previews', obj.name))
+    removed = remove_files(
+        current_app.config['UPLOAD_PATH'],
+        obj.name,
+        [get_size_dirname(current_app.config, size) for size in current_app.config['IMAGE_SIZES']],
+    )
+    cache = get_memory_cache()
+    if cache is not None:
+        for path in removed:
+            cache.invalidate(path)
 
     # Remove Image instance from database
     db_session.delete(obj)
     db_session.commit()
+    bump_gallery_version()
 
     flash('Object removed', 'info')
     return redirect(url_for('auth.dashboard'))
 
 
-def display_uploaded_file(filename, dirname=None):
-    path = current_app.config['UPLOAD_PATH']
-    if dirname is not None:
-        path = os.path.join(path, dirname)
-    with open(os.path.join(path, filename), 'rb') as fp:
-        contents = fp.read()
-    # TODO: Mime types
-    return Response(contents, content_type='image/jpeg')
+def get_memory_cache():
+    """
+    Returns in-memory cache of small image files owned by current
+    process, or None if it's disabled.
+
+    :rtype ByteCache:
+    """
+    if not current_app.config['IMAGE_MEMORY_CACHE_BYTES']:
+        return None
+
+    cache = current_app.extensions.get('chgallery.image_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault('chgallery.image_cache', ByteCache(
+            current_app.config['IMAGE_MEMORY_CACHE_BYTES'],
+            current_app.config['IMAGE_MEMORY_CACHE_MAX_ITEM_BYTES'],
+        ))
+    return cache
+
+
+def display_uploaded_file(filename, dirname=None, mimetype=None, memory_cache=False):
+    """
+    Sends uploaded file without reading it into memory. File is streamed
+    with `wsgi.file_wrapper` (or offloaded to the server with X-Sendfile
+    when `USE_X_SENDFILE` is enabled), response carries ETag and
+    Last-Modified headers and conditional and range requests are handled.
+
+    When `UPLOAD_ACCEL_REDIRECT` is set only `X-Accel-Redirect` header
+    pointing to internal Nginx location is sent.
+
+    :param str filename: name of uploaded file
+    :param str dirname: optional subdirectory of `UPLOAD_PATH`
+    :param str mimetype: mime type of the file, guessed if not given
+    :param bool memory_cache: send the file from in-memory cache if enabled
+    :rtype flask.Response:
+    """
+    upload_path = current_app.config['UPLOAD_PATH']
+    filepath = find_file(upload_path, filename, dirname)
+    if filepath is None:
+        abort(404)
+
+    try:
+        stat_result = os.stat(filepath)
+    except OSError:
+        abort(404)
+    if not stat.S_ISREG(stat_result.st_mode):
+        abort(404)
+
+    accel_prefix = current_app.config['UPLOAD_ACCEL_REDIRECT']
+    if accel_prefix:
+        location = '{}/{}'.format(
+            accel_prefix.rstrip('/'), os.path.relpath(filepath, upload_path).replace(os.sep, '/')
+        )
+        response = Response(content_type=mimetype or guess_image_mimetype(filepath))
+        response.headers['X-Accel-Redirect'] = location
+        return response
+
+    cache = get_memory_cache() if memory_cache and not current_app.config['USE_X_SENDFILE'] else None
+    if cache is not None:
+        entry = cache.get(filepath, stat_result)
+        if entry is None:
+            entry = cache.load(filepath, stat_result, mimetype or guess_image_mimetype(filepath))
+        if entry is not None:
+            return send_file(
+                io.BytesIO(entry.data),
+                mimetype=entry.mimetype,
+                etag=entry.etag,
+                last_modified=entry.mtime,
+                conditional=True,
+            )
+
+    return send_file(filepath, mimetype=mimetype or guess_image_mimetype(filepath), conditional=True)
+
+
+def display_derivative(filename, dirname):
+    """
+    Sends thumbnail or preview in the smallest of available formats
+    accepted by client. Only formats listed explicitly in `Accept`
+    header are taken into account, as many browsers send wildcards.
+
+    :param str filename: name of uploaded file
+    :param str dirname: subdirectory of `UPLOAD_PATH`, e.g. 'thumbs'
+    :rtype flask.Response:
+    """
+    variants = current_app.config['IMAGE_VARIANTS']
+    if not variants:
+        return display_uploaded_file(filename, dirname, memory_cache=True)
+
+    accepted = {value for value, quality in request.accept_mimetypes if quality > 0}
+    candidates = [(dirname, None)] + [
+        ('{}/{}'.format(dirname, variant), VARIANTS[variant][1])
+        for variant in variants if VARIANTS[variant][1] in accepted
+    ]
+
+    best = candidates[0]
+    best_size = None
+    for candidate in candidates:
+        filepath = find_file(current_app.config['UPLOAD_PATH'], filename, candidate[0])
+        if filepath is None:
+            continue
+        try:
+            size = os.stat(filepath).st_size
+        except OSError:
+            continue
+        if best_size is None or size < best_size:
+            best, best_size = candidate, size
+
+    response = display_uploaded_file(filename, *best, memory_cache=True)
+    response.vary.add('Accept')
+    return response
+
+
+@bp.route('/cache-stats')
+@login_required
+def cache_stats():
+    """ Counters of in-memory cache of worker process handling this request """
+    cache = get_memory_cache()
+    return jsonify(pid=os.getpid(), cache=cache.stats() if cache is not None else None)
 
 
 @bp.route('/uploads/<filename>')
+@skip_user_loading
 def uploaded_file(filename):
     return display_uploaded_file(filename)
 
 
-@bp.route('/uploads/thumbs/<filename>')
-def uploaded_file_thumbnail(filename):
-    return display_uploaded_file(filename, 'thumbs')
+def get_size_limit():
+    """
+    Returns size limit of on-demand rendered derivatives cache,
+    owned by current process.
 
+    :rtype SizeLimit:
+    """
+    limit = current_app.extensions.get('chgallery.size_limit')
+    if limit is None:
+        limit = current_app.extensions.setdefault('chgallery.size_limit', SizeLimit(
+            os.path.join(current_app.config['UPLOAD_PATH'], CACHE_DIRNAME)
+        ))
+    return limit
 
-@bp.route('/uploads/previews/<filename>')
-def uploaded_file_preview(filename):
-    return display_uploaded_file(filename, 'previews')
+
+def add_to_cache_size(filename, dirname, options):
+    """
+    Account derivative rendered to the cache, removing least recently
+    used files when the cache gets too big.
+
+    :param str filename: name of uploaded file
+    :param str dirname: directory of derivative, relative to `UPLOAD_PATH`
+    :param dict options: image processing settings, see `get_options`
+    """
+    config = current_app.config
+    try:
+        size = os.path.getsize(get_path(config['UPLOAD_PATH'], filename, dirname, options['sharded']))
+    except OSError:
+        size = 0
+    # Variants are about the same size as the rendered file
+    get_size_limit().add(size * (1 + len(options['variants'])), config['IMAGE_CACHE_MAX_BYTES'])
+
+
+def is_ready(filename):
+    """
+    Checks if derivatives of uploaded image may be created, i.e. it's
+    normalized and no worker is processing it.
+
+    :param str filename: name of uploaded file
+    :rtype bool:
+    """
+    status = get_db_session().query(Image.status).filter(Image.name == filename).scalar()
+    return status == Image.READY
+
+
+def get_resized_file(filename, size):
+    """
+    Make sure that derivative of given size exists, rendering it if
+    necessary. Missing eager sizes are created again together with
+    normalized image, exactly as after upload, other sizes are rendered
+    from already normalized image. Derivatives of images which are not
+    processed yet are never rendered here. Concurrent requests for the
+    same file wait for the first one instead of rendering it again.
+
+    :param str filename: name of uploaded file
+    :param str size: one of `IMAGE_SIZES` keys
+    :rtype str: directory of derivative, relative to `UPLOAD_PATH`
+    """
+    config = current_app.config
+    upload_path = config['UPLOAD_PATH']
+    dirname = get_size_dirname(config, size)
+    cached = dirname != size
+
+    path = find_file(upload_path, filename, dirname)
+    if path is not None:
+        if cached:
+            try:
+                touch(path, os.stat(path))
+            except FileNotFoundError:
+                pass
+        return dirname
+
+    if find_file(upload_path, filename) is None or not is_ready(filename):
+        abort(404)
+
+    options = get_options(config)
+    lock_dir = os.path.join(upload_path, CACHE_DIRNAME, '.locks')
+    with file_lock(lock_dir, '{}/{}'.format(dirname, filename)):
+        path = find_file(upload_path, filename, dirname)
+        if path is None:
+            with measure('image'):
+                if cached:
+                    render_size(upload_path, filename, dirname, config['IMAGE_SIZES'][size], options)
+                else:
+                    generate_derivatives(upload_path, filename, options=options)
+
+    if cached and path is None:
+        add_to_cache_size(filename, dirname, options)
+
+    return dirname
+
+
+@bp.route('/uploads/<size>/<filename>')
+@skip_user_loading
+def uploaded_file_resized(size, filename):
+    if size not in current_app.config['IMAGE_SIZES']:
+        abort(404)
+    return display_derivative(filename, get_resized_file(filename, size))
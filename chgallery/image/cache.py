@@ -0,0 +1,236 @@
+"""
+Caching of image derivatives: files rendered on demand are kept
+on disk and small, frequently requested files may be kept in memory.
+"""
+import collections
+import os
+import threading
+import time
+import zlib
+
+# Access time of cached files is updated at most this often (in seconds),
+# it's precise enough to find least recently used ones.
+TOUCH_INTERVAL = 60
+
+# Cache directory is scanned at least this often (in seconds), as other
+# processes add files to it too.
+SCAN_INTERVAL = 60
+
+
+def touch(path, stat_result):
+    """
+    Mark cached file as recently used. Only access time is updated,
+    as modification time is used for ETag and Last-Modified headers.
+    Files used less than `TOUCH_INTERVAL` seconds ago are skipped.
+
+    :param str path: cached file
+    :param stat_result: result of `os.stat` for the file
+    """
+    now = time.time_ns()
+    if now - stat_result.st_atime_ns < TOUCH_INTERVAL * 10 ** 9:
+        return
+    try:
+        os.utime(path, ns=(now, stat_result.st_mtime_ns))
+    except OSError:
+        pass
+
+
+def scan_files(directory):
+    """
+    Lists files in `directory` with their access time and size. Hidden
+    files and directories (locks, files being written) are skipped.
+
+    :param str directory: cache directory
+    :rtype list: tuples of access time, size and path
+    """
+    files = []
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat_result.st_atime, stat_result.st_size, path))
+    return files
+
+
+def evict(files, total, max_bytes):
+    """
+    Remove least recently used of given files until their total size
+    is not bigger than `max_bytes`.
+
+    :param list files: tuples of access time, size and path
+    :param int total: total size of the files
+    :param int max_bytes: maximum size of the cache
+    :rtype tuple: number of removed files and size of remaining ones
+    """
+    removed = 0
+    for atime, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        total -= size
+        removed += 1
+    return removed, total
+
+
+class SizeLimit:
+    """
+    Keeps size of cache directory under the limit without scanning it
+    on every write. Size of the directory is estimated from the last scan
+    and files written by current process since then. The directory is
+    scanned again (and least recently used files removed) only when the
+    estimate goes over the limit or the last scan is older than
+    `SCAN_INTERVAL`. Owned by single worker process.
+    """
+
+    def __init__(self, directory, scan_interval=SCAN_INTERVAL):
+        self.directory = directory
+        self.scan_interval = scan_interval
+        self.total = None
+        self.scanned = 0
+        self._lock = threading.Lock()
+
+    def add(self, size, max_bytes):
+        """
+        Account file written to the cache.
+
+        :param int size: size of the file
+        :param int max_bytes: maximum size of the cache
+        :rtype int: number of removed files
+        """
+        with self._lock:
+            if self.total is not None:
+                self.total += size
+                if self.total <= max_bytes and time.monotonic() - self.scanned < self.scan_interval:
+                    return 0
+
+            files = scan_files(self.directory)
+            removed, self.total = evict(files, sum(size for atime, size, path in files), max_bytes)
+            self.scanned = time.monotonic()
+            return removed
+
+
+CachedFile = collections.namedtuple('CachedFile', 'data etag mtime mtime_ns size mimetype')
+
+
+def make_etag(path, stat_result):
+    """
+    ETag of a file, in the same form as created by `send_file`, so it
+    doesn't change whether the file is sent from memory or from disk.
+
+    :param str path: path to the file
+    :param stat_result: result of `os.stat` for the file
+    :rtype str:
+    """
+    check = zlib.adler32(path.encode()) & 0xFFFFFFFF
+    return '{}-{}-{}'.format(stat_result.st_mtime, stat_result.st_size, check)
+
+
+class ByteCache:
+    """
+    In-memory LRU cache of small files, owned by single worker process.
+    Total size of cached data is limited by `max_bytes`.
+
+    Entries are validated against file modification time and size, so
+    files changed or removed by other processes are never sent.
+    """
+
+    def __init__(self, max_bytes, max_item_bytes):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, stat_result):
+        """
+        Returns cached file if it's still up to date.
+
+        :param str path: path to the file
+        :param stat_result: current result of `os.stat` for the file
+        :rtype CachedFile: or None
+        """
+        with self._lock:
+            entry = self._items.get(path)
+            if entry is None or (entry.mtime_ns, entry.size) != (stat_result.st_mtime_ns, stat_result.st_size):
+                self.misses += 1
+                return None
+            self._items.move_to_end(path)
+            self.hits += 1
+            return entry
+
+    def load(self, path, stat_result, mimetype):
+        """
+        Read file into the cache. Files bigger than `max_item_bytes`
+        are not cached.
+
+        :param str path: path to the file
+        :param stat_result: result of `os.stat` for the file
+        :param str mimetype: mime type of the file
+        :rtype CachedFile: or None if file is too big
+        """
+        if stat_result.st_size > self.max_item_bytes or stat_result.st_size > self.max_bytes:
+            return None
+
+        with open(path, 'rb') as fp:
+            data = fp.read()
+
+        entry = CachedFile(
+            data=data,
+            etag=make_etag(path, stat_result),
+            mtime=stat_result.st_mtime,
+            mtime_ns=stat_result.st_mtime_ns,
+            size=len(data),
+            mimetype=mimetype,
+        )
+
+        with self._lock:
+            self._remove(path)
+            self._items[path] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+        return entry
+
+    def invalidate(self, path):
+        """
+        Remove file from the cache.
+
+        :param str path: path to the file
+        """
+        with self._lock:
+            self._remove(path)
+
+    def stats(self):
+        """
+        Returns cache counters.
+
+        :rtype dict:
+        """
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'size': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _remove(self, path):
+        entry = self._items.pop(path, None)
+        if entry is not None:
+            self.size -= entry.size
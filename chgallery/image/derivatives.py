@@ -0,0 +1,555 @@
+"""
+Creating derivative files for uploaded images: normalized image,
+thumbnail and preview.
+
+Upload view stores only original file and database entry, while the
+rest of the work is done according to `DERIVATIVES_WORKER` setting:
+
+* 'inline' - immediately, in the same request,
+* 'pool'   - in local pool of `DERIVATIVES_POOL_SIZE` worker processes,
+* 'queue'  - by separate `flask derivatives-worker` process, which
+             picks up all images with pending status.
+"""
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import or_
+
+from chgallery.db import get_db_session
+from chgallery.db.declarative import Image
+from chgallery.image.storage import find_file, get_all_paths, get_path
+from chgallery.image.utils import get_resample_filter, smart_resize
+from chgallery.metrics import measure
+from chgallery.pagecache import bump_gallery_version
+
+
+THUMBNAIL_SIZE = 250
+PREVIEW_SIZE = 100
+
+# Sizes not created during upload are rendered on demand into this
+# subdirectory of `UPLOAD_PATH`, e.g. cache/<size>/<shard>/<filename>
+CACHE_DIRNAME = 'cache'
+
+# Additional formats of thumbnails and previews, stored in subdirectories
+# named after the format, e.g. thumbs/webp/<shard>/<filename>
+VARIANTS = {
+    'webp': ('WEBP', 'image/webp'),
+    'avif': ('AVIF', 'image/avif'),
+}
+
+DEFAULT_SIZES = (('thumbs', THUMBNAIL_SIZE), ('previews', PREVIEW_SIZE))
+
+EXIF_ORIENTATION = 0x0112
+
+_executor_lock = threading.Lock()
+
+
+def _save_image(img, path, img_format, save_options=None):
+    """
+    Save image under temporary name first, so partially written file
+    is never served. Uploaded file names never start with a dot.
+    Existing files hard linked by duplicates (see `link_derivatives`)
+    are written in place instead, so they stay shared.
+    """
+    dirname, filename = os.path.split(path)
+    tmp_path = os.path.join(dirname, '.{}.tmp'.format(filename))
+    img.save(tmp_path, img_format, **(save_options or {}).get(img_format, {}))
+    try:
+        shared = os.stat(path).st_nlink > 1
+    except FileNotFoundError:
+        shared = False
+
+    if not shared:
+        os.replace(tmp_path, path)
+        return
+    with open(tmp_path, 'rb') as src, open(path, 'r+b') as dst:
+        shutil.copyfileobj(src, dst)
+        dst.truncate()
+    os.unlink(tmp_path)
+
+
+def _save_derivative(img, upload_path, dirname, filename, img_format, options):
+    """
+    Save thumbnail or preview in original format and all configured variants.
+    """
+    save_options = options.get('save_options')
+    sharded = options.get('sharded', True)
+    _save_image(img, get_path(upload_path, filename, dirname, sharded), img_format, save_options)
+
+    if not options.get('variants'):
+        return
+
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.mode in ('LA', 'PA') or 'transparency' in img.info else 'RGB')
+
+    for variant in options['variants']:
+        variant_path = get_path(upload_path, filename, '{}/{}'.format(dirname, variant), sharded)
+        _save_image(img, variant_path, VARIANTS[variant][0], save_options)
+
+
+def is_variant_supported(variant):
+    """
+    Checks if Pillow was built with encoder for given variant format.
+
+    :param str variant: one of `VARIANTS` keys
+    :rtype bool:
+    """
+    from PIL import Image as PILImage
+
+    PILImage.init()
+    return VARIANTS[variant][0] in PILImage.SAVE
+
+
+def get_size_dirname(config, size):
+    """
+    Returns directory of derivatives of given size, relative to `UPLOAD_PATH`.
+
+    :param config: application config
+    :param str size: one of `IMAGE_SIZES` keys
+    :rtype str:
+    """
+    if size in config['IMAGE_EAGER_SIZES']:
+        return size
+    return '{}/{}'.format(CACHE_DIRNAME, size)
+
+
+def get_options(config):
+    """
+    Collect image processing settings from application configuration,
+    so they may be passed to worker process.
+
+    :param config: application config
+    :rtype dict:
+    """
+    return {
+        'max_size': config['IMAGE_MAX_SIZE'],
+        'upscale': config['IMAGE_UPSCALE'],
+        'resample': get_resample_filter(config['IMAGE_RESAMPLE']),
+        'thumbnail_resample': get_resample_filter(config['THUMBNAIL_RESAMPLE']),
+        'variants': [variant for variant in config['IMAGE_VARIANTS'] if is_variant_supported(variant)],
+        'save_options': config['IMAGE_SAVE_OPTIONS'],
+        'strip_metadata': config['IMAGE_STRIP_METADATA'],
+        'sharded': config['UPLOAD_SHARDING'],
+        'sizes': sorted(
+            ((size, config['IMAGE_SIZES'][size]) for size in config['IMAGE_EAGER_SIZES']),
+            key=lambda item: item[1],
+            reverse=True,
+        ),
+    }
+
+
+def get_derivative_dirnames(options):
+    """
+    Directories of all derivatives created together with normalized
+    image (thumbnails and previews in all variants).
+
+    :param dict options: image processing settings, see `get_options`
+    :rtype list: directories relative to `UPLOAD_PATH`
+    """
+    dirnames = []
+    for dirname, max_size in options.get('sizes', DEFAULT_SIZES):
+        dirnames.append(dirname)
+        dirnames.extend('{}/{}'.format(dirname, variant) for variant in options.get('variants') or ())
+    return dirnames
+
+
+def link_derivatives(upload_path, source, target, options=None):
+    """
+    Share normalized image and derivatives of already processed image
+    with new image of the same content, instead of storing and creating
+    them again. Files are hard linked, so their data is removed from disk
+    together with the last image using them. Images of the same content
+    are processed the same way, so processing one of them again rewrites
+    shared files in place (see `_save_image`).
+
+    :param str upload_path: directory with uploaded files
+    :param str source: name of processed image
+    :param str target: name of new image
+    :param dict options: image processing settings, see `get_options`
+    :rtype bool: True if all files were linked
+    """
+    options = options or {}
+    links = []
+    try:
+        for dirname in [None] + get_derivative_dirnames(options):
+            source_path = find_file(upload_path, source, dirname)
+            if source_path is None:
+                raise FileNotFoundError(source)
+            target_path = get_path(upload_path, target, dirname, options.get('sharded', True))
+            os.link(source_path, target_path)
+            links.append(target_path)
+    except OSError:
+        for path in links:
+            os.unlink(path)
+        return False
+    return True
+
+
+def generate_derivatives(upload_path, filename, img=None, options=None):
+    """
+    Normalize uploaded image and create it's thumbnail and preview.
+    It doesn't need application context, so it may be called
+    from separate worker process.
+
+    Original file is rewritten only if it's bigger than maximum size
+    (or smaller, when upscaling is enabled), has to be rotated according
+    to it's EXIF orientation or if it has metadata to strip.
+
+    :param str upload_path: directory with uploaded files
+    :param str filename: name of the original file
+    :param img: already opened (but not loaded) original image, it's
+                opened from `upload_path` if not given
+    :param dict options: image processing settings, see `get_options`
+    :rtype tuple: width and height of normalized image
+    """
+    from PIL import Image as PILImage, ImageOps
+
+    options = options or {}
+    thumbnail_resample = options.get('thumbnail_resample', PILImage.BILINEAR)
+    path = find_file(upload_path, filename)
+    if path is None:
+        raise FileNotFoundError(filename)
+    if img is None:
+        img = PILImage.open(path)
+
+    with img:
+        img_format = img.format
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+        normalized = smart_resize(
+            img,
+            max_size=options.get('max_size', 2000),
+            resample=options.get('resample', PILImage.LANCZOS),
+            upscale=options.get('upscale', False),
+        )
+        if orientation != 1:
+            normalized = ImageOps.exif_transpose(normalized)
+
+        # Metadata is not copied to new file, except of color profile
+        if normalized is not img or (options.get('strip_metadata') and 'exif' in img.info):
+            save_options = dict(options.get('save_options') or {})
+            save_options[img_format] = dict(
+                save_options.get(img_format, {}),
+                icc_profile=img.info.get('icc_profile'),
+            )
+            _save_image(normalized, path, img_format, save_options)
+
+        # Every size is created from previous, bigger one
+        size = normalized.size
+        for dirname, max_size in options.get('sizes', DEFAULT_SIZES):
+            normalized.thumbnail((max_size, max_size), thumbnail_resample)
+            _save_derivative(normalized, upload_path, dirname, filename, img_format, options)
+
+    return size
+
+
+def render_size(upload_path, filename, dirname, max_size, options=None):
+    """
+    Create single derivative of already normalized image.
+
+    :param str upload_path: directory with uploaded files
+    :param str filename: name of the original file
+    :param str dirname: directory for derivative, relative to `upload_path`
+    :param int max_size: maximum width or height of derivative
+    :param dict options: image processing settings, see `get_options`
+    """
+    from PIL import Image as PILImage
+
+    options = options or {}
+    path = find_file(upload_path, filename)
+    if path is None:
+        raise FileNotFoundError(filename)
+
+    with PILImage.open(path) as img:
+        img_format = img.format
+        img.thumbnail((max_size, max_size), options.get('thumbnail_resample', PILImage.BILINEAR))
+        _save_derivative(img, upload_path, dirname, filename, img_format, options)
+
+
+def remove_files(upload_path, filename, dirnames=('thumbs', 'previews')):
+    """
+    Remove original file and all it's derivatives, in both sharded
+    and flat layout. Files that were not created (e.g. image is still
+    processed) are skipped.
+
+    :param str upload_path: directory with uploaded files
+    :param str filename: name of the original file
+    :param dirnames: directories of all derivative sizes
+    :rtype list: paths of removed files
+    """
+    paths = get_all_paths(upload_path, filename)
+    for dirname in dirnames:
+        paths.extend(get_all_paths(upload_path, filename, dirname))
+        for variant in VARIANTS:
+            paths.extend(get_all_paths(upload_path, filename, '{}/{}'.format(dirname, variant)))
+
+    removed = []
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        removed.append(path)
+
+    return removed
+
+
+def _store_result(image_id, size=None):
+    """
+    Update image status in database. Missing `size` means failure.
+    """
+    if size is None:
+        values = {'status': Image.FAILED}
+    else:
+        values = {'status': Image.READY, 'width': size[0], 'height': size[1]}
+
+    db_session = get_db_session()
+    db_session.query(Image).filter(Image.id == image_id).update(values, synchronize_session=False)
+    db_session.commit()
+    bump_gallery_version()
+
+
+def _process_image(image_id, filename, img=None):
+    """
+    Generate derivatives of single image in current process and store result.
+    """
+    try:
+        with measure('image'):
+            size = generate_derivatives(
+                current_app.config['UPLOAD_PATH'], filename, img, get_options(current_app.config)
+            )
+    except Exception:
+        current_app.logger.exception('Cannot create derivatives of %s', filename)
+        size = None
+    _store_result(image_id, size)
+
+
+class _PoolState:
+    """
+    Process pool owned by single worker process.
+    """
+
+    def __init__(self, max_workers):
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.pid = os.getpid()
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+
+
+def _get_executor():
+    state = current_app.extensions.get('chgallery.derivatives')
+    if state is None or state.pid != os.getpid():
+        with _executor_lock:
+            state = current_app.extensions.get('chgallery.derivatives')
+            if state is None or state.pid != os.getpid():
+                state = _PoolState(current_app.config['DERIVATIVES_POOL_SIZE'])
+                current_app.extensions['chgallery.derivatives'] = state
+                resubmitted = _resubmit_stale_images()
+                if resubmitted:
+                    current_app.logger.warning('Resubmitted %d image(s) scheduled by stopped workers', resubmitted)
+    return state.executor
+
+
+def _stale_claim(timeout):
+    return or_(Image.claimed_at.is_(None), Image.claimed_at < _utcnow() - timedelta(seconds=timeout))
+
+
+def _submit_to_pool(image_id, filename, condition=None):
+    """
+    Claim pending image and create it's derivatives in process pool.
+    Image is only claimed when it's still pending and matches optional
+    `condition`, so other processes don't submit it at the same time.
+
+    :rtype bool: whether image was submitted
+    """
+    app = current_app._get_current_object()
+    db_session = get_db_session()
+    query = db_session.query(Image).filter(Image.id == image_id, Image.status == Image.PENDING)
+    if condition is not None:
+        query = query.filter(condition)
+    claimed = query.update({'claimed_at': _utcnow()}, synchronize_session=False)
+    db_session.commit()
+    if not claimed:
+        return False
+
+    def store_result(future):
+        with app.app_context():
+            if future.exception() is not None:
+                app.logger.error('Cannot create derivatives of %s', image_id, exc_info=future.exception())
+                _store_result(image_id)
+            else:
+                _store_result(image_id, future.result())
+
+    # Image is claimed before pool is started, so it's not resubmitted as stale
+    future = _get_executor().submit(
+        generate_derivatives, app.config['UPLOAD_PATH'], filename, options=get_options(app.config)
+    )
+    future.add_done_callback(store_result)
+    return True
+
+
+def _resubmit_stale_images():
+    """
+    Submit pending images which were scheduled more than
+    `DERIVATIVES_CLAIM_TIMEOUT` seconds ago, as process pool which
+    had them most likely stopped before finishing it's work.
+
+    :rtype int: number of resubmitted images
+    """
+    condition = _stale_claim(current_app.config['DERIVATIVES_CLAIM_TIMEOUT'])
+    stale = (
+        get_db_session()
+        .query(Image.id, Image.name)
+        .filter(Image.status == Image.PENDING, condition)
+        .order_by(Image.id)
+        .all()
+    )
+    return sum(_submit_to_pool(image_id, filename, condition) for image_id, filename in stale)
+
+
+def schedule_derivatives(image, img=None):
+    """
+    Create derivatives of newly uploaded image according
+    to `DERIVATIVES_WORKER` configuration.
+
+    :param image: Image instance already stored in database
+    :param img: uploaded file opened with Pillow, reused when
+                derivatives are created in the same process
+    """
+    worker = current_app.config['DERIVATIVES_WORKER']
+
+    if worker == 'inline':
+        _process_image(image.id, image.name, img)
+    elif worker == 'pool':
+        _submit_to_pool(image.id, image.name)
+    elif worker != 'queue':
+        raise ValueError('Unknown DERIVATIVES_WORKER: {}'.format(worker))
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def requeue_stale_images(timeout):
+    """
+    Return images claimed by workers more than `timeout` seconds ago
+    to the queue, as their worker most likely died while processing them.
+
+    :param int timeout: seconds after which claim expires
+    :rtype int: number of requeued images
+    """
+    db_session = get_db_session()
+    requeued = (
+        db_session.query(Image)
+        .filter(
+            Image.status == Image.PROCESSING,
+            _stale_claim(timeout),
+        )
+        .update({'status': Image.PENDING, 'claimed_at': None}, synchronize_session=False)
+    )
+    db_session.commit()
+    return requeued
+
+
+def process_pending_images(limit=20):
+    """
+    Process images waiting in the queue. Every image is claimed first
+    by changing it's status, so many workers may run at the same time.
+    Claims older than `DERIVATIVES_CLAIM_TIMEOUT` are released first.
+    Pending images recently submitted to process pool are skipped.
+
+    :param int limit: maximum number of images to process
+    :rtype int: number of processed images
+    """
+    timeout = current_app.config['DERIVATIVES_CLAIM_TIMEOUT']
+    requeued = requeue_stale_images(timeout)
+    if requeued:
+        current_app.logger.warning('Requeued %d image(s) claimed by stopped workers', requeued)
+
+    db_session = get_db_session()
+    pending = (
+        db_session.query(Image.id, Image.name)
+        .filter(Image.status == Image.PENDING, _stale_claim(timeout))
+        .order_by(Image.id)
+        .limit(limit)
+        .all()
+    )
+    processed = 0
+
+    for image_id, filename in pending:
+        claimed = (
+            db_session.query(Image)
+            .filter(Image.id == image_id, Image.status == Image.PENDING, _stale_claim(timeout))
+            .update({'status': Image.PROCESSING, 'claimed_at': _utcnow()}, synchronize_session=False)
+        )
+        db_session.commit()
+
+        if claimed:
+            _process_image(image_id, filename)
+            processed += 1
+
+    return processed
+
+
+@click.command('derivatives-worker')
+@click.option('--once', is_flag=True, help='Process all pending images and exit.')
+@click.option('--interval', default=2.0, show_default=True, help='Seconds to wait for new uploads.')
+@with_appcontext
+def derivatives_worker_command(once, interval):
+    """ Create thumbnails and previews of uploaded images """
+    while True:
+        processed = process_pending_images()
+        if processed:
+            click.echo('Processed {} image(s)'.format(processed))
+        elif once:
+            break
+        else:
+            time.sleep(interval)
+
+
+@click.command('normalize-images')
+@click.option('--batch', default=100, show_default=True, help='Number of images loaded at once.')
+@with_appcontext
+def normalize_images_command(batch):
+    """ Apply current size and filter settings to existing images """
+    db_session = get_db_session()
+    last_id = 0
+    processed = failed = 0
+
+    while True:
+        images = (
+            db_session.query(Image.id, Image.name)
+            .filter(Image.id > last_id, Image.status == Image.READY)
+            .order_by(Image.id)
+            .limit(batch)
+            .all()
+        )
+        if not images:
+            break
+
+        for image_id, filename in images:
+            try:
+                size = generate_derivatives(
+                    current_app.config['UPLOAD_PATH'], filename, options=get_options(current_app.config)
+                )
+            except Exception as exc:
+                # Image keeps it's status, previous files are still usable
+                current_app.logger.exception('Cannot normalize %s', filename)
+                click.echo('Cannot normalize {}: {}'.format(filename, exc), err=True)
+                failed += 1
+            else:
+                _store_result(image_id, size)
+                processed += 1
+        last_id = images[-1].id
+
+    click.echo('Normalized {} image(s), failed {}'.format(processed, failed))
+
+
+def init_app(app):
+    app.cli.add_command(derivatives_worker_command)
+    app.cli.add_command(normalize_images_command)
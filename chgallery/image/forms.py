@@ -3,14 +3,16 @@ from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField
 from wtforms.validators import Length, StopValidation
 
-from chgallery.image.utils import is_allowed_image_file
+from chgallery.image.utils import open_image_file
 
 
 class ImageFileRequired(FileRequired):
 
     def __call__(self, form, field):
         super().__call__(form, field)
-        if not is_allowed_image_file(field.data):
+        # Opened image is kept in the field to process it without reopening
+        field.pil_image = open_image_file(field.data)
+        if field.pil_image is None:
             raise StopValidation(
                 "An image of type 'jpg', 'png' or 'gif' is required"
             )
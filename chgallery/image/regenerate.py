@@ -0,0 +1,314 @@
+"""
+Regenerating derivatives of already uploaded images (after files were
+lost or image settings changed), checking that files in `UPLOAD_PATH`
+match the database and moving them to sharded layout.
+
+Progress of `flask regenerate-derivatives` is stored in instance folder
+after every batch, so interrupted run continues where it stopped.
+"""
+import collections
+import hashlib
+import json
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from chgallery.db import get_db_session
+from chgallery.db.declarative import Image
+from chgallery.image.derivatives import (
+    VARIANTS,
+    generate_derivatives,
+    get_derivative_dirnames,
+    get_options,
+    get_size_dirname
+)
+from chgallery.image.storage import find_file, get_all_paths, get_relative_path, iter_files, move_to_shard
+from chgallery.pagecache import bump_gallery_version
+
+
+STATE_FILENAME = 'regenerate-derivatives.json'
+
+
+def get_options_digest(options):
+    """
+    Fingerprint of image processing settings, changes whenever
+    derivatives created with them would be different.
+
+    :param dict options: image processing settings, see `get_options`
+    :rtype str:
+    """
+    return hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_state(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    # Instance folder is not created by `create_app`
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as fp:
+        json.dump(state, fp)
+    os.replace(tmp_path, path)
+
+
+def is_up_to_date(upload_path, filename, options):
+    """
+    Checks if all derivatives exist and are not older than the original.
+
+    :param str upload_path: directory with uploaded files
+    :param str filename: name of the original file
+    :param dict options: image processing settings, see `get_options`
+    :rtype bool:
+    """
+    paths = [find_file(upload_path, filename, dirname) for dirname in [None] + get_derivative_dirnames(options)]
+    if None in paths:
+        return False
+
+    try:
+        original_mtime = os.stat(paths[0]).st_mtime_ns
+        return all(os.stat(path).st_mtime_ns >= original_mtime for path in paths[1:])
+    except FileNotFoundError:
+        return False
+
+
+def remove_cached_sizes(config, filename):
+    """
+    Remove sizes rendered on demand, they're rendered again
+    from regenerated image on next request.
+    """
+    upload_path = config['UPLOAD_PATH']
+    for size in config['IMAGE_SIZES']:
+        dirname = get_size_dirname(config, size)
+        if dirname == size:
+            continue
+        paths = get_all_paths(upload_path, filename, dirname)
+        for variant in config['IMAGE_VARIANTS']:
+            paths.extend(get_all_paths(upload_path, filename, '{}/{}'.format(dirname, variant)))
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def check_files(config, names, statuses):
+    """
+    Compare files in `UPLOAD_PATH` with the database.
+
+    :param config: application config
+    :param set names: names of all images stored in database
+    :param dict statuses: image status for every name
+    :rtype tuple: lists of orphaned files and missing files, relative
+                  to `UPLOAD_PATH`
+    """
+    upload_path = config['UPLOAD_PATH']
+    options = get_options(config)
+    directories = ['']
+    for size in config['IMAGE_SIZES']:
+        dirname = get_size_dirname(config, size)
+        directories.append(dirname)
+        directories.extend('{}/{}'.format(dirname, variant) for variant in config['IMAGE_VARIANTS'])
+
+    orphaned = []
+    for dirname in directories:
+        for path, filename in sorted(iter_files(os.path.join(upload_path, dirname))):
+            if filename not in names:
+                orphaned.append('/'.join(part for part in (dirname, path) if part))
+
+    missing = []
+    derivative_dirnames = get_derivative_dirnames(options)
+    for filename in sorted(names):
+        dirnames = [None]
+        # Derivatives of other images are not created yet or couldn't be created
+        if statuses[filename] == Image.READY:
+            dirnames.extend(derivative_dirnames)
+        missing.extend(
+            get_relative_path(filename, dirname, options['sharded'])
+            for dirname in dirnames if find_file(upload_path, filename, dirname) is None
+        )
+
+    return orphaned, missing
+
+
+def check_uploads(config):
+    """
+    Report orphaned and missing files, exits with status 1 if any found.
+    """
+    statuses = dict(get_db_session().query(Image.name, Image.status))
+    orphaned, missing = check_files(config, set(statuses), statuses)
+    for path in orphaned:
+        click.echo('Orphaned file: {}'.format(path))
+    for path in missing:
+        click.echo('Missing file: {}'.format(path))
+    click.echo('Found {} orphaned and {} missing file(s)'.format(len(orphaned), len(missing)))
+    if orphaned or missing:
+        raise SystemExit(1)
+
+
+def get_resume_point(state, digest, force, restart):
+    """
+    Decide where run starts, continuing interrupted one if it was
+    started with the same settings.
+
+    :param dict state: state stored by previous run
+    :param str digest: digest of current image settings
+    :rtype tuple: id of last processed image and `force` flag
+    """
+    if not restart and state.get('last_id') is not None and state.get('run_options') == digest:
+        click.echo('Continuing after image {}'.format(state['last_id']))
+        return state['last_id'], force or state['force']
+
+    # Files created with different settings are outdated, whatever their mtime is
+    return 0, force or state.get('options', digest) != digest
+
+
+def regenerate_batch(executor, images, config, options, force, counts):
+    """
+    Regenerate derivatives of images in worker processes and store
+    results in the database.
+
+    :param list images: ids and names of images
+    :param dict options: image processing settings, see `get_options`
+    :param collections.Counter counts: updated with number of regenerated,
+                                       skipped and failed images
+    :rtype bool: True if any image was regenerated or failed
+    """
+    from concurrent.futures import as_completed
+
+    upload_path = config['UPLOAD_PATH']
+    db_session = get_db_session()
+    futures = {}
+    for image_id, filename in images:
+        if not force and is_up_to_date(upload_path, filename, options):
+            counts['skipped'] += 1
+            continue
+        future = executor.submit(generate_derivatives, upload_path, filename, options=options)
+        futures[future] = (image_id, filename)
+
+    for future in as_completed(futures):
+        image_id, filename = futures[future]
+        try:
+            size = future.result()
+        except Exception:
+            current_app.logger.exception('Cannot create derivatives of %s', filename)
+            values = {'status': Image.FAILED}
+            counts['failed'] += 1
+        else:
+            values = {'status': Image.READY, 'width': size[0], 'height': size[1]}
+            remove_cached_sizes(config, filename)
+            counts['regenerated'] += 1
+        db_session.query(Image).filter(Image.id == image_id).update(values, synchronize_session=False)
+
+    db_session.commit()
+    return bool(futures)
+
+
+@click.command('regenerate-derivatives')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Number of worker processes.')
+@click.option('--batch', default=100, show_default=True, help='Number of images loaded at once.')
+@click.option('--force', is_flag=True, help='Regenerate also up to date derivatives.')
+@click.option('--restart', is_flag=True, help="Don't continue interrupted run.")
+@click.option('--check', is_flag=True, help='Only report orphaned and missing files.')
+@with_appcontext
+def regenerate_derivatives_command(workers, batch, force, restart, check):
+    """ Create missing and outdated thumbnails and previews """
+    from concurrent.futures import ProcessPoolExecutor
+
+    config = current_app.config
+    if check:
+        check_uploads(config)
+        return
+
+    options = get_options(config)
+    digest = get_options_digest(options)
+    state_path = os.path.join(current_app.instance_path, STATE_FILENAME)
+    state = load_state(state_path)
+    last_id, force = get_resume_point(state, digest, force, restart)
+    db_session = get_db_session()
+    counts = collections.Counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            images = (
+                db_session.query(Image.id, Image.name)
+                .filter(Image.id > last_id, Image.status.in_((Image.READY, Image.FAILED)))
+                .order_by(Image.id)
+                .limit(batch)
+                .all()
+            )
+            if not images:
+                break
+
+            if regenerate_batch(executor, images, config, options, force, counts):
+                bump_gallery_version()
+
+            last_id = images[-1].id
+            save_state(state_path, {
+                'options': state.get('options'),
+                'run_options': digest,
+                'force': force,
+                'last_id': last_id,
+            })
+
+    save_state(state_path, {'options': digest, 'last_id': None})
+    click.echo('Regenerated {}, skipped {}, failed {} image(s)'.format(
+        counts['regenerated'], counts['skipped'], counts['failed']
+    ))
+
+
+@click.command('shard-uploads')
+@click.option('--batch', default=100, show_default=True, help='Number of images moved at once.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to wait between batches.')
+@with_appcontext
+def shard_uploads_command(batch, pause):
+    """ Move uploaded files from flat to sharded directory layout """
+    config = current_app.config
+    if not config['UPLOAD_SHARDING']:
+        raise click.ClickException('UPLOAD_SHARDING is disabled')
+
+    # Files are found in both layouts, so application may keep running
+    dirnames = [None]
+    for size in config['IMAGE_SIZES']:
+        dirname = get_size_dirname(config, size)
+        dirnames.append(dirname)
+        dirnames.extend('{}/{}'.format(dirname, variant) for variant in VARIANTS)
+
+    db_session = get_db_session()
+    last_id = 0
+    moved = 0
+
+    while True:
+        # Images being processed may be rewritten in place, they're moved by next run
+        images = (
+            db_session.query(Image.id, Image.name)
+            .filter(Image.id > last_id, Image.status.in_((Image.READY, Image.FAILED)))
+            .order_by(Image.id)
+            .limit(batch)
+            .all()
+        )
+        if not images:
+            break
+
+        for image_id, filename in images:
+            for dirname in dirnames:
+                moved += move_to_shard(config['UPLOAD_PATH'], filename, dirname)
+        last_id = images[-1].id
+
+        db_session.commit()
+        time.sleep(pause)
+
+    click.echo('Moved {} file(s)'.format(moved))
+
+
+def init_app(app):
+    app.cli.add_command(regenerate_derivatives_command)
+    app.cli.add_command(shard_uploads_command)
@@ -0,0 +1,159 @@
+"""
+Location of uploaded files on disk.
+
+Files are spread over two levels of subdirectories named after first
+characters of MD5 hash of the file name, e.g. `thumbs/3f/a2/picture.jpg`,
+so no directory holds too many files. Files stored in flat layout used
+before (e.g. `thumbs/picture.jpg`) are still found, until they're moved
+with `flask shard-uploads`.
+
+Sharding is used when `UPLOAD_SHARDING` is enabled.
+"""
+import hashlib
+import os
+import re
+
+from werkzeug.security import safe_join
+
+
+SHARD_LEVELS = 2
+SHARD_RE = re.compile(r'^[0-9a-f]{2}$')
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_shard(filename):
+    """
+    Returns subdirectories for given file name, e.g. '3f/a2'.
+
+    :param str filename: name of uploaded file
+    :rtype str:
+    """
+    digest = hashlib.md5(filename.encode()).hexdigest()
+    return '/'.join(digest[level * 2:level * 2 + 2] for level in range(SHARD_LEVELS))
+
+
+def get_relative_path(filename, dirname=None, sharded=True):
+    """
+    Returns path of the file relative to `UPLOAD_PATH`.
+
+    :param str filename: name of uploaded file
+    :param str dirname: optional subdirectory of `UPLOAD_PATH`, e.g. 'thumbs'
+    :param bool sharded: use sharded layout
+    :rtype str:
+    """
+    parts = [dirname, get_shard(filename) if sharded else None, filename]
+    return '/'.join(part for part in parts if part)
+
+
+def get_path(upload_path, filename, dirname=None, sharded=True):
+    """
+    Returns path under which new file should be stored,
+    creating missing directories.
+
+    :param str upload_path: directory with uploaded files
+    :param str filename: name of uploaded file
+    :param str dirname: optional subdirectory of `upload_path`
+    :param bool sharded: use sharded layout
+    :rtype str:
+    """
+    path = os.path.join(upload_path, get_relative_path(filename, dirname, sharded))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def find_file(upload_path, filename, dirname=None):
+    """
+    Returns path of existing file, stored in sharded or flat layout.
+    File names containing path separators are rejected.
+
+    :param str upload_path: directory with uploaded files
+    :param str filename: name of uploaded file
+    :param str dirname: optional subdirectory of `upload_path`
+    :rtype str: or None if file doesn't exist
+    """
+    directory = os.path.join(upload_path, dirname) if dirname else upload_path
+    flat_path = safe_join(directory, filename)
+    if flat_path is None:
+        return None
+
+    sharded_path = os.path.join(upload_path, get_relative_path(filename, dirname))
+    # File may be moved to sharded layout between checks
+    for path in (sharded_path, flat_path, sharded_path):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def get_all_paths(upload_path, filename, dirname=None):
+    """
+    Returns all possible locations of the file, in both layouts.
+
+    :param str upload_path: directory with uploaded files
+    :param str filename: name of uploaded file
+    :param str dirname: optional subdirectory of `upload_path`
+    :rtype list:
+    """
+    return [
+        os.path.join(upload_path, get_relative_path(filename, dirname, sharded))
+        for sharded in (True, False)
+    ]
+
+
+def iter_files(directory):
+    """
+    Yields paths (relative to `directory`) and names of all files stored
+    in the directory, in both layouts. Hidden files are skipped.
+
+    :param str directory: e.g. `UPLOAD_PATH` or it's 'thumbs' subdirectory
+    """
+    def scan(path, level):
+        try:
+            entries = list(os.scandir(os.path.join(directory, path)))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            relative_path = '/'.join(part for part in (path, entry.name) if part)
+            if entry.is_file():
+                yield relative_path, entry.name
+            elif level < SHARD_LEVELS and SHARD_RE.match(entry.name) and entry.is_dir():
+                yield from scan(relative_path, level + 1)
+
+    yield from scan('', 0)
+
+
+def move_to_shard(upload_path, filename, dirname=None):
+    """
+    Move file stored in flat layout to sharded one.
+
+    :param str upload_path: directory with uploaded files
+    :param str filename: name of uploaded file
+    :param str dirname: optional subdirectory of `upload_path`
+    :rtype bool: True if file was moved
+    """
+    sharded_path, flat_path = get_all_paths(upload_path, filename, dirname)
+    if not os.path.isfile(flat_path):
+        return False
+
+    os.makedirs(os.path.dirname(sharded_path), exist_ok=True)
+    os.replace(flat_path, sharded_path)
+    return True
+
+
+def save_stream(stream, path):
+    """
+    Write contents of the stream to the file, computing SHA-256
+    digest of the data on the way.
+
+    :param stream: file-like object, e.g. uploaded file
+    :param str path: destination file
+    :rtype str: hex digest of written data
+    """
+    digest = hashlib.sha256()
+    with open(path, 'wb') as fp:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            fp.write(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,134 @@
+"""
+Streaming of uploaded images.
+
+Files sent to views marked with `streaming_upload` are written directly
+to `UPLOAD_PATH` while the request body is parsed, instead of being
+spooled to temporary files first. Magic number and image header are
+checked as soon as they're received, so files that are not images
+(415 response) or images bigger than `IMAGE_MAX_PIXELS` (413 response)
+are rejected before the rest of the body is read. Size of the whole
+request is limited with `MAX_CONTENT_LENGTH`.
+"""
+import hashlib
+import io
+import os
+import uuid
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+from chgallery.image.utils import ALLOWED_FORMATS, SIGNATURE_SIZE, SIGNATURES
+
+
+MAGIC_NUMBERS = tuple(signature for signature, mimetype in SIGNATURES)
+MAGIC_NUMBER_SIZE = SIGNATURE_SIZE
+
+# Image header is looked for only in this many first bytes of the file,
+# headers placed further (e.g. after big color profile) are checked
+# by the form, when whole file is received.
+MAX_HEADER_SIZE = 1024 * 1024
+
+NOT_AN_IMAGE = "An image of type 'jpg', 'png' or 'gif' is required"
+
+
+def streaming_upload(view):
+    """
+    Stream files uploaded to the view directly to `UPLOAD_PATH`,
+    see `UploadStream`.
+    """
+    view.streaming_upload = True
+    return view
+
+
+class UploadStream:
+    """
+    File object receiving uploaded image in hidden temporary file in
+    `directory`, so it may be moved to final location with `os.replace`.
+    SHA-256 digest of the data is computed on the way. Temporary file is
+    removed when the stream is closed at the end of the request,
+    unless it was moved before.
+
+    :param str directory: where the file is stored, e.g. `UPLOAD_PATH`
+    :param int max_pixels: maximum number of pixels of uploaded image
+    """
+
+    def __init__(self, directory, max_pixels=None):
+        self.path = os.path.join(directory, '.upload-{}.tmp'.format(uuid.uuid4().hex))
+        self.max_pixels = max_pixels
+        self._file = open(self.path, 'w+b')
+        self._digest = hashlib.sha256()
+        self._header = bytearray()
+
+    def write(self, data):
+        if self._header is not None:
+            self._header += data
+            self._check_header()
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        """
+        :rtype str: SHA-256 of data written so far
+        """
+        return self._digest.hexdigest()
+
+    def close(self):
+        self._file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def _check_header(self):
+        if len(self._header) < MAGIC_NUMBER_SIZE:
+            return
+        if not self._header.startswith(MAGIC_NUMBERS):
+            raise UnsupportedMediaType(NOT_AN_IMAGE)
+
+        from PIL import Image, UnidentifiedImageError
+
+        try:
+            with Image.open(io.BytesIO(self._header), formats=ALLOWED_FORMATS) as img:
+                width, height = img.size
+        except Image.DecompressionBombError:
+            raise RequestEntityTooLarge('Image has too many pixels')
+        except (UnidentifiedImageError, OSError):
+            # Header is not received completely yet
+            if len(self._header) >= MAX_HEADER_SIZE:
+                self._header = None
+            return
+
+        self._header = None
+        if self.max_pixels and width * height > self.max_pixels:
+            raise RequestEntityTooLarge('Image has too many pixels, up to {} are allowed'.format(self.max_pixels))
+
+
+class UploadRequest(Request):
+    """
+    Request class streaming files uploaded to views marked
+    with `streaming_upload` to `UploadStream`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._upload_streams = []
+
+    def close(self):
+        # Files rejected while body was parsed never get to `request.files`
+        super().close()
+        for stream in self._upload_streams:
+            stream.close()
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        view = current_app.view_functions.get(self.endpoint)
+        if not getattr(view, 'streaming_upload', False):
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+        upload_path = current_app.config['UPLOAD_PATH']
+        os.makedirs(upload_path, exist_ok=True)
+        stream = UploadStream(upload_path, current_app.config['IMAGE_MAX_PIXELS'])
+        self._upload_streams.append(stream)
+        return stream
@@ -1,4 +1,39 @@
-from PIL import Image, UnidentifiedImageError
+# Pillow is imported by functions which use it, so it's not loaded by
+# worker processes until first image is processed.
+import mimetypes
+
+
+ALLOWED_FORMATS = ('JPEG', 'PNG', 'GIF')
+
+# File signatures (magic numbers) of allowed formats
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+SIGNATURE_SIZE = max(len(signature) for signature, mimetype in SIGNATURES)
+
+# Images are reduced by integer factor before resampling until they are
+# at most this many times bigger than target size (see Image.resize).
+REDUCING_GAP = 3.0
+
+
+def open_image_file(fn):
+    """
+    Opens image file if it's actual image of allowed type. Only file
+    header is read at this point, image data is decoded on first use,
+    so returned object may be used for further processing.
+
+    :param fn: A filename (string), pathlib.Path object or a file object
+    :rtype Pillow.Image: image object or None if file is not allowed
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        return Image.open(fn, formats=ALLOWED_FORMATS)
+    except UnidentifiedImageError:
+        return None
 
 
 def is_allowed_image_file(fn):
@@ -9,26 +44,105 @@ def is_allowed_image_file(fn):
     :param fn: A filename (string), pathlib.Path object or a file object
     :rtype bool:
     """
-    try:
-        return Image.open(fn).format in ('JPEG', 'PNG', 'GIF')
-    except UnidentifiedImageError:
-        return False
+    return open_image_file(fn) is not None
+
+
+RESAMPLE_FILTERS = ('nearest', 'box', 'bilinear', 'hamming', 'bicubic', 'lanczos')
+
+
+def get_resample_filter(name):
+    """
+    Returns Pillow resampling filter by it's name as used in configuration.
+
+    :param str name: one of `RESAMPLE_FILTERS`, e.g. 'lanczos'
+    :rtype int:
+    """
+    if name not in RESAMPLE_FILTERS:
+        raise ValueError('Unknown resampling filter: {}'.format(name))
+
+    from PIL import Image
+    return getattr(Image, name.upper())
+
 
+def get_resized_size(size, max_size=2000, upscale=False):
+    """
+    Calculate size of image after `smart_resize`. It requires only image
+    dimensions, so it may be used before image data is actually decoded.
+
+    :param tuple size: width and height of original image
+    :param max_size: maximum value of width or height in pixels.
+    :param bool upscale: enlarge images smaller than `max_size`
+    :rtype tuple:
+    """
+    width, height = size
+    if not upscale and max(width, height) <= max_size:
+        return width, height
+
+    if width >= height:
+        new_width = max_size
+        new_height = int(new_width / width * height)
+    else:
+        new_height = max_size
+        new_width = int(new_height / height * width)
+
+    return new_width, new_height
 
-def smart_resize(image, max_size=2000):
+
+def smart_resize(image, max_size=2000, resample=None, upscale=False):
     """
     Resize image to `max_size` using it's bigger size (either width or height).
     This will set wide image width to `max_size` and adjust height accordingly.
+    Images that already fit in `max_size` are returned untouched, unless
+    `upscale` is set.
+
+    If image data is not loaded yet, only as much of it is decoded as
+    required for new size. JPEG files are decoded at reduced scale
+    (draft mode) and other formats are reduced by integer factor before
+    resampling.
 
     :param image: Pillow.Image object
     :param max_size: maximum value of width or height in pixels.
+    :param resample: Pillow resampling filter, lanczos by default
+    :param bool upscale: enlarge images smaller than `max_size`
     :rtype Pillow.Image:
     """
-    if image.width >= image.height:
-        new_width = max_size
-        new_height = int(new_width / image.width * image.height)
-    else:
-        new_height = max_size
-        new_width = int(new_height / image.height * image.width)
+    size = get_resized_size(image.size, max_size, upscale)
+    if size == image.size:
+        return image
+
+    if resample is None:
+        resample = get_resample_filter('lanczos')
+    image.draft(image.mode, size)
+    return image.resize(size, resample, reducing_gap=REDUCING_GAP)
+
+
+def guess_image_mimetype(path):
+    """
+    Returns mime type of image file. Allowed formats are recognized by
+    file signature, so files stored with wrong extension are sent with
+    their real type. Type of other files is guessed from extension and
+    only if it's not an image type file header is checked with Pillow.
 
-    return image.resize((new_width, new_height))
+    :param str path: path to image file
+    :rtype str:
+    """
+    try:
+        with open(path, 'rb') as fp:
+            header = fp.read(SIGNATURE_SIZE)
+    except OSError:
+        header = b''
+    for signature, mimetype in SIGNATURES:
+        if header.startswith(signature):
+            return mimetype
+
+    mimetype = mimetypes.guess_type(path)[0]
+    if mimetype is not None and mimetype.startswith('image/'):
+        return mimetype
+
+    from PIL import Image
+
+    try:
+        with Image.open(path) as img:
+            return img.get_format_mimetype() or 'application/octet-stream'
+    except OSError:
+        return 'application/octet-stream'
@@ -0,0 +1,45 @@
+"""
+Locks shared by worker processes.
+"""
+import contextlib
+import os
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+# Keys are spread over fixed number of lock files,
+# so locking doesn't leave a file for every cached image.
+LOCK_STRIPES = 64
+
+_thread_locks = [threading.Lock() for i in range(LOCK_STRIPES)]
+
+
+@contextlib.contextmanager
+def file_lock(lock_dir, key):
+    """
+    Exclusive lock for given key shared by all threads and processes
+    using the same `lock_dir`. Where `fcntl` is not available only
+    threads of current process are synchronized.
+
+    :param str lock_dir: directory for lock files
+    :param str key: name of locked resource
+    """
+    stripe = zlib.crc32(key.encode()) % LOCK_STRIPES
+
+    with _thread_locks[stripe]:
+        if fcntl is None:
+            yield
+            return
+
+        os.makedirs(lock_dir, exist_ok=True)
+        with open(os.path.join(lock_dir, '{}.lock'.format(stripe)), 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
@@ -0,0 +1,434 @@
+"""
+Timing of requests and metrics in Prometheus text format.
+
+Time spent on the whole request, SQL queries, rendering templates and
+processing images is measured for every request when `SERVER_TIMING`
+or `METRICS` is enabled:
+
+* `SERVER_TIMING` - measured times are sent in `Server-Timing` header,
+* `METRICS`       - latency histograms and counters of every endpoint
+                    are collected and exposed at `/metrics`.
+
+Every worker process collects its own metrics and writes them to file
+named after it's pid in `METRICS_DIR` (at most once a second), so
+`/metrics` shows totals of all workers, whichever of them handles it.
+Metrics of finished processes are moved to single `archived.json` file
+when `/metrics` is requested, so counters never go down while the
+directory doesn't grow with every restarted worker. All processes
+sharing `METRICS_DIR` must run on the same machine.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+from flask import (
+    Response,
+    abort,
+    before_render_template,
+    current_app,
+    has_request_context,
+    request,
+    template_rendered
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from chgallery.auth.decorators import skip_user_loading
+from chgallery.locks import file_lock
+
+
+ENVIRON_KEY = 'chgallery.timing'
+
+# Upper bounds of latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+FLUSH_INTERVAL = 1.0
+
+# Metrics of finished processes, summed up
+ARCHIVE_FILENAME = 'archived.json'
+
+HELP = {
+    'chgallery_request_duration_seconds': 'Time of handling requests.',
+    'chgallery_requests_total': 'Number of handled requests.',
+    'chgallery_db_queries_total': 'Number of executed SQL queries.',
+    'chgallery_db_seconds_total': 'Time spent executing SQL queries.',
+    'chgallery_template_seconds_total': 'Time spent rendering templates.',
+    'chgallery_image_seconds_total': 'Time spent processing images.',
+}
+
+
+class RequestTiming:
+    """
+    Times measured during single request, stored in WSGI environ.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.endpoint = None
+        self.durations = {'db': 0.0, 'template': 0.0, 'image': 0.0}
+        self.queries = 0
+        self._starts = {}
+
+    def begin(self, name):
+        self._starts.setdefault(name, []).append(time.perf_counter())
+
+    def end(self, name):
+        starts = self._starts.get(name)
+        if starts:
+            self.durations[name] += time.perf_counter() - starts.pop()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """
+        :rtype str: value of `Server-Timing` header
+        """
+        entries = ['db;dur={:.2f};desc="{} queries"'.format(self.durations['db'] * 1000, self.queries)]
+        entries.extend(
+            '{};dur={:.2f}'.format(name, self.durations[name] * 1000) for name in ('template', 'image')
+        )
+        entries.append('total;dur={:.2f}'.format(self.elapsed() * 1000))
+        return ', '.join(entries)
+
+
+def get_request_timing():
+    """
+    Returns timing of current request, or None if timing is disabled
+    or there's no request.
+    """
+    if not has_request_context():
+        return None
+    return request.environ.get(ENVIRON_KEY)
+
+
+@contextlib.contextmanager
+def measure(name):
+    """
+    Add time spent in the block to timing of current request.
+
+    :param str name: 'db', 'template' or 'image'
+    """
+    timing = get_request_timing()
+    if timing is None:
+        yield
+        return
+
+    timing.begin(name)
+    try:
+        yield
+    finally:
+        timing.end(name)
+
+
+class Metrics:
+    """
+    Counters and histograms of single process. Metrics are identified
+    by name and value of `endpoint` label.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        """
+        :param str name: name of the counter
+        :param tuple labels: pairs of label name and value
+        :param value: added to the counter
+        """
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """
+        :param str name: name of the histogram
+        :param tuple labels: pairs of label name and value
+        :param float value: observed value, e.g. request duration
+        """
+        with self._lock:
+            # Counts of values in every bucket (not cumulative) and +Inf, sum of values
+            histogram = self.histograms.setdefault((name, labels), [0] * (len(BUCKETS) + 1) + [0.0])
+            index = next((i for i, bound in enumerate(BUCKETS) if value <= bound), len(BUCKETS))
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def merge(self, data):
+        """
+        Add metrics serialized with `dump`.
+        """
+        with self._lock:
+            for name, labels, value in data.get('counters', ()):
+                key = (name, tuple(map(tuple, labels)))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, values in data.get('histograms', ()):
+                key = (name, tuple(map(tuple, labels)))
+                histogram = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 1) + [0.0])
+                for i, value in enumerate(values):
+                    histogram[i] += value
+
+    def dump(self):
+        """
+        :rtype dict: metrics serializable to JSON
+        """
+        with self._lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, values] for (name, labels), values in self.histograms.items()],
+            }
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_metrics(metrics):
+    """
+    Format metrics in Prometheus text exposition format.
+
+    :param Metrics metrics:
+    :rtype str:
+    """
+    lines = []
+    names = sorted(
+        {(name, 'counter') for name, labels in metrics.counters}
+        | {(name, 'histogram') for name, labels in metrics.histograms}
+    )
+    for name, kind in names:
+        if name in HELP:
+            lines.append('# HELP {} {}'.format(name, HELP[name]))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+        if kind == 'counter':
+            for (counter_name, labels), value in sorted(metrics.counters.items()):
+                if counter_name == name:
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+            continue
+
+        for (histogram_name, labels), values in sorted(metrics.histograms.items()):
+            if histogram_name != name:
+                continue
+            count = 0
+            for bound, value in zip(BUCKETS + ('+Inf',), values):
+                count += value
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', bound)]), count))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), values[-1]))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsState:
+    """
+    Metrics collected by single worker process.
+    """
+
+    def __init__(self, path):
+        self.pid = os.getpid()
+        self.path = os.path.join(path, '{}.json'.format(self.pid))
+        self.metrics = Metrics()
+        self.flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+        # Left by finished process with the same pid
+        try:
+            with open(self.path) as fp:
+                self.metrics.merge(json.load(fp))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def flush(self, force=False):
+        """
+        Write metrics of this process to it's file.
+
+        :param bool force: write even if they were written less than a second ago
+        """
+        if not force and time.monotonic() - self.flushed < FLUSH_INTERVAL:
+            return
+
+        with self._lock:
+            self.flushed = time.monotonic()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.metrics.dump(), fp)
+            os.replace(tmp_path, self.path)
+
+
+_state_lock = threading.Lock()
+
+
+def get_metrics_dir(app):
+    return app.config['METRICS_DIR'] or os.path.join(app.instance_path, 'metrics')
+
+
+def _get_state(app):
+    state = app.extensions.get('chgallery.metrics')
+    if state is not None and state.pid == os.getpid():
+        return state
+
+    with _state_lock:
+        state = app.extensions.get('chgallery.metrics')
+        # Metrics inherited from parent process were collected by the parent
+        if state is None or state.pid != os.getpid():
+            state = _MetricsState(get_metrics_dir(app))
+            app.extensions['chgallery.metrics'] = state
+    return state
+
+
+def record_request(app, timing, status):
+    """
+    Add timing of finished request to metrics of current process.
+
+    :param app: Flask application
+    :param RequestTiming timing:
+    :param str status: HTTP status code
+    """
+    state = _get_state(app)
+    labels = (('endpoint', timing.endpoint or 'none'),)
+    metrics = state.metrics
+
+    metrics.observe('chgallery_request_duration_seconds', labels, timing.elapsed())
+    metrics.inc('chgallery_requests_total', labels + (('status', status),))
+    metrics.inc('chgallery_db_queries_total', labels, timing.queries)
+    for name, duration in timing.durations.items():
+        metrics.inc('chgallery_{}_seconds_total'.format(name), labels, duration)
+
+    state.flush()
+
+
+def is_running(pid):
+    """
+    :param int pid: process id
+    :rtype bool:
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load(path, metrics):
+    try:
+        with open(path) as fp:
+            metrics.merge(json.load(fp))
+    except (FileNotFoundError, ValueError):
+        pass
+
+
+def archive_finished_processes(path):
+    """
+    Move metrics of processes which are not running anymore to the
+    archive file and remove their files.
+
+    :param str path: metrics directory
+    """
+    def is_finished(filename):
+        pid, ext = os.path.splitext(filename)
+        return ext == '.json' and pid.isdigit() and not is_running(int(pid))
+
+    if not any(is_finished(filename) for filename in os.listdir(path)):
+        return
+
+    # Every file must be archived only once, even by concurrent requests
+    with file_lock(os.path.join(path, '.locks'), 'archive'):
+        archive_path = os.path.join(path, ARCHIVE_FILENAME)
+        archive = Metrics()
+        _load(archive_path, archive)
+        # Files are listed again, as they could be archived in the meantime
+        finished = [os.path.join(path, filename) for filename in os.listdir(path) if is_finished(filename)]
+        for filename in finished:
+            _load(filename, archive)
+
+        tmp_path = '{}.tmp'.format(archive_path)
+        with open(tmp_path, 'w') as fp:
+            json.dump(archive.dump(), fp)
+        os.replace(tmp_path, archive_path)
+        for filename in finished:
+            os.unlink(filename)
+
+
+def collect_metrics(app):
+    """
+    Returns metrics of all processes, including current one.
+
+    :rtype Metrics:
+    """
+    _get_state(app).flush(force=True)
+
+    path = get_metrics_dir(app)
+    archive_finished_processes(path)
+    metrics = Metrics()
+    for filename in os.listdir(path):
+        if filename.endswith('.json'):
+            _load(os.path.join(path, filename), metrics)
+    return metrics
+
+
+@skip_user_loading
+def metrics_view():
+    if not current_app.config['METRICS']:
+        abort(404)
+    return Response(render_metrics(collect_metrics(current_app)), mimetype='text/plain; version=0.0.4')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timing = get_request_timing()
+    if timing is not None:
+        timing.queries += 1
+        timing.begin('db')
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timing = get_request_timing()
+    if timing is not None:
+        timing.end('db')
+
+
+def _before_render_template(app, template, context):
+    timing = get_request_timing()
+    if timing is not None:
+        timing.begin('template')
+
+
+def _template_rendered(app, template, context):
+    timing = get_request_timing()
+    if timing is not None:
+        timing.end('template')
+
+
+def _set_endpoint():
+    timing = get_request_timing()
+    if timing is not None:
+        timing.endpoint = request.endpoint
+
+
+def _add_server_timing(response):
+    timing = get_request_timing()
+    if timing is not None and current_app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = timing.server_timing()
+    return response
+
+
+def init_app(app):
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+    app.before_request(_set_endpoint)
+    app.after_request(_add_server_timing)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -1,6 +1,17 @@
 """Middleware classes."""
 
-from typing import Any, Dict, Union
+import datetime
+import os
+from typing import Any, Dict, Optional, Union
+
+from werkzeug.middleware.profiler import ProfilerMiddleware
+from werkzeug.utils import send_file
+
+from chgallery.image.derivatives import get_size_dirname
+from chgallery.image.storage import find_file
+from chgallery.image.utils import guess_image_mimetype
+from chgallery.metrics import ENVIRON_KEY, RequestTiming, record_request
+from chgallery.profiler import get_dump_filename, get_profiles_dir, rotate_dumps, should_profile
 
 
 class PrefixMiddleware:
@@ -20,3 +31,141 @@ class PrefixMiddleware:
 
         start_response("404", [("Content-Type", "text/plain")])
         return ["This url does not belong to the app.".encode()]
+
+
+class UploadsMiddleware:
+    """
+    Serves uploaded files straight from ``UPLOAD_PATH`` (in sharded or flat
+    layout, see `chgallery.image.storage`), without routing,
+    session loading and database teardown of the Flask application.
+
+    Only files that already exist on disk are sent, everything else
+    (missing files, sizes rendered on demand, format negotiation,
+    in-memory cache, X-Sendfile and X-Accel-Redirect) falls through
+    to the application, so responses don't depend on which one
+    handled the request.
+    """
+
+    def __init__(self, app: Any, flask_app: Any, url_prefix: str = "/image/uploads/") -> None:
+        self.app = app
+        self.config = flask_app.config
+        self.url_prefix = url_prefix
+
+    def __call__(
+        self, environ: Dict[str, Any], start_response: Any
+    ) -> Union[Any, list[bytes]]:
+        filepath = self.get_file_path(environ)
+        if filepath is None:
+            return self.app(environ, start_response)
+
+        max_age = self.config["SEND_FILE_MAX_AGE_DEFAULT"]
+        if isinstance(max_age, datetime.timedelta):
+            max_age = int(max_age.total_seconds())
+
+        response = send_file(
+            filepath,
+            environ,
+            mimetype=guess_image_mimetype(filepath),
+            max_age=max_age,
+        )
+        return response(environ, start_response)
+
+    def get_file_path(self, environ: Dict[str, Any]) -> Optional[str]:
+        """Returns path of existing file to send, or None if request is left to the application."""
+        config = self.config
+        path = environ["PATH_INFO"]
+
+        if (
+            not config["UPLOAD_STATIC_APP"]
+            or environ["REQUEST_METHOD"] not in ("GET", "HEAD")
+            or not path.startswith(self.url_prefix)
+            or config["UPLOAD_ACCEL_REDIRECT"]
+            or config["USE_X_SENDFILE"]
+        ):
+            return None
+
+        parts = path[len(self.url_prefix):].encode("latin1").decode("utf-8", "replace").split("/")
+        if len(parts) == 1:
+            dirname = None
+        elif len(parts) == 2:
+            # Derivatives may be negotiated or kept in memory by the application
+            if (
+                parts[0] not in config["IMAGE_SIZES"]
+                or config["IMAGE_VARIANTS"]
+                or config["IMAGE_MEMORY_CACHE_BYTES"]
+            ):
+                return None
+            dirname = get_size_dirname(config, parts[0])
+            # Sizes rendered on demand have to be marked as recently used
+            if dirname != parts[0]:
+                return None
+        else:
+            return None
+
+        return find_file(config["UPLOAD_PATH"], parts[-1], dirname)
+
+
+class TimingMiddleware:
+    """
+    Measures time of handling the whole request, including other
+    middleware, when ``SERVER_TIMING`` or ``METRICS`` is enabled.
+    Timing is stored in WSGI environ, so the application adds time
+    of SQL queries, templates and image processing to it
+    (see `chgallery.metrics`).
+    """
+
+    def __init__(self, app: Any, flask_app: Any) -> None:
+        self.app = app
+        self.flask_app = flask_app
+
+    def __call__(
+        self, environ: Dict[str, Any], start_response: Any
+    ) -> Union[Any, list[bytes]]:
+        config = self.flask_app.config
+        if not config["SERVER_TIMING"] and not config["METRICS"]:
+            return self.app(environ, start_response)
+
+        timing = environ[ENVIRON_KEY] = RequestTiming()
+        status = ["500"]
+
+        def timed_start_response(response_status: str, headers: Any, exc_info: Optional[Any] = None) -> Any:
+            status[0] = response_status.split(" ", 1)[0]
+            return start_response(response_status, headers, exc_info)
+
+        try:
+            return self.app(environ, timed_start_response)
+        finally:
+            if config["METRICS"]:
+                record_request(self.flask_app, timing, status[0])
+
+
+class SamplingProfilerMiddleware:
+    """
+    Profiles chosen requests with Werkzeug's `ProfilerMiddleware`, when
+    ``PROFILER`` is enabled (see `chgallery.profiler`). Response of
+    profiled request is buffered in memory, other requests are passed
+    through untouched.
+    """
+
+    def __init__(self, app: Any, flask_app: Any) -> None:
+        self.app = app
+        self.flask_app = flask_app
+
+    def __call__(
+        self, environ: Dict[str, Any], start_response: Any
+    ) -> Union[Any, list[bytes]]:
+        if not should_profile(self.flask_app, environ):
+            return self.app(environ, start_response)
+
+        profiles_dir = get_profiles_dir(self.flask_app)
+
+        def filename_format(environ: Dict[str, Any]) -> str:
+            filename = get_dump_filename(environ)
+            os.makedirs(os.path.join(profiles_dir, os.path.dirname(filename)), exist_ok=True)
+            return filename
+
+        profiler = ProfilerMiddleware(self.app, stream=None, profile_dir=profiles_dir, filename_format=filename_format)
+        try:
+            return profiler(environ, start_response)
+        finally:
+            rotate_dumps(profiles_dir, self.flask_app.config["PROFILER_MAX_BYTES"])
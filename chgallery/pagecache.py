@@ -0,0 +1,208 @@
+"""
+Cache of pages rendered for anonymous users.
+
+Cached pages are stored under current gallery version, which is bumped
+every time gallery content changes (image is uploaded, processed or
+deleted), so pages rendered for older versions are never sent again.
+
+Backend is chosen with `PAGE_CACHE` setting:
+
+* 'memory'     - pages are kept in memory of every worker process for
+                 `PAGE_CACHE_TTL` seconds at most, as invalidation
+                 is not visible to other processes,
+* 'filesystem' - pages and version counter are stored in `PAGE_CACHE_DIR`
+                 shared by all workers (and `flask derivatives-worker`).
+"""
+import functools
+import hashlib
+import os
+import threading
+import time
+
+from flask import current_app, g, request, session
+
+from chgallery.locks import file_lock
+
+# Query arguments read by cached views. Pages requested with any other
+# are not cached, so clients can't fill the cache with copies of the
+# same page.
+CACHED_ARGS = ('after',)
+
+
+class MemoryBackend:
+    """
+    Pages cached in memory of current process, kept for `ttl` seconds.
+    Version is bumped only by current process, so changes made by other
+    processes are noticed when cached pages expire.
+    """
+
+    def __init__(self, ttl, max_items=1000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._version = 0
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get_version(self):
+        return self._version
+
+    def bump_version(self):
+        with self._lock:
+            self._version += 1
+            self._items = {}
+
+    def get(self, version, key):
+        entry = self._items.get((version, key))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1:]
+
+    def set(self, version, key, mimetype, data):
+        with self._lock:
+            if version != self._version:
+                return
+            if len(self._items) >= self.max_items:
+                self._items = {}
+            self._items[(version, key)] = (time.monotonic() + self.ttl, mimetype, data)
+
+
+class FileSystemBackend:
+    """
+    Pages cached in files shared by all processes. Current version is
+    stored in `version` file and every page in file named after version
+    and hash of the key.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._version_path = os.path.join(path, 'version')
+
+    def get_version(self):
+        try:
+            with open(self._version_path) as fp:
+                return int(fp.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump_version(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        with file_lock(os.path.join(self.path, '.locks'), 'version'):
+            version = self.get_version() + 1
+            self._write(self._version_path, str(version).encode())
+
+        # Pages of older versions won't be used anymore
+        prefix = '{}-'.format(version)
+        for filename in os.listdir(self.path):
+            if filename.endswith('.page') and not filename.startswith(prefix):
+                try:
+                    os.unlink(os.path.join(self.path, filename))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, version, key):
+        try:
+            with open(self._page_path(version, key), 'rb') as fp:
+                mimetype, data = fp.read().split(b'\n', 1)
+        except (FileNotFoundError, ValueError):
+            return None
+        return mimetype.decode(), data
+
+    def set(self, version, key, mimetype, data):
+        os.makedirs(self.path, exist_ok=True)
+        self._write(self._page_path(version, key), mimetype.encode() + b'\n' + data)
+
+    def _page_path(self, version, key):
+        return os.path.join(self.path, '{}-{}.page'.format(version, hashlib.sha1(key.encode()).hexdigest()))
+
+    def _write(self, path, data):
+        """ Write file atomically, so it's never read partially written """
+        dirname, filename = os.path.split(path)
+        tmp_path = os.path.join(dirname, '.{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident()))
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+
+
+def get_page_cache():
+    """
+    Returns page cache backend configured for current application,
+    or None if page cache is disabled.
+    """
+    backend = current_app.config['PAGE_CACHE']
+    if not backend:
+        return None
+
+    cache = current_app.extensions.get('chgallery.page_cache')
+    if cache is None:
+        if backend == 'memory':
+            cache = MemoryBackend(current_app.config['PAGE_CACHE_TTL'])
+        elif backend == 'filesystem':
+            cache = FileSystemBackend(
+                current_app.config['PAGE_CACHE_DIR'] or os.path.join(current_app.instance_path, 'page-cache')
+            )
+        else:
+            raise ValueError('Unknown PAGE_CACHE: {}'.format(backend))
+        cache = current_app.extensions.setdefault('chgallery.page_cache', cache)
+    return cache
+
+
+def bump_gallery_version():
+    """
+    Invalidate all cached pages. Must be called after changes
+    in gallery content are committed to the database.
+    """
+    cache = get_page_cache()
+    if cache is not None:
+        cache.bump_version()
+
+
+def get_cache_key():
+    """
+    Returns key of page requested by current request, or None if it
+    shouldn't be cached.
+
+    :rtype str:
+    """
+    if any(name not in CACHED_ARGS or len(request.args.getlist(name)) > 1 for name in request.args):
+        return None
+    # Values are stored as read by the views, e.g. invalid ones are ignored
+    return '{}?after={}'.format(request.endpoint, request.args.get('after', type=int))
+
+
+def cached_page(view):
+    """
+    Cache page rendered by view for anonymous users. Pages of logged in
+    users, pages with flashed messages and pages requested with query
+    arguments other than `CACHED_ARGS` are always rendered.
+    """
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        cache = get_page_cache()
+        if cache is None or g.user is not None or '_flashes' in session:
+            return view(**kwargs)
+
+        key = get_cache_key()
+        if key is None:
+            return view(**kwargs)
+
+        # Version must be checked before database is queried
+        version = cache.get_version()
+        cached = cache.get(version, key)
+
+        if cached is None:
+            response = current_app.make_response(view(**kwargs))
+            if response.status_code != 200:
+                return response
+            cache.set(version, key, response.mimetype, response.get_data())
+        else:
+            mimetype, data = cached
+            response = current_app.response_class(data, mimetype=mimetype)
+
+        response.vary.add('Cookie')
+        # Version of 'memory' backend is not shared by processes, so only
+        # page contents identify it
+        response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+        return response.make_conditional(request)
+
+    return wrapped_view
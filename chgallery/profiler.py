@@ -0,0 +1,190 @@
+"""
+Profiling of chosen requests in production.
+
+When `PROFILER` is enabled, `PROFILER_SAMPLE_RATE` fraction of requests
+and every request carrying `X-Chgallery-Profile` header with token
+created by `flask profile-token` are profiled with cProfile. Call graph
+of every profiled request is dumped to `PROFILER_DIR/<endpoint>/`, oldest
+dumps are removed when all of them take more than `PROFILER_MAX_BYTES`.
+
+Dumps may be summarized with `flask profile-report` or opened with any
+tool reading `pstats` files, e.g. snakeviz.
+"""
+import io
+import os
+import pstats
+import random
+
+import click
+from flask import current_app, request
+from flask.cli import with_appcontext
+from itsdangerous import BadSignature, TimestampSigner
+
+
+TRIGGER_HEADER = 'X-Chgallery-Profile'
+TRIGGER_ENVIRON_KEY = 'HTTP_X_CHGALLERY_PROFILE'
+TRIGGER_SALT = 'chgallery.profiler'
+TRIGGER_VALUE = 'profile'
+
+DUMP_SUFFIX = '.prof'
+
+# Endpoint of profiled request is passed to middleware in WSGI environ
+ENDPOINT_ENVIRON_KEY = 'chgallery.profiler.endpoint'
+
+
+def get_profiles_dir(app):
+    return app.config['PROFILER_DIR'] or os.path.join(app.instance_path, 'profiles')
+
+
+def _get_signer(app):
+    return TimestampSigner(app.secret_key, salt=TRIGGER_SALT)
+
+
+def make_trigger_token(app):
+    """
+    Returns value of `X-Chgallery-Profile` header, valid
+    for `PROFILER_TOKEN_MAX_AGE` seconds.
+
+    :rtype str:
+    """
+    return _get_signer(app).sign(TRIGGER_VALUE).decode()
+
+
+def is_triggered(app, environ):
+    """
+    Checks if request carries valid `X-Chgallery-Profile` header.
+
+    :rtype bool:
+    """
+    token = environ.get(TRIGGER_ENVIRON_KEY)
+    if not token:
+        return False
+    try:
+        value = _get_signer(app).unsign(token, max_age=app.config['PROFILER_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return False
+    return value == TRIGGER_VALUE.encode()
+
+
+def should_profile(app, environ):
+    """
+    Decide if request should be profiled.
+
+    :param app: Flask application
+    :param dict environ: WSGI environ of the request
+    :rtype bool:
+    """
+    if not app.config['PROFILER']:
+        return False
+    rate = app.config['PROFILER_SAMPLE_RATE']
+    return (rate > 0 and random.random() < rate) or is_triggered(app, environ)
+
+
+def get_dump_filename(environ):
+    """
+    Name of the dump relative to `PROFILER_DIR`, in directory named after
+    endpoint of the request (known after it's handled).
+
+    :param dict environ: WSGI environ of profiled request
+    :rtype str:
+    """
+    endpoint = environ.get(ENDPOINT_ENVIRON_KEY) or 'none'
+    profiler = environ['werkzeug.profiler']
+    return os.path.join(endpoint, '{:.0f}-{}-{:.0f}ms{}'.format(
+        profiler['time'] * 1000, os.getpid(), profiler['elapsed'], DUMP_SUFFIX
+    ))
+
+
+def iter_dumps(path, endpoint=None):
+    """
+    Yields paths of all dumps stored in `path`.
+
+    :param str path: `PROFILER_DIR`
+    :param str endpoint: only dumps of this endpoint
+    """
+    try:
+        endpoints = [endpoint] if endpoint else sorted(os.listdir(path))
+    except FileNotFoundError:
+        return
+    for name in endpoints:
+        try:
+            filenames = sorted(os.listdir(os.path.join(path, name)))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for filename in filenames:
+            if filename.endswith(DUMP_SUFFIX):
+                yield os.path.join(path, name, filename)
+
+
+def rotate_dumps(path, max_bytes):
+    """
+    Remove oldest dumps until all of them take at most `max_bytes`.
+
+    :param str path: `PROFILER_DIR`
+    :param int max_bytes: maximum total size of dumps
+    """
+    dumps = []
+    for dump_path in iter_dumps(path):
+        try:
+            stat = os.stat(dump_path)
+        except FileNotFoundError:
+            continue
+        dumps.append((stat.st_mtime, stat.st_size, dump_path))
+
+    total = sum(size for mtime, size, dump_path in dumps)
+    for mtime, size, dump_path in sorted(dumps):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(dump_path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+@click.command('profile-token')
+@with_appcontext
+def profile_token_command():
+    """ Print header triggering profiling of the request """
+    click.echo('{}: {}'.format(TRIGGER_HEADER, make_trigger_token(current_app)))
+
+
+@click.command('profile-report')
+@click.option('--endpoint', help='Only dumps of this endpoint.')
+@click.option('--sort', default='cumulative', show_default=True, type=click.Choice(['cumulative', 'tottime', 'calls']))
+@click.option('--limit', default=30, show_default=True, help='Number of functions shown.')
+@with_appcontext
+def profile_report_command(endpoint, sort, limit):
+    """ Show functions taking the most time in all profiled requests """
+    path = get_profiles_dir(current_app)
+    dumps = list(iter_dumps(path, endpoint))
+    if not dumps:
+        raise click.ClickException('No dumps found in {}'.format(path))
+
+    endpoints = {}
+    for dump_path in dumps:
+        name = os.path.basename(os.path.dirname(dump_path))
+        endpoints[name] = endpoints.get(name, 0) + 1
+    for name, count in sorted(endpoints.items()):
+        click.echo('{}: {} request(s)'.format(name, count))
+
+    output = io.StringIO()
+    stats = pstats.Stats(dumps[0], stream=output)
+    for dump_path in dumps[1:]:
+        try:
+            stats.add(dump_path)
+        except (OSError, EOFError, ValueError, TypeError):
+            click.echo('Skipped unreadable dump {}'.format(dump_path))
+    stats.sort_stats(sort).print_stats(limit)
+    click.echo(output.getvalue())
+
+
+def _store_endpoint():
+    if current_app.config['PROFILER']:
+        request.environ[ENDPOINT_ENVIRON_KEY] = request.endpoint
+
+
+def init_app(app):
+    app.before_request(_store_endpoint)
+    app.cli.add_command(profile_report_command)
+    app.cli.add_command(profile_token_command)
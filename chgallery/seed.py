@@ -0,0 +1,180 @@
+"""
+Synthetic gallery content for load testing, created with::
+
+    $ flask seed-gallery --users 50 --images 5000
+
+Users are named `seed-user-<number>` and share the same password, so
+`benchmarks.load` may log in as any of them. Images are generated in
+worker processes, together with their derivatives created by the same
+code as for uploaded images, and stored in batches with bulk inserts.
+"""
+import os
+import random
+import uuid
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+
+from chgallery.db import get_db_session
+from chgallery.db.declarative import Image, User
+from chgallery.image.derivatives import generate_derivatives, get_options
+from chgallery.image.storage import get_path
+from chgallery.pagecache import bump_gallery_version
+
+
+USERNAME_PREFIX = 'seed-user-'
+
+# Sizes of generated images, like photos taken with phones and cameras
+# scaled down by the gallery, plus some small screenshots
+SIZES = ((2000, 1500), (1500, 2000), (2000, 1125), (1600, 1200), (1024, 768), (800, 600))
+# Formats and their weights
+FORMATS = (('JPEG', 'jpg', 8), ('PNG', 'png', 1), ('GIF', 'gif', 1))
+
+
+# Backgrounds of every size, generated once by every worker process
+_backgrounds = {}
+
+
+def get_background(size):
+    """
+    Gradient with noise, the slowest part of generating an image.
+
+    :param tuple size: width and height
+    :rtype Pillow.Image:
+    """
+    if size not in _backgrounds:
+        from PIL import Image as PILImage
+
+        gradient = PILImage.linear_gradient('L').resize(size)
+        noise = PILImage.effect_noise(size, 48)
+        _backgrounds[size] = PILImage.merge('RGB', (gradient, noise, gradient.transpose(PILImage.FLIP_LEFT_RIGHT)))
+    return _backgrounds[size]
+
+
+def make_image(size, rnd):
+    """
+    Synthetic photo-like image: gradient background with noise and some
+    shapes, so encoders have realistic amount of work.
+
+    :param tuple size: width and height
+    :param random.Random rnd: source of randomness
+    :rtype Pillow.Image:
+    """
+    from PIL import Image as PILImage, ImageDraw
+
+    width, height = size
+    img = get_background(size).copy()
+    if rnd.random() < 0.5:
+        img = img.transpose(PILImage.FLIP_TOP_BOTTOM)
+
+    draw = ImageDraw.Draw(img)
+    for i in range(rnd.randint(3, 12)):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        box = (x, y, x + rnd.randint(20, width // 2), y + rnd.randint(20, height // 2))
+        color = tuple(rnd.randrange(256) for channel in range(3))
+        (draw.ellipse if rnd.random() < 0.5 else draw.rectangle)(box, fill=color)
+    return img
+
+
+def create_image_files(upload_path, filename, img_format, size, seed, options):
+    """
+    Generate image with it's derivatives, runs in worker process.
+
+    :rtype tuple: size of normalized image
+    """
+    img = make_image(size, random.Random(seed))
+    if img_format == 'GIF':
+        img = img.convert('P')
+    # Originals are written with fast compression, derivatives with configured options
+    img.save(get_path(upload_path, filename, sharded=options['sharded']), img_format, compress_level=1)
+    return generate_derivatives(upload_path, filename, options=options)
+
+
+def create_users(count, password):
+    """
+    Create users numbered after already existing seeded users.
+
+    :rtype list: ids of all seeded users
+    """
+    db_session = get_db_session()
+    existing = db_session.query(User.id).filter(User.username.startswith(USERNAME_PREFIX)).count()
+    # Hashing is slow on purpose, all users share the same password
+    password_hash = generate_password_hash(password)
+
+    if count:
+        db_session.execute(insert(User), [
+            {
+                'username': '{}{}'.format(USERNAME_PREFIX, number),
+                'email': '{}{}@example.com'.format(USERNAME_PREFIX, number),
+                'password': password_hash,
+            }
+            for number in range(existing + 1, existing + count + 1)
+        ])
+        db_session.commit()
+
+    return [user_id for user_id, in db_session.query(User.id).filter(User.username.startswith(USERNAME_PREFIX))]
+
+
+@click.command('seed-gallery')
+@click.option('--users', default=10, show_default=True, help='Number of users created.')
+@click.option('--images', default=100, show_default=True, help='Number of images created.')
+@click.option('--password', default='seed', show_default=True, help='Password of created users.')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Number of worker processes.')
+@click.option('--batch', default=500, show_default=True, help='Number of images inserted at once.')
+@click.option('--seed', type=int, help='Seed of random generator, for repeatable content.')
+@with_appcontext
+def seed_gallery_command(users, images, password, workers, batch, seed):
+    """ Fill the gallery with synthetic users and images """
+    from concurrent.futures import ProcessPoolExecutor
+
+    rnd = random.Random(seed)
+    author_ids = create_users(users, password)
+    if images and not author_ids:
+        raise click.ClickException('There are no seeded users, use --users')
+    click.echo('Created {} user(s)'.format(users))
+
+    config = current_app.config
+    upload_path = config['UPLOAD_PATH']
+    options = get_options(config)
+    run_id = uuid.uuid4().hex[:8]
+    formats = [(img_format, ext) for img_format, ext, weight in FORMATS for i in range(weight)]
+    db_session = get_db_session()
+    created = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for offset in range(0, images, batch):
+            futures = []
+            for number in range(offset, min(offset + batch, images)):
+                img_format, ext = rnd.choice(formats)
+                filename = 'seed-{}-{}.{}'.format(run_id, number, ext)
+                future = executor.submit(
+                    create_image_files, upload_path, filename, img_format, rnd.choice(SIZES), rnd.random(), options
+                )
+                futures.append((filename, future))
+
+            rows = []
+            for filename, future in futures:
+                width, height = future.result()
+                rows.append({
+                    'name': filename,
+                    'description': 'Synthetic image {}'.format(filename),
+                    'width': width,
+                    'height': height,
+                    'author_id': rnd.choice(author_ids),
+                    'status': Image.READY,
+                })
+            db_session.execute(insert(Image), rows)
+            db_session.commit()
+
+            created += len(rows)
+            click.echo('Created {} of {} image(s)'.format(created, images))
+
+    if created:
+        bump_gallery_version()
+
+
+def init_app(app):
+    app.cli.add_command(seed_gallery_command)
@@ -0,0 +1,43 @@
+"""
+Cache of compiled templates shared by all worker processes.
+
+Jinja compiles every template from source the first time it's rendered
+in a process, which adds to the latency of first requests served by
+every (re)spawned worker. With `TEMPLATE_BYTECODE_CACHE` enabled,
+compiled templates are stored in `TEMPLATE_BYTECODE_CACHE_DIR`, so only
+the first process renders them from source. Entries of changed
+templates are recognized by checksum of their source and replaced.
+"""
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    """
+    File system bytecode cache which creates it's directory when first
+    template is stored, so nothing is done on application startup.
+    Files are written under temporary names and renamed, so processes
+    never read partially written entries.
+    """
+
+    def dump_bytecode(self, bucket):
+        try:
+            try:
+                super().dump_bytecode(bucket)
+            except FileNotFoundError:
+                os.makedirs(self.directory, exist_ok=True)
+                super().dump_bytecode(bucket)
+        except OSError:
+            # Template is compiled from source again in the next process
+            pass
+
+
+def get_cache_dir(app):
+    return app.config['TEMPLATE_BYTECODE_CACHE_DIR'] or os.path.join(app.instance_path, 'jinja-cache')
+
+
+def init_app(app):
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        # Options are used when Jinja environment is created on first render
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=BytecodeCache(get_cache_dir(app)))
@@ -13,7 +13,7 @@ setup(
     long_description_content_type='text/markdown',
     url='https://dev.krastaman.tk/docs/ch-gallery',
     license_file='LICENSE.txt',
-    packages=find_packages(),
+    packages=find_packages(exclude=('benchmarks',)),
     include_package_data=True,
     zip_safe=False,
     classifiers=[
@@ -23,8 +23,8 @@ setup(
     ],
     python_requires='>=3.5',
     install_requires=[
-        'flask>=1.1.2',
-        'sqlalchemy>=1.3.20',
+        'flask>=2.0',
+        'sqlalchemy>=2.0',
         'flask-wtf>=0.14.3',
         'email-validator>=1.1.2',
         'pillow>=8.0.1',
@@ -14,11 +14,13 @@ from chgallery.db.declarative import User
 def app():
     db_fd, db_path = tempfile.mkstemp()
     upload_path = tempfile.mkdtemp('upload')
+    template_cache_path = tempfile.mkdtemp('jinja-cache')
 
     app = create_app({
         'TESTING': True,
         'DATABASE': 'sqlite:///{}'.format(db_path),
         'UPLOAD_PATH': upload_path,
+        'TEMPLATE_BYTECODE_CACHE_DIR': template_cache_path,
         'WTF_CSRF_ENABLED': False,
 
         # https://stackoverflow.com/questions/31766082/flask-url-for-error-attempted-to-generate-a-url-without-the-application-conte # noqa
@@ -44,6 +46,7 @@ def app():
     os.close(db_fd)
     os.unlink(db_path)
     shutil.rmtree(upload_path)
+    shutil.rmtree(template_cache_path)
 
 
 @pytest.fixture
@@ -1,7 +1,9 @@
 import pytest
+from sqlalchemy import event
 
-from chgallery.db import get_db_session
+from chgallery.db import get_db_engine, get_db_session
 from chgallery.db.declarative import User
+from chgallery.image.storage import get_path
 
 
 class TestLoginForm:
@@ -93,3 +95,67 @@ def test_login_required_decorator(client, auth):
     assert response.headers['location'].endswith('/auth/login')
     auth.login()
     assert client.get('/auth/').status_code == 200
+
+
+@pytest.fixture
+def queries(app):
+    statements = []
+    with app.app_context():
+        event.listen(get_db_engine(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    return statements
+
+
+class TestUserLoadingClass:
+
+    @pytest.mark.parametrize('static_app', [True, False])
+    def test_uploaded_files_dont_load_user(self, app, client, auth, queries, static_app):
+        # Without static app files are served by Flask view
+        app.config['UPLOAD_STATIC_APP'] = static_app
+        with open(get_path(app.config['UPLOAD_PATH'], 'image.jpg', 'thumbs', sharded=False), 'wb') as fp:
+            fp.write(b'image')
+        auth.login()
+        del queries[:]
+
+        for i in range(5):
+            assert client.get('/image/uploads/thumbs/image.jpg').status_code == 200
+        assert queries == []
+
+    def test_user_is_cached(self, client, auth, queries):
+        auth.login()
+        assert client.get('/auth/').status_code == 200
+        del queries[:]
+
+        assert client.get('/auth/').status_code == 200
+        assert not [query for query in queries if 'FROM user' in query]
+
+    def test_cache_disabled(self, app, client, auth, queries):
+        app.config['USER_CACHE_TTL'] = 0
+        auth.login()
+        client.get('/auth/')
+        del queries[:]
+
+        client.get('/auth/')
+        assert [query for query in queries if 'FROM user' in query]
+
+    def test_deleted_user_is_logged_out(self, app, client, auth):
+        auth.login()
+        assert client.get('/auth/').status_code == 200
+
+        with app.app_context():
+            db_session = get_db_session()
+            db_session.delete(db_session.query(User).filter(User.username == 'test').one())
+            db_session.commit()
+
+        response = client.get('/auth/')
+        assert response.headers['location'].endswith('/auth/login')
+
+    def test_logout_invalidates_cache(self, app, client, auth):
+        auth.login()
+        client.get('/auth/')
+        with app.app_context():
+            user_id = get_db_session().query(User.id).filter(User.username == 'test').scalar()
+            assert app.extensions['chgallery.identity_cache'].get(user_id) is not None
+
+        auth.logout()
+        with app.app_context():
+            assert app.extensions['chgallery.identity_cache'].get(user_id) is None
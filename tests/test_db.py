@@ -0,0 +1,307 @@
+import io
+import multiprocessing
+import os
+import sqlite3
+
+import pytest
+from PIL import Image as PILImage
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, event, inspect
+
+import chgallery.image
+from chgallery import create_app
+from chgallery.db import get_db_engine, get_db_session
+from chgallery.db.declarative import Image, User
+from chgallery.db.migrations import MigrationError, upgrade_db
+from chgallery.image.derivatives import process_pending_images
+from chgallery.image.storage import iter_files
+
+
+class TestEngineClass:
+
+    def test_connections_are_reused_across_requests(self, app, client):
+        with app.app_context():
+            engine = get_db_engine()
+
+        connections = []
+        event.listen(engine, 'connect', lambda *args: connections.append(args))
+
+        for i in range(5):
+            assert client.get('/').status_code == 200
+
+        with app.app_context():
+            assert get_db_engine() is engine
+
+        # At most one new connection may be opened, all following
+        # requests should take it from the pool.
+        assert len(connections) <= 1
+
+    def test_session_is_scoped_to_app_context(self, app):
+        with app.app_context():
+            session = get_db_session()
+            assert get_db_session() is session
+
+        with app.app_context():
+            assert get_db_session() is not session
+
+    def test_pool_is_replaced_after_fork(self, app, monkeypatch):
+        with app.app_context():
+            engine = get_db_engine()
+            pool = engine.pool
+
+            monkeypatch.setattr('os.getpid', lambda: -1)
+            assert get_db_engine() is engine
+            assert engine.pool is not pool
+
+    def test_pool_configuration(self, app):
+        app.config.update(
+            DATABASE_POOL_SIZE=3,
+            DATABASE_MAX_OVERFLOW=2,
+            DATABASE_POOL_RECYCLE=60,
+            DATABASE_POOL_PRE_PING=True,
+        )
+        app.extensions.pop('chgallery.db', None)
+
+        with app.app_context():
+            pool = get_db_engine().pool
+
+        assert pool.size() == 3
+        assert pool._max_overflow == 2
+        assert pool._recycle == 60
+        assert pool._pre_ping
+
+
+def _stress_worker(config, worker, iterations):
+    """
+    Upload images and read gallery pages as logged in user in separate
+    process. Returns list of errors.
+    """
+    app = create_app(config)
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'test', 'password': 'test'})
+
+    data = io.BytesIO()
+    PILImage.new('RGB', (32, 32), 'red').save(data, 'PNG')
+    errors = []
+
+    for i in range(iterations):
+        try:
+            response = client.post('/image/upload', data={
+                'image': (io.BytesIO(data.getvalue()), 'worker_{}.png'.format(worker)),
+            })
+            if response.status_code != 302:
+                errors.append('upload: {}'.format(response.status_code))
+            for url in ('/', '/auth/'):
+                response = client.get(url)
+                if response.status_code != 200:
+                    errors.append('{}: {}'.format(url, response.status_code))
+        except Exception as e:
+            errors.append(repr(e))
+
+    return errors
+
+
+class TestSqliteClass:
+
+    def test_pragmas_are_applied(self, app):
+        with app.app_context():
+            with get_db_engine().connect() as connection:
+                assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+                assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000
+                assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1
+                assert connection.exec_driver_sql('PRAGMA cache_size').scalar() == -16000
+
+    def test_pragmas_disabled(self, app):
+        app.config['DATABASE_SQLITE_PRAGMAS'] = None
+        app.extensions.pop('chgallery.db', None)
+        with app.app_context():
+            with get_db_engine().connect() as connection:
+                assert connection.exec_driver_sql('PRAGMA cache_size').scalar() != -16000
+
+    def test_db_tune(self, runner):
+        result = runner.invoke(args=['db-tune'])
+        assert result.exit_code == 0
+        assert 'journal_mode = wal' in result.output
+
+    def test_db_checkpoint(self, app, client, runner):
+        client.get('/')
+        result = runner.invoke(args=['db-checkpoint', '--mode', 'passive'])
+        assert result.exit_code == 0
+        assert 'Checkpointed' in result.output
+
+    def test_concurrent_processes(self, app):
+        config = {
+            key: app.config[key]
+            for key in (
+                'TESTING', 'DATABASE', 'UPLOAD_PATH', 'TEMPLATE_BYTECODE_CACHE_DIR', 'WTF_CSRF_ENABLED', 'SERVER_NAME'
+            )
+        }
+        workers, iterations = 4, 10
+
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers) as pool:
+            results = pool.starmap(_stress_worker, [(config, worker, iterations) for worker in range(workers)])
+
+        assert [error for errors in results for error in errors] == []
+        with app.app_context():
+            assert get_db_session().query(Image).count() == workers * iterations
+        assert len(list(iter_files(app.config['UPLOAD_PATH']))) == workers * iterations
+
+
+class TestReplicaClass:
+
+    @pytest.fixture
+    def replica(self, app):
+        primary_path = app.config['DATABASE'][len('sqlite:///'):]
+        replica_path = primary_path + '-replica'
+        with sqlite3.connect(primary_path) as source, sqlite3.connect(replica_path) as target:
+            source.backup(target)
+        source.close()
+        target.close()
+
+        app.config['DATABASE_REPLICAS'] = ['sqlite:///{}'.format(replica_path)]
+        app.extensions.pop('chgallery.db', None)
+        engine = create_engine(app.config['DATABASE_REPLICAS'][0])
+
+        yield engine
+
+        engine.dispose()
+        os.unlink(replica_path)
+
+    def _upload(self, client):
+        data = io.BytesIO()
+        PILImage.new('RGB', (32, 32), 'red').save(data, 'PNG')
+        data.seek(0)
+        return client.post('/image/upload', data={'image': (data, 'uploaded.png')})
+
+    def test_reads_go_to_replica(self, client, replica):
+        with replica.begin() as connection:
+            connection.execute(Image.__table__.insert().values(name='replicated.jpg', width=10, height=10))
+
+        assert b'replicated.jpg' in client.get('/').data
+
+    def test_writes_go_to_primary(self, app, replica):
+        with app.app_context():
+            db_session = get_db_session()
+            assert db_session.query(User).count() == 1
+            assert not db_session.use_primary
+
+            db_session.add(Image(name='written.jpg', width=10, height=10))
+            db_session.commit()
+            assert db_session.use_primary
+            assert db_session.query(Image).count() == 1
+
+        with replica.connect() as connection:
+            assert connection.execute(Image.__table__.select()).all() == []
+
+    def test_client_sticks_to_primary_after_write(self, app, client, auth, replica):
+        auth.login()
+        assert self._upload(client).status_code == 302
+        assert b'uploaded.png' in client.get('/auth/').data
+
+        app.config['DATABASE_REPLICA_LAG'] = 0
+        assert self._upload(client).status_code == 302
+        assert b'uploaded.png' not in client.get('/auth/').data
+
+
+class TestMigrationsClass:
+
+    @pytest.fixture
+    def old_database(self, app):
+        # Schema from before status column and indexes were added
+        with app.app_context():
+            engine = get_db_engine()
+        with engine.begin() as connection:
+            connection.exec_driver_sql('DROP TABLE image')
+            connection.exec_driver_sql(
+                'CREATE TABLE image (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL UNIQUE, '
+                'description VARCHAR(128) NOT NULL, creation_date DATETIME, width INTEGER NOT NULL, '
+                'height INTEGER NOT NULL, author_id INTEGER REFERENCES user(id))'
+            )
+            connection.exec_driver_sql(
+                "INSERT INTO image (name, description, width, height) VALUES ('old.jpg', '', 10, 10)"
+            )
+        return engine
+
+    def test_upgrade(self, app, runner, old_database):
+        result = runner.invoke(args=['db-upgrade'])
+        assert result.exit_code == 0
+        assert 'Added column image.status' in result.output
+        assert 'Created index ix_image_author_id_creation_date' in result.output
+
+        inspector = inspect(old_database)
+        assert 'status' in {column['name'] for column in inspector.get_columns('image')}
+        assert {'ix_image_author_id_creation_date', 'ix_image_status_id', 'ix_image_name'} <= {
+            index['name'] for index in inspector.get_indexes('image')
+        }
+
+        with app.app_context():
+            image = get_db_session().query(Image).one()
+            assert image.name == 'old.jpg'
+            assert image.is_ready
+
+        result = runner.invoke(args=['db-upgrade'])
+        assert result.output == 'Database is up to date\n'
+
+    def test_new_table(self, app):
+        metadata = MetaData()
+        Table('other', metadata, Column('id', Integer, primary_key=True))
+
+        with app.app_context():
+            assert upgrade_db(get_db_engine(), metadata) == ['Created table other']
+
+    def test_not_null_column_is_rejected(self, app):
+        metadata = MetaData()
+        Table('user', metadata, Column('id', Integer, primary_key=True), Column('age', Integer, nullable=False))
+
+        with app.app_context():
+            with pytest.raises(MigrationError):
+                upgrade_db(get_db_engine(), metadata)
+
+
+class TestQueryPlanClass:
+
+    @pytest.fixture
+    def statements(self, app):
+        captured = []
+        with app.app_context():
+            engine = get_db_engine()
+            db_session = get_db_session()
+            user = db_session.query(User).one()
+            for i in range(20):
+                db_session.add(Image(name='image_{}.jpg'.format(i), width=10, height=10, author=user))
+            db_session.commit()
+
+        event.listen(engine, 'before_cursor_execute', lambda *args: captured.append((args[2], args[3])))
+        return captured
+
+    def query_plans(self, app, statements):
+        with app.app_context():
+            with get_db_engine().connect() as connection:
+                for statement, parameters in statements:
+                    if statement.startswith('SELECT') and 'FROM image' in statement:
+                        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)
+                        yield statement, ' '.join(row[3] for row in rows)
+
+    def assert_uses_index(self, app, statements, index):
+        plans = list(self.query_plans(app, statements))
+        assert plans
+        for statement, plan in plans:
+            assert index in plan, statement
+            assert 'SCAN' not in plan, statement
+            assert 'TEMP B-TREE' not in plan, statement
+
+    def test_dashboard(self, app, client, auth, statements):
+        auth.login()
+        del statements[:]
+        assert client.get('/auth/').status_code == 200
+        self.assert_uses_index(app, statements, 'ix_image_author_id_creation_date')
+
+    def test_pending_images(self, app, statements):
+        with app.app_context():
+            process_pending_images()
+        self.assert_uses_index(app, statements, 'ix_image_status_id')
+
+    def test_unique_filename(self, app, statements):
+        with app.app_context():
+            assert chgallery.image.get_unique_filename('image_1.jpg') == 'image_1(1).jpg'
+        self.assert_uses_index(app, statements, 'ix_image_name')
@@ -1,6 +1,33 @@
+import os
+
 from chgallery import create_app
 
 
 def test_config():
     assert not create_app().testing
     assert create_app({'TESTING': True}).testing
+
+
+def test_no_directories_are_created(tmp_path):
+    create_app({
+        'TESTING': True,
+        'DATABASE': 'sqlite:///{}'.format(tmp_path / 'instance' / 'chgallery.sqlite'),
+        'UPLOAD_PATH': str(tmp_path / 'uploads'),
+        'TEMPLATE_BYTECODE_CACHE_DIR': str(tmp_path / 'jinja-cache'),
+    })
+    assert not os.listdir(tmp_path)
+
+
+def test_template_bytecode_cache(app, client):
+    cache_dir = app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+    os.rmdir(cache_dir)
+    assert client.get('/').status_code == 200
+    assert os.listdir(cache_dir)
+
+    # Another process loads compiled templates instead of compiling them
+    other_app = create_app(dict(app.config))
+    compiled = []
+    compile_template = other_app.jinja_env.compile
+    other_app.jinja_env.compile = lambda *args, **kwargs: compiled.append(args) or compile_template(*args, **kwargs)
+    assert other_app.test_client().get('/').status_code == 200
+    assert not compiled
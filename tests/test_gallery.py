@@ -0,0 +1,153 @@
+import os
+
+import pytest
+from sqlalchemy import event
+
+from chgallery.db import get_db_engine, get_db_session
+from chgallery.db.declarative import Image
+from chgallery.pagecache import bump_gallery_version
+
+
+@pytest.fixture
+def images(app):
+    app.config['GALLERY_PAGE_SIZE'] = 2
+
+    with app.app_context():
+        db_session = get_db_session()
+        for i in range(5):
+            db_session.add(Image(name='image_{}.jpg'.format(i), width=300, height=200))
+        db_session.commit()
+
+
+class TestGalleryPaginationClass:
+
+    def test_first_page(self, client, images):
+        response = client.get('/')
+        assert response.status_code == 200
+        assert b'image_0.jpg' in response.data
+        assert b'image_1.jpg' in response.data
+        assert b'image_2.jpg' not in response.data
+        assert b'data-next="/page.json?after=2"' in response.data
+        assert b'href="/?after=2"' in response.data
+
+    def test_next_page(self, client, images):
+        response = client.get('/?after=2')
+        assert b'image_1.jpg' not in response.data
+        assert b'image_2.jpg' in response.data
+        assert b'image_3.jpg' in response.data
+
+    def test_last_page(self, client, images):
+        response = client.get('/?after=4')
+        assert b'image_4.jpg' in response.data
+        assert b'data-next' not in response.data
+        assert b'More images' not in response.data
+
+    def test_json_page(self, client, images):
+        data = client.get('/page.json?after=2').get_json()
+        assert [image['url'] for image in data['images']] == [
+            '/image/uploads/image_2.jpg',
+            '/image/uploads/image_3.jpg',
+        ]
+        assert data['images'][0]['thumbnail_url'] == '/image/uploads/thumbs/image_2.jpg'
+        assert data['images'][0]['width'] == 300
+        assert data['next'] == '/page.json?after=4'
+
+        data = client.get(data['next']).get_json()
+        assert len(data['images']) == 1
+        assert data['next'] is None
+
+
+@pytest.fixture(params=['memory', 'filesystem'])
+def page_cache(app, request):
+    app.config['PAGE_CACHE'] = request.param
+    app.config['PAGE_CACHE_DIR'] = os.path.join(app.config['UPLOAD_PATH'], '.page-cache')
+
+
+def count_queries(app):
+    queries = []
+    with app.app_context():
+        event.listen(get_db_engine(), 'before_cursor_execute', lambda *args: queries.append(args[2]))
+    return queries
+
+
+class TestPageCacheClass:
+
+    def test_cached_page_doesnt_query_database(self, app, client, images, page_cache):
+        first = client.get('/')
+        queries = count_queries(app)
+        second = client.get('/')
+        assert second.data == first.data
+        assert queries == []
+
+        client.get('/page.json?after=2')
+        assert queries
+
+    def test_conditional_request(self, client, images, page_cache):
+        response = client.get('/')
+        assert response.headers['ETag']
+        assert 'Cookie' in response.headers['Vary']
+
+        response = client.get('/', headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+    def test_changes_invalidate_cache(self, app, client, images, page_cache):
+        etag = client.get('/?after=4').headers['ETag']
+
+        with app.app_context():
+            db_session = get_db_session()
+            db_session.add(Image(name='image_new.jpg', width=300, height=200))
+            db_session.commit()
+            bump_gallery_version()
+
+        response = client.get('/?after=4')
+        assert b'image_new.jpg' in response.data
+        assert response.headers['ETag'] != etag
+
+    def test_logged_in_user_is_not_cached(self, app, client, auth, images, page_cache):
+        client.get('/')
+        auth.login()
+        queries = count_queries(app)
+        response = client.get('/')
+        assert queries
+        assert 'ETag' not in response.headers
+
+    def test_other_arguments_are_not_cached(self, app, client, images, page_cache):
+        client.get('/?x=1')
+        client.get('/?after=4&after=5')
+        queries = count_queries(app)
+        client.get('/?x=1')
+        assert queries
+
+        del queries[:]
+        client.get('/?after=4&after=5')
+        assert queries
+
+    def test_memory_cache_expires(self, app, client, images):
+        app.config['PAGE_CACHE'] = 'memory'
+        app.config['PAGE_CACHE_TTL'] = -1
+        client.get('/')
+        queries = count_queries(app)
+        client.get('/')
+        assert queries
+
+    def test_etag_changes_with_content(self, app, client, images):
+        app.config['PAGE_CACHE'] = 'memory'
+        app.config['PAGE_CACHE_TTL'] = -1
+        etag = client.get('/?after=4').headers['ETag']
+
+        # Added by another process, version of this one is not bumped
+        with app.app_context():
+            db_session = get_db_session()
+            db_session.add(Image(name='image_new.jpg', width=300, height=200))
+            db_session.commit()
+
+        response = client.get('/?after=4', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert b'image_new.jpg' in response.data
+        assert response.headers['ETag'] != etag
+
+    def test_disabled_by_default(self, app, client, images):
+        client.get('/')
+        queries = count_queries(app)
+        client.get('/')
+        assert queries
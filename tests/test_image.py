@@ -1,14 +1,27 @@
+import datetime
+import hashlib
 import io
 import os
+import shutil
+import threading
+import time
 
 import pytest
+from flask import Request, request
 from PIL import Image as PILImage
+from sqlalchemy import event
 from werkzeug.datastructures import FileStorage
 from werkzeug.security import generate_password_hash
 
-from chgallery.db import get_db_session
+import chgallery.image
+from chgallery.db import get_db_engine, get_db_session
 from chgallery.db.declarative import Image, User
-from chgallery.image.utils import is_allowed_image_file, smart_resize
+from chgallery.image import regenerate
+from chgallery.image.cache import ByteCache
+from chgallery.image.derivatives import get_options
+from chgallery.image.storage import get_path, get_relative_path, get_shard
+from chgallery.image.streaming import UploadStream
+from chgallery.image.utils import get_resample_filter, is_allowed_image_file, smart_resize
 
 TEST_PICTURE = os.path.join(os.getcwd(), 'tests', 'assets', 'test_picture.jpg')
 
@@ -22,6 +35,11 @@ def mock_txt_file():
     )
 
 
+def stored_path(app, filename, dirname=None):
+    """ Location of uploaded file in sharded layout """
+    return os.path.join(app.config['UPLOAD_PATH'], get_relative_path(filename, dirname))
+
+
 @pytest.fixture
 def mock_jpg_file():
     return FileStorage(
@@ -62,6 +80,29 @@ def test_resize_high_image(image_copy):
     assert image_copy.width == 1333
 
 
+def test_resize_to_given_size(image_copy):
+    image_copy = smart_resize(image_copy, max_size=500)
+    assert image_copy.width == 500
+    assert image_copy.height == 333
+
+
+def test_small_image_is_not_upscaled():
+    img = PILImage.new('RGB', (640, 480))
+    assert smart_resize(img) is img
+    assert smart_resize(img, upscale=True).size == (2000, 1500)
+    assert smart_resize(img, max_size=320, resample=get_resample_filter('nearest')).size == (320, 240)
+
+
+def test_resize_decodes_jpeg_at_reduced_scale():
+    fp = io.BytesIO()
+    PILImage.new('RGB', (2000, 1000), 'blue').save(fp, 'JPEG')
+    img = PILImage.open(fp)
+    resized = smart_resize(img, max_size=400)
+    assert resized.size == (400, 200)
+    # Image was decoded at 1/4 scale, not at full resolution
+    assert img.size == (500, 250)
+
+
 class TestUploadImageClass:
 
     def test_only_authorized_user_can_upload_file(self, client):
@@ -95,9 +136,9 @@ class TestUploadImageClass:
             assert image.url().endswith('/image/uploads/{}'.format(image.name))
             assert image.thumbnail_url().endswith('/image/uploads/thumbs/{}'.format(image.name))
             assert image.preview_url().endswith('/image/uploads/previews/{}'.format(image.name))
-            assert image.name in os.listdir(app.config['UPLOAD_PATH'])
-            assert image.name in os.listdir(os.path.join(app.config['UPLOAD_PATH'], 'thumbs'))
-            assert image.name in os.listdir(os.path.join(app.config['UPLOAD_PATH'], 'previews'))
+            assert os.path.exists(stored_path(app, image.name))
+            assert os.path.exists(stored_path(app, image.name, 'thumbs'))
+            assert os.path.exists(stored_path(app, image.name, 'previews'))
 
         response = client.get('/image/uploads/{}'.format(image.name))
         assert response.status_code == 200
@@ -142,6 +183,46 @@ class TestUploadImageClass:
         assert items[1].name == 'repeated_name(1).jpg'
         assert items[2].name == 'repeated_name(2).jpg'
 
+    def test_unique_name_needs_single_query(self, app):
+        with app.test_request_context():
+            db_session = get_db_session()
+            db_session.add(Image(name='IMG_0001.jpg', width=1, height=1))
+            db_session.add(Image(name='IMG_0001x.jpg', width=1, height=1))
+            for i in range(1, 50):
+                db_session.add(Image(name='IMG_0001({}).jpg'.format(i), width=1, height=1))
+            db_session.commit()
+
+            queries = []
+            event.listen(get_db_engine(), 'before_cursor_execute', lambda *args: queries.append(args))
+            assert chgallery.image.get_unique_filename('IMG_0001.jpg') == 'IMG_0001(50).jpg'
+            assert len(queries) == 1
+
+            # Free slots are reused and underscore is not treated as wildcard
+            assert chgallery.image.get_unique_filename('IMG_0001x.png') == 'IMG_0001x.png'
+            assert chgallery.image.get_unique_filename('IMGx0001.jpg') == 'IMGx0001.jpg'
+
+    def test_name_taken_concurrently(self, app, client, auth, monkeypatch, mock_jpg_file):
+        with app.app_context():
+            db_session = get_db_session()
+            db_session.add(Image(name='test_picture.jpg', width=1, height=1))
+            db_session.commit()
+
+        # Simulate other process taking the name between check and insert
+        get_unique_filename = chgallery.image.get_unique_filename
+        names = iter(['test_picture.jpg'])
+        monkeypatch.setattr(
+            chgallery.image, 'get_unique_filename',
+            lambda filename: next(names, None) or get_unique_filename(filename),
+        )
+
+        auth.login()
+        response = client.post('/image/upload', data={'image': mock_jpg_file})
+        assert response.status_code == 302
+
+        with app.app_context():
+            db_session = get_db_session()
+            assert db_session.query(Image).filter(Image.name == 'test_picture(1).jpg').count() == 1
+
 
 class TestDeleteImageClass:
 
@@ -189,9 +270,9 @@ class TestDeleteImageClass:
             db_session = get_db_session()
             assert not db_session.query(Image).all()
 
-        assert 'test_picture.jpg' not in os.listdir(app.config['UPLOAD_PATH'])
-        assert 'test_picture.jpg' not in os.listdir(os.path.join(app.config['UPLOAD_PATH'], 'thumbs'))
-        assert 'test_picture.jpg' not in os.listdir(os.path.join(app.config['UPLOAD_PATH'], 'previews'))
+        assert not os.path.exists(stored_path(app, 'test_picture.jpg'))
+        assert not os.path.exists(stored_path(app, 'test_picture.jpg', 'thumbs'))
+        assert not os.path.exists(stored_path(app, 'test_picture.jpg', 'previews'))
 
     def test_that_images_are_deleted_along_with_author(self, app, auth, client, mock_jpg_file):
         other_user = User(
@@ -233,3 +314,734 @@ class TestDashboardClass:
         response = client.get('/auth/')
         assert response.status_code == 200
         assert b'/image/uploads/previews/test_picture.jpg' in response.data
+
+
+class TestDisplayUploadedFileClass:
+
+    @pytest.fixture
+    def uploaded_png(self, app):
+        img = PILImage.new('RGB', (64, 64), 'red')
+        img.save(os.path.join(app.config['UPLOAD_PATH'], 'picture.png'), 'PNG')
+        # Extension that doesn't match file contents
+        img.save(get_path(app.config['UPLOAD_PATH'], 'picture.txt', 'thumbs', sharded=False), 'PNG')
+        return 'picture.png'
+
+    def test_real_mime_type(self, client, uploaded_png):
+        response = client.get('/image/uploads/{}'.format(uploaded_png))
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'image/png'
+
+        response = client.get('/image/uploads/thumbs/picture.txt')
+        assert response.headers['content-type'] == 'image/png'
+
+    def test_extension_doesnt_override_real_type(self, app, client):
+        PILImage.new('RGB', (64, 64), 'red').save(os.path.join(app.config['UPLOAD_PATH'], 'picture.jpg'), 'PNG')
+        response = client.get('/image/uploads/picture.jpg')
+        assert response.headers['content-type'] == 'image/png'
+
+    def test_missing_file(self, client):
+        assert client.get('/image/uploads/does_not_exist.jpg').status_code == 404
+        assert client.get('/image/uploads/thumbs/..%2F..%2Fetc%2Fpasswd').status_code == 404
+
+    def test_conditional_request(self, client, uploaded_png):
+        response = client.get('/image/uploads/{}'.format(uploaded_png))
+        assert response.headers['etag']
+        assert response.headers['last-modified']
+
+        response = client.get(
+            '/image/uploads/{}'.format(uploaded_png),
+            headers={'If-None-Match': response.headers['etag']},
+        )
+        assert response.status_code == 304
+        assert not response.data
+
+    def test_range_request(self, client, uploaded_png):
+        full = client.get('/image/uploads/{}'.format(uploaded_png)).data
+        response = client.get('/image/uploads/{}'.format(uploaded_png), headers={'Range': 'bytes=0-9'})
+        assert response.status_code == 206
+        assert response.data == full[:10]
+        assert response.headers['content-range'] == 'bytes 0-9/{}'.format(len(full))
+
+    def test_accel_redirect(self, app, client, uploaded_png):
+        app.config['UPLOAD_ACCEL_REDIRECT'] = '/protected/'
+        response = client.get('/image/uploads/thumbs/picture.txt')
+        assert response.headers['x-accel-redirect'] == '/protected/thumbs/picture.txt'
+        assert response.headers['content-type'] == 'image/png'
+        assert not response.data
+
+    @pytest.fixture
+    def app_requests(self, app):
+        endpoints = []
+        app.before_request(lambda: endpoints.append(request.endpoint))
+        return endpoints
+
+    def test_static_app(self, app, client, uploaded_png, app_requests):
+        response = client.get('/image/uploads/thumbs/picture.txt')
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'image/png'
+        assert response.headers['etag']
+
+        response = client.get('/image/uploads/{}'.format(uploaded_png))
+        assert response.status_code == 200
+        assert app_requests == []
+
+        app.config['UPLOAD_STATIC_APP'] = False
+        response = client.get('/image/uploads/{}'.format(uploaded_png))
+        assert response.status_code == 200
+        assert app_requests == ['image.uploaded_file']
+
+    def test_static_app_falls_through(self, app, client, uploaded_png, app_requests):
+        assert client.get('/image/uploads/does_not_exist.jpg').status_code == 404
+        assert client.get('/image/uploads/thumbs/..%2F{}'.format(uploaded_png)).status_code == 404
+        assert client.get('/image/uploads/..%2F..%2Fetc%2Fpasswd').status_code == 404
+        assert client.get('/image/uploads/unknown/picture.txt').status_code == 404
+        assert len(app_requests) == 4
+
+
+class TestDerivativesClass:
+
+    def _get_image(self, app):
+        with app.app_context():
+            db_session = get_db_session()
+            image = db_session.query(Image).filter(Image.name == 'test_picture.jpg').one()
+            db_session.close()
+        return image
+
+    def test_uploaded_image_is_closed(self, app, auth, client, mock_jpg_file, monkeypatch):
+        app.config['DERIVATIVES_WORKER'] = 'queue'
+        scheduled = []
+        schedule_derivatives = chgallery.image.schedule_derivatives
+        monkeypatch.setattr(chgallery.image, 'schedule_derivatives', lambda *args: (
+            scheduled.append(args) or schedule_derivatives(*args)
+        ))
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+
+        (image, img), = scheduled
+        assert img.fp is None
+
+    def test_stale_claims_are_requeued(self, app, auth, client, runner, mock_jpg_file):
+        app.config['DERIVATIVES_WORKER'] = 'queue'
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+
+        # Claimed by worker which stopped while processing the image
+        with app.app_context():
+            db_session = get_db_session()
+            db_session.query(Image).update({
+                Image.status: Image.PROCESSING, Image.claimed_at: datetime.datetime(2000, 1, 1)
+            })
+            db_session.commit()
+
+        runner.invoke(args=['derivatives-worker', '--once'])
+        assert self._get_image(app).status == Image.READY
+
+    def test_queued_derivatives(self, app, auth, client, runner, mock_jpg_file):
+        app.config['DERIVATIVES_WORKER'] = 'queue'
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+
+        image = self._get_image(app)
+        assert image.status == Image.PENDING
+        assert (image.width, image.height) == (2000, 1333)
+        assert os.path.exists(stored_path(app, image.name))
+        assert not os.path.exists(stored_path(app, image.name, 'thumbs'))
+
+        # Placeholders are displayed until derivatives are ready
+        assert b'Processing' in client.get('/').data
+        assert b'/image/uploads/previews/test_picture.jpg' not in client.get('/auth/').data
+
+        result = runner.invoke(args=['derivatives-worker', '--once'])
+        assert 'Processed 1 image(s)' in result.output
+
+        image = self._get_image(app)
+        assert image.status == Image.READY
+        assert os.path.exists(stored_path(app, image.name, 'thumbs'))
+        assert os.path.exists(stored_path(app, image.name, 'previews'))
+        assert b'/image/uploads/thumbs/test_picture.jpg' in client.get('/').data
+
+        with PILImage.open(stored_path(app, image.name)) as img:
+            assert img.size == (2000, 1333)
+
+    def test_failed_derivatives(self, app, auth, client, runner, mock_jpg_file):
+        app.config['DERIVATIVES_WORKER'] = 'queue'
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+        os.unlink(stored_path(app, 'test_picture.jpg'))
+
+        runner.invoke(args=['derivatives-worker', '--once'])
+        assert self._get_image(app).status == Image.FAILED
+
+    def test_small_image_is_stored_untouched(self, app, auth, client):
+        fp = io.BytesIO()
+        PILImage.new('RGB', (640, 480), 'green').save(fp, 'JPEG')
+        contents = fp.getvalue()
+        fp.seek(0)
+
+        auth.login()
+        client.post('/image/upload', data={'image': FileStorage(stream=fp, filename='small.jpg')})
+
+        with open(stored_path(app, 'small.jpg'), 'rb') as fp:
+            assert fp.read() == contents
+        with PILImage.open(stored_path(app, 'small.jpg', 'thumbs')) as img:
+            assert img.size == (250, 188)
+
+    def test_normalize_images_command(self, app, auth, client, runner, mock_jpg_file):
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+
+        app.config['IMAGE_MAX_SIZE'] = 600
+        result = runner.invoke(args=['normalize-images'])
+        assert 'Normalized 1 image(s)' in result.output
+
+        image = self._get_image(app)
+        assert (image.width, image.height) == (600, 399)
+        with PILImage.open(stored_path(app, image.name)) as img:
+            assert img.size == (600, 399)
+
+    def test_normalize_images_keeps_status_on_error(self, app, auth, client, runner, mock_jpg_file):
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+        os.unlink(stored_path(app, 'test_picture.jpg'))
+
+        result = runner.invoke(args=['normalize-images'])
+        assert 'Normalized 0 image(s), failed 1' in result.output
+        assert self._get_image(app).status == Image.READY
+
+    def test_process_pool_derivatives(self, app, auth, client, mock_jpg_file):
+        app.config['DERIVATIVES_WORKER'] = 'pool'
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+
+        app.extensions['chgallery.derivatives'].executor.shutdown(wait=True)
+        assert self._get_image(app).status == Image.READY
+
+    def test_pool_image_is_not_taken_by_worker(self, app, auth, client, runner, mock_jpg_file):
+        app.config['DERIVATIVES_WORKER'] = 'queue'
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+        with app.app_context():
+            db_session = get_db_session()
+            now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            db_session.query(Image).update({Image.claimed_at: now})
+            db_session.commit()
+
+        # Image was recently submitted to process pool of another worker
+        result = runner.invoke(args=['derivatives-worker', '--once'])
+        assert 'Processed' not in result.output
+        assert self._get_image(app).status == Image.PENDING
+
+    def test_stale_pool_images_are_resubmitted(self, app, auth, client, mock_jpg_file):
+        app.config['DERIVATIVES_WORKER'] = 'queue'
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+        with app.app_context():
+            db_session = get_db_session()
+            db_session.query(Image).update({Image.claimed_at: datetime.datetime(2000, 1, 1)})
+            db_session.commit()
+
+            # Image scheduled by stopped worker is submitted by new process pool
+            app.config['DERIVATIVES_WORKER'] = 'pool'
+            chgallery.image.derivatives._get_executor()
+        app.extensions['chgallery.derivatives'].executor.shutdown(wait=True)
+        assert self._get_image(app).status == Image.READY
+
+
+class TestRegenerateDerivativesClass:
+
+    @pytest.fixture
+    def uploaded(self, app, auth, client, mock_jpg_file, tmp_path):
+        app.instance_path = str(tmp_path)
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+        return stored_path(app, 'test_picture.jpg', 'thumbs')
+
+    def test_missing_files_are_regenerated(self, app, runner, uploaded):
+        result = runner.invoke(args=['regenerate-derivatives', '--workers', '2'])
+        assert 'Regenerated 0, skipped 1, failed 0 image(s)' in result.output
+
+        os.unlink(uploaded)
+        result = runner.invoke(args=['regenerate-derivatives', '--workers', '2'])
+        assert 'Regenerated 1, skipped 0, failed 0 image(s)' in result.output
+        assert os.path.exists(uploaded)
+
+    def test_changed_settings(self, app, runner, uploaded):
+        runner.invoke(args=['regenerate-derivatives', '--workers', '1'])
+
+        app.config['IMAGE_SIZES'] = {'thumbs': 120, 'previews': 100}
+        result = runner.invoke(args=['regenerate-derivatives', '--workers', '1'])
+        assert 'Regenerated 1, skipped 0, failed 0 image(s)' in result.output
+        with PILImage.open(uploaded) as img:
+            assert max(img.size) == 120
+
+        result = runner.invoke(args=['regenerate-derivatives', '--workers', '1'])
+        assert 'Regenerated 0, skipped 1, failed 0 image(s)' in result.output
+
+    def test_interrupted_run_is_continued(self, app, runner, uploaded):
+        with app.app_context():
+            image_id = get_db_session().query(Image.id).scalar()
+            options_digest = regenerate.get_options_digest(get_options(app.config))
+        regenerate.save_state(os.path.join(app.instance_path, regenerate.STATE_FILENAME), {
+            'options': None, 'run_options': options_digest, 'force': True, 'last_id': image_id,
+        })
+
+        result = runner.invoke(args=['regenerate-derivatives', '--workers', '1'])
+        assert 'Continuing after image {}'.format(image_id) in result.output
+        assert 'Regenerated 0, skipped 0, failed 0 image(s)' in result.output
+
+        result = runner.invoke(args=['regenerate-derivatives', '--workers', '1', '--force'])
+        assert 'Regenerated 1, skipped 0, failed 0 image(s)' in result.output
+
+    def test_check(self, app, runner, uploaded):
+        result = runner.invoke(args=['regenerate-derivatives', '--check'])
+        assert result.exit_code == 0
+
+        os.unlink(stored_path(app, 'test_picture.jpg', 'previews'))
+        with open(os.path.join(app.config['UPLOAD_PATH'], 'thumbs', 'orphan.jpg'), 'wb') as fp:
+            fp.write(b'orphan')
+
+        result = runner.invoke(args=['regenerate-derivatives', '--check'])
+        assert result.exit_code == 1
+        assert 'Orphaned file: thumbs/orphan.jpg' in result.output
+        assert 'Missing file: previews/{}/test_picture.jpg'.format(get_shard('test_picture.jpg')) in result.output
+
+
+class TestShardedStorageClass:
+
+    @pytest.fixture
+    def flat_image(self, app):
+        # Image stored before sharding was introduced
+        img = PILImage.new('RGB', (64, 64), 'red')
+        for dirname in (None, 'thumbs', 'previews'):
+            img.save(get_path(app.config['UPLOAD_PATH'], 'flat.jpg', dirname, sharded=False), 'JPEG')
+
+        with app.app_context():
+            db_session = get_db_session()
+            db_session.add(Image(name='flat.jpg', width=64, height=64))
+            db_session.commit()
+        return 'flat.jpg'
+
+    def test_upload_is_sharded(self, app, auth, client, mock_jpg_file):
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+
+        shard = get_shard('test_picture.jpg')
+        assert stored_path(app, 'test_picture.jpg', 'thumbs') == os.path.join(
+            app.config['UPLOAD_PATH'], 'thumbs', shard, 'test_picture.jpg'
+        )
+        assert os.path.exists(stored_path(app, 'test_picture.jpg', 'thumbs'))
+        assert not os.path.exists(os.path.join(app.config['UPLOAD_PATH'], 'test_picture.jpg'))
+        assert client.get('/image/uploads/test_picture.jpg').status_code == 200
+
+    def test_sharding_disabled(self, app, auth, client, mock_jpg_file):
+        app.config['UPLOAD_SHARDING'] = False
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+        assert os.path.exists(os.path.join(app.config['UPLOAD_PATH'], 'thumbs', 'test_picture.jpg'))
+
+    def test_flat_files_are_migrated(self, app, client, runner, flat_image):
+        urls = ['/image/uploads/flat.jpg', '/image/uploads/thumbs/flat.jpg', '/image/uploads/previews/flat.jpg']
+        for url in urls:
+            assert client.get(url).status_code == 200
+
+        result = runner.invoke(args=['shard-uploads', '--batch', '1'])
+        assert 'Moved 3 file(s)' in result.output
+        for dirname in (None, 'thumbs', 'previews'):
+            assert os.path.exists(stored_path(app, flat_image, dirname))
+        assert not os.path.exists(os.path.join(app.config['UPLOAD_PATH'], flat_image))
+
+        for url in urls:
+            assert client.get(url).status_code == 200
+
+        result = runner.invoke(args=['shard-uploads'])
+        assert 'Moved 0 file(s)' in result.output
+
+    def test_flat_files_are_deleted(self, app, auth, client, flat_image):
+        with app.app_context():
+            db_session = get_db_session()
+            db_session.query(Image).update({'author_id': 1})
+            db_session.commit()
+
+        auth.login()
+        client.post('/image/delete/1')
+        assert not os.listdir(os.path.join(app.config['UPLOAD_PATH'], 'thumbs'))
+
+
+class TestStreamingUploadClass:
+
+    @pytest.fixture
+    def written(self, monkeypatch):
+        # Bytes written to upload streams
+        sizes = []
+        write = UploadStream.write
+
+        def counting_write(self, data):
+            sizes.append(len(data))
+            return write(self, data)
+
+        monkeypatch.setattr(UploadStream, 'write', counting_write)
+        return sizes
+
+    def get_tmp_files(self, app):
+        return [name for name in os.listdir(app.config['UPLOAD_PATH']) if name.endswith('.tmp')]
+
+    def test_not_an_image_is_rejected_early(self, app, auth, client, written):
+        auth.login()
+        data = {'image': (io.BytesIO(b'Hello, world!' * 1024 * 1024), 'example.jpg', 'image/jpeg')}
+        response = client.post('/image/upload', data=data)
+
+        assert response.status_code == 415
+        assert b'An image of type' in response.data
+        assert sum(written) < 1024 * 1024
+        assert not self.get_tmp_files(app)
+
+    def test_too_many_pixels(self, app, auth, client, mock_jpg_file, written):
+        app.config['IMAGE_MAX_PIXELS'] = 100 * 100
+        auth.login()
+        response = client.post('/image/upload', data={'image': mock_jpg_file})
+
+        assert response.status_code == 413
+        assert b'too many pixels' in response.data
+        assert sum(written) < os.path.getsize(TEST_PICTURE)
+        assert not self.get_tmp_files(app)
+        with app.app_context():
+            assert get_db_session().query(Image).count() == 0
+
+    def test_too_large_request(self, app, auth, client, mock_jpg_file):
+        app.config['MAX_CONTENT_LENGTH'] = 1024
+        auth.login()
+        response = client.post('/image/upload', data={'image': mock_jpg_file})
+        assert response.status_code == 413
+
+    def test_streamed_file_is_moved(self, app, auth, client, mock_jpg_file):
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+
+        with open(TEST_PICTURE, 'rb') as fp, app.app_context():
+            image = get_db_session().query(Image).one()
+            assert image.digest == hashlib.sha256(fp.read()).hexdigest()
+        assert not self.get_tmp_files(app)
+
+    def test_invalid_form_removes_file(self, app, auth, client, mock_jpg_file):
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file, 'description': 'x' * 200})
+        assert not self.get_tmp_files(app)
+
+    def test_not_streamed_file_to_fresh_instance(self, app, auth, client, mock_jpg_file, monkeypatch):
+        # Requests of plain Flask class don't stream files to upload directory
+        monkeypatch.setattr(app, 'request_class', Request)
+        shutil.rmtree(app.config['UPLOAD_PATH'])
+        auth.login()
+        response = client.post('/image/upload', data={'image': mock_jpg_file})
+
+        assert response.status_code == 302
+        assert os.path.exists(stored_path(app, 'test_picture.jpg'))
+        assert not self.get_tmp_files(app)
+
+
+class TestDeduplicationClass:
+
+    def upload(self, client, path=TEST_PICTURE):
+        client.post('/image/upload', data={'image': FileStorage(
+            stream=open(path, 'rb'), filename='test_picture.jpg', content_type='image/jpeg'
+        )})
+
+    def get_images(self, app):
+        with app.app_context():
+            return get_db_session().query(Image.name, Image.digest, Image.status).order_by(Image.id).all()
+
+    def test_same_file_is_stored_once(self, app, auth, client):
+        auth.login()
+        self.upload(client)
+        self.upload(client)
+
+        first, second = self.get_images(app)
+        with open(TEST_PICTURE, 'rb') as fp:
+            assert first.digest == second.digest == hashlib.sha256(fp.read()).hexdigest()
+        assert second.status == Image.READY
+
+        for dirname in (None, 'thumbs', 'previews'):
+            first_stat = os.stat(stored_path(app, first.name, dirname))
+            second_stat = os.stat(stored_path(app, second.name, dirname))
+            assert first_stat.st_ino == second_stat.st_ino
+            assert second_stat.st_nlink == 2
+
+        assert not [name for name in os.listdir(app.config['UPLOAD_PATH']) if name.endswith('.tmp')]
+
+    def test_shared_files_outlive_deleted_image(self, app, auth, client):
+        auth.login()
+        self.upload(client)
+        self.upload(client)
+        client.post('/image/delete/1')
+
+        (image,) = self.get_images(app)
+        for dirname in (None, 'thumbs'):
+            assert os.stat(stored_path(app, image.name, dirname)).st_nlink == 1
+        assert client.get('/image/uploads/thumbs/{}'.format(image.name)).status_code == 200
+
+    def test_shared_files_stay_linked_when_processed_again(self, app, auth, client, runner):
+        auth.login()
+        self.upload(client)
+        self.upload(client)
+
+        app.config['IMAGE_MAX_SIZE'] = 600
+        result = runner.invoke(args=['normalize-images'])
+        assert 'Normalized 2 image(s)' in result.output
+
+        first, second = self.get_images(app)
+        for dirname in (None, 'thumbs', 'previews'):
+            first_stat = os.stat(stored_path(app, first.name, dirname))
+            assert first_stat.st_ino == os.stat(stored_path(app, second.name, dirname)).st_ino
+            assert first_stat.st_nlink == 2
+        with PILImage.open(stored_path(app, second.name)) as img:
+            assert img.size == (600, 399)
+
+    def test_different_content(self, app, auth, client, tmp_path):
+        path = str(tmp_path / 'other.jpg')
+        PILImage.new('RGB', (64, 64), 'blue').save(path, 'JPEG')
+
+        auth.login()
+        self.upload(client)
+        self.upload(client, path)
+
+        first, second = self.get_images(app)
+        assert first.digest != second.digest
+        assert os.stat(stored_path(app, second.name)).st_nlink == 1
+
+    def test_deduplication_disabled(self, app, auth, client):
+        app.config['IMAGE_DEDUPLICATE'] = False
+        auth.login()
+        self.upload(client)
+        self.upload(client)
+
+        first, second = self.get_images(app)
+        assert os.stat(stored_path(app, second.name)).st_ino != os.stat(stored_path(app, first.name)).st_ino
+
+
+class TestImageVariantsClass:
+
+    @pytest.fixture
+    def variants_app(self, app):
+        app.config['IMAGE_VARIANTS'] = ('webp',)
+        return app
+
+    def test_variants_are_created(self, variants_app, auth, client, mock_jpg_file):
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+
+        for dirname in ('thumbs/webp', 'previews/webp'):
+            with PILImage.open(stored_path(variants_app, 'test_picture.jpg', dirname)) as img:
+                assert img.format == 'WEBP'
+
+        # Resized original is saved with configured encoder options
+        with PILImage.open(stored_path(variants_app, 'test_picture.jpg')) as img:
+            assert img.info.get('progressive')
+
+    def test_variant_negotiation(self, variants_app, auth, client, mock_jpg_file):
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+
+        response = client.get('/image/uploads/thumbs/test_picture.jpg', headers={'Accept': 'image/webp,*/*'})
+        assert response.headers['content-type'] == 'image/webp'
+        assert 'Accept' in response.headers['vary']
+
+        response = client.get('/image/uploads/previews/test_picture.jpg', headers={'Accept': 'image/*'})
+        assert response.headers['content-type'] == 'image/jpeg'
+        assert 'Accept' in response.headers['vary']
+
+    def test_variants_are_deleted(self, variants_app, auth, client, mock_jpg_file):
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+        client.post('/image/delete/1')
+
+        assert not os.path.exists(stored_path(variants_app, 'test_picture.jpg', 'thumbs/webp'))
+        assert not os.path.exists(stored_path(variants_app, 'test_picture.jpg', 'previews/webp'))
+
+    def test_exif_orientation_is_applied(self, app, auth, client):
+        img = PILImage.new('RGB', (400, 200))
+        exif = img.getexif()
+        exif[0x0112] = 6  # rotated 90 degrees clockwise
+        fp = io.BytesIO()
+        img.save(fp, 'JPEG', exif=exif)
+        fp.seek(0)
+
+        auth.login()
+        client.post('/image/upload', data={'image': FileStorage(stream=fp, filename='rotated.jpg')})
+
+        with PILImage.open(stored_path(app, 'rotated.jpg')) as img:
+            assert img.size == (200, 400)
+            assert 'exif' not in img.info
+
+
+class TestResizedImageClass:
+
+    @pytest.fixture
+    def sizes_app(self, app, auth, client, mock_jpg_file):
+        app.config['IMAGE_SIZES'] = dict(app.config['IMAGE_SIZES'], medium=500, small=300)
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+        return app
+
+    def test_size_is_rendered_on_demand(self, sizes_app, client):
+        cache_path = os.path.join(sizes_app.config['UPLOAD_PATH'], 'cache', 'medium')
+        assert not os.path.exists(cache_path)
+
+        response = client.get('/image/uploads/medium/test_picture.jpg')
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'image/jpeg'
+        with PILImage.open(stored_path(sizes_app, 'test_picture.jpg', 'cache/medium')) as img:
+            assert img.width == 500
+
+        with sizes_app.test_request_context():
+            image = Image(name='test_picture.jpg')
+            assert image.resized_url('medium') == '/image/uploads/medium/test_picture.jpg'
+
+    def test_unknown_size_or_file(self, sizes_app, client):
+        assert client.get('/image/uploads/huge/test_picture.jpg').status_code == 404
+        assert client.get('/image/uploads/medium/missing.jpg').status_code == 404
+
+    def test_missing_thumbnail_is_recreated(self, sizes_app, client):
+        os.unlink(stored_path(sizes_app, 'test_picture.jpg', 'thumbs'))
+        assert client.get('/image/uploads/thumbs/test_picture.jpg').status_code == 200
+        assert os.path.exists(stored_path(sizes_app, 'test_picture.jpg', 'thumbs'))
+
+    def test_pending_image_is_not_rendered(self, sizes_app, client):
+        with sizes_app.app_context():
+            db_session = get_db_session()
+            db_session.query(Image).update({Image.status: Image.PROCESSING})
+            db_session.commit()
+        os.unlink(stored_path(sizes_app, 'test_picture.jpg', 'thumbs'))
+
+        assert client.get('/image/uploads/thumbs/test_picture.jpg').status_code == 404
+        assert client.get('/image/uploads/medium/test_picture.jpg').status_code == 404
+        assert not os.path.exists(stored_path(sizes_app, 'test_picture.jpg', 'thumbs'))
+
+    def test_cache_size_limit(self, sizes_app, client):
+        client.get('/image/uploads/medium/test_picture.jpg')
+        medium_size = os.path.getsize(stored_path(sizes_app, 'test_picture.jpg', 'cache/medium'))
+
+        # Only the most recently rendered file fits in the cache
+        sizes_app.config['IMAGE_CACHE_MAX_BYTES'] = medium_size
+        assert client.get('/image/uploads/small/test_picture.jpg').status_code == 200
+        assert not os.path.exists(stored_path(sizes_app, 'test_picture.jpg', 'cache/medium'))
+        assert os.path.exists(stored_path(sizes_app, 'test_picture.jpg', 'cache/small'))
+
+    def test_cache_is_scanned_when_limit_is_exceeded(self, sizes_app, client, monkeypatch):
+        scans = []
+        scan_files = chgallery.image.cache.scan_files
+        monkeypatch.setattr(chgallery.image.cache, 'scan_files', lambda *args: scans.append(args) or scan_files(*args))
+
+        client.get('/image/uploads/medium/test_picture.jpg')
+        client.get('/image/uploads/small/test_picture.jpg')
+        assert len(scans) == 1
+
+        sizes_app.config['IMAGE_CACHE_MAX_BYTES'] = 1
+        os.unlink(stored_path(sizes_app, 'test_picture.jpg', 'cache/small'))
+        client.get('/image/uploads/small/test_picture.jpg')
+        assert len(scans) == 2
+
+    def test_recently_used_file_is_not_touched(self, sizes_app, client):
+        client.get('/image/uploads/medium/test_picture.jpg')
+        path = stored_path(sizes_app, 'test_picture.jpg', 'cache/medium')
+        os.utime(path, (1000, os.stat(path).st_mtime))
+        client.get('/image/uploads/medium/test_picture.jpg')
+        atime = os.stat(path).st_atime
+        assert atime > 1000
+
+        client.get('/image/uploads/medium/test_picture.jpg')
+        assert os.stat(path).st_atime == atime
+
+    def test_concurrent_requests_render_once(self, sizes_app, monkeypatch):
+        rendered = []
+        render_size = chgallery.image.render_size
+
+        def slow_render_size(*args):
+            rendered.append(args)
+            time.sleep(0.2)
+            render_size(*args)
+
+        monkeypatch.setattr(chgallery.image, 'render_size', slow_render_size)
+
+        def fetch(results):
+            results.append(sizes_app.test_client().get('/image/uploads/medium/test_picture.jpg').status_code)
+
+        results = []
+        threads = [threading.Thread(target=fetch, args=(results,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [200] * 4
+        assert len(rendered) == 1
+
+    def test_cached_sizes_are_deleted(self, sizes_app, client):
+        client.get('/image/uploads/medium/test_picture.jpg')
+        client.post('/image/delete/1')
+        assert not os.path.exists(stored_path(sizes_app, 'test_picture.jpg', 'cache/medium'))
+
+
+class TestMemoryCacheClass:
+
+    @pytest.fixture
+    def cache_app(self, app, auth, client, mock_jpg_file):
+        auth.login()
+        client.post('/image/upload', data={'image': mock_jpg_file})
+        app.config['IMAGE_MEMORY_CACHE_BYTES'] = 1024 * 1024
+        return app
+
+    def test_thumbnail_is_cached(self, cache_app, client):
+        url = '/image/uploads/thumbs/test_picture.jpg'
+
+        cache_app.config['IMAGE_MEMORY_CACHE_BYTES'] = 0
+        uncached = client.get(url)
+
+        cache_app.config['IMAGE_MEMORY_CACHE_BYTES'] = 1024 * 1024
+        first = client.get(url)
+        second = client.get(url)
+        assert first.data == second.data == uncached.data
+        assert second.headers['etag'] == uncached.headers['etag']
+        assert second.headers['content-length'] == uncached.headers['content-length']
+        assert second.headers['content-type'] == 'image/jpeg'
+
+        response = client.get(url, headers={'If-None-Match': second.headers['etag']})
+        assert response.status_code == 304
+
+        stats = client.get('/image/cache-stats').get_json()['cache']
+        assert stats['misses'] == 1
+        assert stats['hits'] == 2
+        assert stats['items'] == 1
+
+    def test_full_size_image_is_not_cached(self, cache_app, client):
+        client.get('/image/uploads/test_picture.jpg')
+        assert client.get('/image/cache-stats').get_json()['cache']['items'] == 0
+
+    def test_cache_is_invalidated(self, cache_app, client):
+        client.get('/image/uploads/thumbs/test_picture.jpg')
+        client.get('/image/uploads/previews/test_picture.jpg')
+        assert client.get('/image/cache-stats').get_json()['cache']['items'] == 2
+
+        client.post('/image/delete/1')
+        assert client.get('/image/cache-stats').get_json()['cache']['items'] == 0
+        assert client.get('/image/uploads/thumbs/test_picture.jpg').status_code == 404
+
+
+def test_byte_cache_eviction(tmpdir):
+    paths = []
+    for i in range(3):
+        path = tmpdir.join('{}.bin'.format(i))
+        path.write_binary(b'x' * 100)
+        paths.append(str(path))
+
+    cache = ByteCache(max_bytes=250, max_item_bytes=100)
+    for path in paths:
+        assert cache.load(path, os.stat(path), 'image/jpeg') is not None
+
+    assert cache.get(paths[0], os.stat(paths[0])) is None
+    assert cache.get(paths[2], os.stat(paths[2])).data == b'x' * 100
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['size'] == 200
+
+    # Modified file is not sent from cache
+    tmpdir.join('2.bin').write_binary(b'y' * 50)
+    assert cache.get(paths[2], os.stat(paths[2])) is None
@@ -0,0 +1,106 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from chgallery.metrics import BUCKETS, Metrics, render_metrics
+
+TEST_PICTURE = os.path.join(os.getcwd(), 'tests', 'assets', 'test_picture.jpg')
+
+
+@pytest.fixture
+def metrics_app(app, tmp_path):
+    app.config['METRICS'] = True
+    app.config['METRICS_DIR'] = str(tmp_path)
+    return app
+
+
+def get_metrics(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    return response.get_data(as_text=True).splitlines()
+
+
+def test_timing_is_disabled_by_default(client):
+    assert 'Server-Timing' not in client.get('/').headers
+    assert client.get('/metrics').status_code == 404
+
+
+def test_server_timing_header(app, client):
+    app.config['SERVER_TIMING'] = True
+    header = client.get('/').headers['Server-Timing']
+
+    entries = dict(entry.split(';', 1) for entry in header.split(', '))
+    assert set(entries) == {'db', 'template', 'image', 'total'}
+    assert 'desc="1 queries"' in entries['db']
+
+
+def test_request_metrics(metrics_app, client):
+    client.get('/')
+    client.get('/')
+    client.get('/missing-page')
+
+    lines = get_metrics(client)
+    assert 'chgallery_request_duration_seconds_bucket{endpoint="index",le="+Inf"} 2' in lines
+    assert 'chgallery_request_duration_seconds_count{endpoint="index"} 2' in lines
+    assert 'chgallery_requests_total{endpoint="index",status="200"} 2' in lines
+    assert 'chgallery_requests_total{endpoint="none",status="404"} 1' in lines
+    assert 'chgallery_db_queries_total{endpoint="index"} 2' in lines
+
+
+def test_image_processing_time(metrics_app, auth, client):
+    auth.login()
+    client.post('/image/upload', data={'image': FileStorage(
+        stream=open(TEST_PICTURE, 'rb'), filename='test_picture.jpg', content_type='image/jpeg'
+    )})
+
+    for line in get_metrics(client):
+        if line.startswith('chgallery_image_seconds_total{endpoint="image.upload"}'):
+            assert float(line.split()[-1]) > 0
+            break
+    else:
+        pytest.fail('Image processing time not found')
+
+
+def test_metrics_of_all_workers_are_summed(metrics_app, client, tmp_path):
+    # Metrics written by other worker process
+    other = Metrics()
+    other.inc('chgallery_requests_total', (('endpoint', 'index'), ('status', '200')), 5)
+    with open(os.path.join(str(tmp_path), '1.json'), 'w') as fp:
+        json.dump(other.dump(), fp)
+
+    client.get('/')
+    assert 'chgallery_requests_total{endpoint="index",status="200"} 6' in get_metrics(client)
+
+
+def test_metrics_of_finished_workers_are_archived(metrics_app, client, tmp_path):
+    finished = subprocess.Popen([sys.executable, '-c', 'pass'])
+    finished.wait()
+    other = Metrics()
+    other.inc('chgallery_requests_total', (('endpoint', 'index'), ('status', '200')), 5)
+    with open(os.path.join(str(tmp_path), '{}.json'.format(finished.pid)), 'w') as fp:
+        json.dump(other.dump(), fp)
+
+    client.get('/')
+    assert 'chgallery_requests_total{endpoint="index",status="200"} 6' in get_metrics(client)
+    assert not os.path.exists(os.path.join(str(tmp_path), '{}.json'.format(finished.pid)))
+    assert 'chgallery_requests_total{endpoint="index",status="200"} 6' in get_metrics(client)
+    assert sorted(os.listdir(str(tmp_path))) == ['.locks', '{}.json'.format(os.getpid()), 'archived.json']
+
+
+def test_render_histogram():
+    metrics = Metrics()
+    labels = (('endpoint', 'a"b'),)
+    metrics.observe('latency', labels, BUCKETS[0])
+    metrics.observe('latency', labels, BUCKETS[1])
+    metrics.observe('latency', labels, BUCKETS[-1] * 2)
+
+    lines = render_metrics(metrics).splitlines()
+    assert lines[0] == '# TYPE latency histogram'
+    assert 'latency_bucket{{endpoint="a\\"b",le="{}"}} 1'.format(BUCKETS[0]) in lines
+    assert 'latency_bucket{{endpoint="a\\"b",le="{}"}} 2'.format(BUCKETS[1]) in lines
+    assert 'latency_bucket{endpoint="a\\"b",le="+Inf"} 3' in lines
+    assert 'latency_count{endpoint="a\\"b"} 3' in lines
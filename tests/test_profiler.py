@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from chgallery.profiler import TRIGGER_HEADER, iter_dumps, make_trigger_token
+
+
+@pytest.fixture
+def profiler_app(app, tmp_path):
+    app.config['PROFILER'] = True
+    app.config['PROFILER_DIR'] = str(tmp_path)
+    return app
+
+
+def get_dumps(app):
+    return list(iter_dumps(app.config['PROFILER_DIR']))
+
+
+def test_profiler_is_disabled_by_default(app, client, tmp_path):
+    app.config['PROFILER_DIR'] = str(tmp_path)
+    app.config['PROFILER_SAMPLE_RATE'] = 1.0
+    client.get('/', headers={TRIGGER_HEADER: make_trigger_token(app)})
+    assert not get_dumps(app)
+
+
+def test_sampled_requests_are_profiled(profiler_app, client):
+    profiler_app.config['PROFILER_SAMPLE_RATE'] = 1.0
+    response = client.get('/')
+    assert response.status_code == 200
+
+    (dump,) = get_dumps(profiler_app)
+    assert os.path.basename(os.path.dirname(dump)) == 'index'
+
+
+def test_signed_header_triggers_profiling(profiler_app, client):
+    client.get('/')
+    client.get('/', headers={TRIGGER_HEADER: 'profile.forged'})
+    assert not get_dumps(profiler_app)
+
+    client.get('/', headers={TRIGGER_HEADER: make_trigger_token(profiler_app)})
+    assert len(get_dumps(profiler_app)) == 1
+
+
+def test_dumps_are_rotated(profiler_app, client):
+    profiler_app.config['PROFILER_SAMPLE_RATE'] = 1.0
+    client.get('/')
+    (first,) = get_dumps(profiler_app)
+    profiler_app.config['PROFILER_MAX_BYTES'] = os.path.getsize(first) * 1.5
+
+    client.get('/auth/login')
+    dumps = get_dumps(profiler_app)
+    assert first not in dumps
+    assert len(dumps) == 1
+
+
+def test_profile_report(profiler_app, client, runner):
+    result = runner.invoke(args=['profile-report'])
+    assert 'No dumps found' in result.output
+
+    profiler_app.config['PROFILER_SAMPLE_RATE'] = 1.0
+    client.get('/')
+    client.get('/')
+    client.get('/auth/login')
+
+    result = runner.invoke(args=['profile-report', '--limit', '5'])
+    assert 'index: 2 request(s)' in result.output
+    assert 'auth.login: 1 request(s)' in result.output
+    assert 'function calls' in result.output
+
+    result = runner.invoke(args=['profile-report', '--endpoint', 'auth.login'])
+    assert 'index' not in result.output.splitlines()[0]
+
+
+def test_profile_token(profiler_app, runner):
+    result = runner.invoke(args=['profile-token'])
+    assert result.output.startswith('{}: '.format(TRIGGER_HEADER))
@@ -0,0 +1,32 @@
+import os
+
+from werkzeug.security import check_password_hash
+
+from chgallery.db import get_db_session
+from chgallery.db.declarative import Image, User
+from chgallery.image.storage import get_relative_path
+
+
+def test_seed_gallery(app, runner, client):
+    result = runner.invoke(args=['seed-gallery', '--users', '2', '--images', '3', '--batch', '2', '--workers', '1'])
+    assert 'Created 3 of 3 image(s)' in result.output
+
+    with app.app_context():
+        db_session = get_db_session()
+        users = db_session.query(User).filter(User.username.startswith('seed-user-')).order_by(User.id).all()
+        assert [user.username for user in users] == ['seed-user-1', 'seed-user-2']
+        assert check_password_hash(users[0].password, 'seed')
+
+        images = db_session.query(Image).all()
+        assert len(images) == 3
+        for image in images:
+            assert image.status == Image.READY
+            assert image.author_id in {user.id for user in users}
+            for dirname in (None, 'thumbs', 'previews'):
+                assert os.path.exists(os.path.join(app.config['UPLOAD_PATH'], get_relative_path(image.name, dirname)))
+
+    assert client.get('/image/uploads/thumbs/{}'.format(images[0].name)).status_code == 200
+
+    runner.invoke(args=['seed-gallery', '--users', '1', '--images', '0'])
+    with app.app_context():
+        assert get_db_session().query(User).filter(User.username == 'seed-user-3').count() == 1